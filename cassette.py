@@ -0,0 +1,360 @@
+import bisect
+import hashlib
+import mmap
+import pickle
+import struct
+import sys
+from array import array
+
+from mock import Mock, _arg_map, _recorded_args
+
+"""Record/replay cassettes built on mock.Mock.
+
+Records method calls on a real object (normalized arguments and return value or exception)
+and replays them from a Mock, so integration tests run without live backends.
+
+Cassette file layout (little-endian):
+    magic                          8 bytes
+    header length, header pickle   {'methods': {name: arg_map}, 'canonical': True}
+    records                        [u32 key length, key, u32 outcome length, outcome] * n
+    index                          u64 key hashes (sorted) * n, u64 record offsets * n
+    trailer                        u64 index offset, u64 n, magic
+
+Loading only maps the file and reads the header: records are found through the sorted
+hash index and unpickled on first use.
+
+Keys are pickles of canonical arguments, so arguments equal in Python find the same record:
+dict and set order, and int, float and bool spellings of a number (1, 1.0, True) do not matter.
+Other values, including instances of user classes, must pickle to the same bytes.
+Cassettes written before canonical keys (no 'canonical' in the header) match exact pickles.
+"""
+
+_MAGIC = b'FUNKCAS1'
+_TRAILER = struct.Struct('<QQ8s')
+_LEN = struct.Struct('<I')
+
+
+def _sort_key(value):
+    return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _canonical(value):
+    """Form of value whose pickle is the same for all values equal to it (see module docstring)."""
+    if isinstance(value, bool) or (isinstance(value, float) and value.is_integer()):
+        return int(value)
+    if isinstance(value, dict):
+        items = [(_canonical(k), _canonical(v)) for k, v in value.items()]
+        return (dict, tuple(sorted(items, key=lambda item: _sort_key(item[0]))))
+    if isinstance(value, (set, frozenset)):
+        return (frozenset, tuple(sorted((_canonical(v) for v in value), key=_sort_key)))
+    if type(value) in (list, tuple):
+        return (type(value), tuple(_canonical(v) for v in value))
+    return value
+
+
+def _key(method_name, merged_args, canonical=True):
+    if canonical:
+        return pickle.dumps((method_name, _canonical(merged_args)), protocol=pickle.HIGHEST_PROTOCOL)
+    if isinstance(merged_args, dict):
+        merged_args = tuple(sorted(merged_args.items()))
+    return pickle.dumps((method_name, merged_args), protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
+
+
+def _u64_array(buffer):
+    if sys.byteorder == 'little':
+        return memoryview(buffer).cast('Q')
+    values = array('Q', bytes(buffer))
+    values.byteswap()
+    return values
+
+
+class CassetteMiss(AssertionError):
+    """Raised on replay of a call that was never recorded."""
+
+
+class _RecordingProxy(object):
+    """Forwards attribute access to the recorded object, method calls are recorded."""
+    def __init__(self, cassette, obj):
+        object.__setattr__(self, '_cassette', cassette)
+        object.__setattr__(self, '_obj', obj)
+
+    def __getattr__(self, name):
+        attr = getattr(object.__getattribute__(self, '_obj'), name)
+        if not callable(attr):
+            return attr
+        cassette = object.__getattribute__(self, '_cassette')
+        arg_map = _arg_map(attr)
+        cassette.methods.setdefault(name, arg_map)
+
+        def method(*args, **kwargs):
+            # The real call comes first and recording never fails it
+            try:
+                rv = attr(*args, **kwargs)
+            except Exception as ex:
+                cassette._add(name, args, kwargs, (False, ex))
+                raise
+            cassette._add(name, args, kwargs, (True, rv))
+            return rv
+
+        # Cached on the proxy, later lookups do not reach __getattr__
+        object.__setattr__(self, name, method)
+        return method
+
+    def __setattr__(self, name, value):
+        setattr(object.__getattribute__(self, '_obj'), name, value)
+
+
+class Cassette(object):
+    """Recorder of interactions with a real object.
+
+    Basic usage:
+        cassette = Cassette()
+        db = cassette.wrap(RealDatabase())
+        db.get('a')
+        cassette.save('db.cassette')
+
+        db = Cassette.load('db.cassette') # Mock
+        db.get('a')
+        db.get.once()
+        db.verify()
+
+    Repeated calls with equal arguments replay recorded outcomes in order, the last one repeats.
+    Arguments, return values and exceptions must be picklable, calls that cannot be recorded
+    are listed in unrecorded as (method name, exception) and replay as misses.
+    """
+
+    def __init__(self):
+        self.methods = {}
+        self.records = []
+        self.unrecorded = []
+
+    def wrap(self, obj):
+        """Returns proxy of obj recording its method calls into the cassette."""
+        return _RecordingProxy(self, obj)
+
+    def _add(self, method_name, args, kwargs, outcome):
+        try:
+            merged_args = _recorded_args(self.methods[method_name], args, kwargs)
+            self.records.append((_key(method_name, merged_args), pickle.dumps(outcome, protocol=pickle.HIGHEST_PROTOCOL)))
+        except Exception as ex:
+            self.unrecorded.append((method_name, ex))
+
+    def save(self, path):
+        header = pickle.dumps({'methods': self.methods, 'canonical': True}, protocol=pickle.HIGHEST_PROTOCOL)
+        with open(path, 'wb') as f:
+            f.write(_MAGIC)
+            f.write(struct.pack('<Q', len(header)))
+            f.write(header)
+
+            index = []
+            offset = len(_MAGIC) + 8 + len(header)
+            for key, outcome in self.records:
+                index.append((_hash(key), offset))
+                f.write(_LEN.pack(len(key)))
+                f.write(key)
+                f.write(_LEN.pack(len(outcome)))
+                f.write(outcome)
+                offset += 2 * _LEN.size + len(key) + len(outcome)
+
+            # Sorted by hash, equal hashes stay in recording order
+            index.sort()
+            hashes = array('Q', [h for h, _ in index])
+            offsets = array('Q', [o for _, o in index])
+            if sys.byteorder != 'little':
+                hashes.byteswap()
+                offsets.byteswap()
+            f.write(hashes.tobytes())
+            f.write(offsets.tobytes())
+            f.write(_TRAILER.pack(offset, len(index), _MAGIC))
+
+    @staticmethod
+    def load(path):
+        """Returns Mock replaying cassette at path."""
+        return _Replay(path).mock()
+
+
+class _Replay(object):
+    """Memory-mapped cassette, records are decoded on demand."""
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.mm[:len(_MAGIC)] != _MAGIC:
+            raise ValueError('{} is not a cassette'.format(path))
+        index_offset, n_records, magic = _TRAILER.unpack_from(self.mm, len(self.mm) - _TRAILER.size)
+        if magic != _MAGIC:
+            raise ValueError('{} is truncated'.format(path))
+
+        header_len, = struct.unpack_from('<Q', self.mm, len(_MAGIC))
+        self.header = pickle.loads(self.mm[len(_MAGIC) + 8:len(_MAGIC) + 8 + header_len])
+        view = memoryview(self.mm)
+        self.hashes = _u64_array(view[index_offset:index_offset + 8 * n_records])
+        self.offsets = _u64_array(view[index_offset + 8 * n_records:index_offset + 16 * n_records])
+        self.canonical = self.header.get('canonical', False)
+        self.served = {}
+
+    def _outcomes(self, key):
+        """Offsets of outcomes recorded for key, in recording order."""
+        key_hash = _hash(key)
+        outcomes = []
+        index = bisect.bisect_left(self.hashes, key_hash)
+        while index < len(self.hashes) and self.hashes[index] == key_hash:
+            offset = self.offsets[index]
+            key_len, = _LEN.unpack_from(self.mm, offset)
+            if self.mm[offset + _LEN.size:offset + _LEN.size + key_len] == key:
+                outcomes.append(offset + _LEN.size + key_len)
+            index += 1
+        return outcomes
+
+    def replay(self, method_name, merged_args):
+        key = _key(method_name, merged_args, self.canonical)
+        outcomes = self._outcomes(key)
+        if not outcomes:
+            raise CassetteMiss('{} was not recorded with {}'.format(method_name, merged_args))
+        n_served = self.served.get(key, 0)
+        self.served[key] = n_served + 1
+
+        offset = outcomes[min(n_served, len(outcomes) - 1)]
+        outcome_len, = _LEN.unpack_from(self.mm, offset)
+        ok, value = pickle.loads(self.mm[offset + _LEN.size:offset + _LEN.size + outcome_len])
+        if not ok:
+            raise value.with_traceback(None)
+        return value
+
+    def mock(self):
+        mock = _ReplayMock()
+        for method_name, arg_map in self.header['methods'].items():
+            member = mock.expects(method_name)
+            member.arg_map = arg_map
+            member._returns = lambda merged_args, method_name=method_name: self.replay(method_name, merged_args)
+        return mock
+
+
+class _ReplayMock(Mock):
+    """Mock merging call arguments the way they were recorded, (args, kwargs) when they cannot be merged."""
+    def __call__(self, *args, **kwargs):
+        merged_args = _recorded_args(self.arg_map, args, kwargs)
+        return self._route(merged_args)._respond(merged_args)
+
+
+# Tests
+import os
+import tempfile
+import unittest
+
+
+class _Backend(object):
+    def __init__(self):
+        self.counter = 0
+
+    def get(self, key, default=None):
+        if key == 'missing':
+            raise KeyError(key)
+        return {'key': key, 'default': default}
+
+    def incr(self):
+        self.counter += 1
+        return self.counter
+
+    def put_many(self, *values):
+        return len(values)
+
+    def lookup(self, query):
+        return sorted(query)
+
+
+class CassetteTests(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.cassette')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_record_replay(self):
+        cassette = Cassette()
+        backend = cassette.wrap(_Backend())
+        backend.get('a')
+        backend.get('b', default=5)
+        with self.assertRaises(KeyError):
+            backend.get('missing')
+        for _ in range(3):
+            backend.incr()
+        self.assertEqual(backend.counter, 3)
+        cassette.save(self.path)
+
+        replay = Cassette.load(self.path)
+        self.assertEqual(replay.get(key='a'), {'key': 'a', 'default': None})
+        self.assertEqual(replay.get('b', 5), {'key': 'b', 'default': 5})
+        with self.assertRaises(KeyError):
+            replay.get('missing')
+        with self.assertRaises(CassetteMiss):
+            replay.get('c')
+        self.assertEqual([replay.incr() for _ in range(4)], [1, 2, 3, 3])
+
+        replay.get.called_with('a')
+        replay.incr.at_least(4)
+        self.assertEqual(replay.verify(), True)
+
+    def test_rules_override_replay(self):
+        cassette = Cassette()
+        cassette.wrap(_Backend()).get('a')
+        cassette.save(self.path)
+
+        replay = Cassette.load(self.path)
+        replay.get.on('x').returns('overridden')
+        self.assertEqual(replay.get('x'), 'overridden')
+
+    def test_many_interactions(self):
+        cassette = Cassette()
+        backend = cassette.wrap(_Backend())
+        for i in range(10000):
+            backend.get(i)
+        cassette.save(self.path)
+
+        replay = Cassette.load(self.path)
+        self.assertEqual(replay.get(1234), {'key': 1234, 'default': None})
+        self.assertEqual(replay.get(9999), {'key': 9999, 'default': None})
+
+    def test_wrapping_keeps_calls_working(self):
+        cassette = Cassette()
+        backend = cassette.wrap(_Backend())
+        self.assertEqual(backend.put_many(1, 2, 3), 3)
+        values = cassette.wrap([3, 1, 2])
+        values.sort(reverse=True)
+        self.assertEqual(values.pop(), 1)
+        self.assertEqual(backend.get(lambda: None)['default'], None) # unpicklable argument
+        self.assertEqual([name for name, _ in cassette.unrecorded], ['get'])
+        cassette.save(self.path)
+
+        replay = Cassette.load(self.path)
+        self.assertEqual(replay.put_many(1, 2, 3), 3)
+        with self.assertRaises(CassetteMiss):
+            replay.put_many(1, 2)
+
+    def test_equal_arguments_match(self):
+        cassette = Cassette()
+        backend = cassette.wrap(_Backend())
+        backend.lookup({'a': 1, 'b': {2, 3}})
+        backend.get(1)
+        cassette.save(self.path)
+
+        replay = Cassette.load(self.path)
+        self.assertEqual(replay.lookup({'b': {3, 2}, 'a': 1.0}), ['a', 'b'])
+        self.assertEqual(replay.get(1.0), {'key': 1, 'default': None})
+        with self.assertRaises(CassetteMiss):
+            replay.get(2)
+
+    def test_not_a_cassette(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'x' * 64)
+        with self.assertRaises(ValueError):
+            Cassette.load(self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
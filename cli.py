@@ -1,18 +1,30 @@
+import functools
 import os
 import pty
 import select
 
-try:
-    from once import Once
-except ImportError:
-    Once = lambda fn: fn
-
 
 COMMAND_OUTPUT_TIMEOUT_MS = 60000
 READ_TIMEOUT_MS = 100
 WRITE_TIMEOUT_MS = 1000
 
 
+def _once(fn):
+    """Once from once.py, imported on the first call rather than with cli."""
+    wrapped = []
+
+    @functools.wraps(fn)
+    def wrapper(*args):
+        if not wrapped:
+            try:
+                from once import Once
+            except ImportError:
+                Once = lambda fn: fn
+            wrapped.append(Once(fn))
+        return wrapped[0](*args)
+    return wrapper
+
+
 def _get_pty(*argv):
     try:
         (child_pid, pipe_fd) = pty.fork()
@@ -51,14 +63,14 @@ class Cli(object):
         self._fork(*argv)
         self._set_pollers()
 
-    @Once
+    @_once
     def _fork(self, *argv):
         fd = _get_pty(*argv)
         if fd is None:
             raise RuntimeError('fork did not return fd')
         self.fd = fd
 
-    @Once
+    @_once
     def _set_pollers(self):
         if self.fd is None:
             raise RuntimeError('fd is not yet ready')
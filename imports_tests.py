@@ -0,0 +1,65 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Own import time of a module, without its standard library dependencies (those are checked
+# against _HEAVY instead). Generous for noisy machines, a warm import takes about 1.5 ms
+_BUDGET_US = 5000
+_HEAVY = ('asyncio', 'inspect', 'json', 'logging', 'tracemalloc', 'typesafe', 'once', 'unittest')
+
+
+def _import(module, cache_dir):
+    """(own import time of module in microseconds, heavy modules loaded, stdout) from a fresh interpreter."""
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    command = [sys.executable, '-X', 'pycache_prefix=' + cache_dir]
+    heavy = tuple(m for m in _HEAVY if m != module)
+    code = 'import sys\nimport {}\nprint(",".join(m for m in {!r} if m in sys.modules))'.format(module, heavy)
+    # The first run compiles into the cache
+    subprocess.run(command + ['-c', 'import ' + module], env=env, cwd=_HERE, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    result = subprocess.run(command + ['-X', 'importtime', '-c', code], env=env, cwd=_HERE, check=True,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+    elapsed = None
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == module:
+            elapsed = int(fields[0].split(':')[1])
+    output, _, loaded = result.stdout.rstrip('\n').rpartition('\n')
+    return elapsed, [m for m in loaded.split(',') if m], output
+
+
+class ImportTests(unittest.TestCase):
+    def setUp(self):
+        self.cache = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.cache.cleanup()
+
+    def check(self, module):
+        elapsed, heavy, stdout = _import(module, self.cache.name)
+        self.assertEqual(stdout, '')
+        self.assertEqual(heavy, [])
+        self.assertLess(elapsed, _BUDGET_US)
+
+    def test_profiler(self):
+        self.check('profiler')
+
+    def test_typesafe(self):
+        self.check('typesafe')
+
+    def test_testing(self):
+        self.check('testing')
+
+    def test_cli(self):
+        self.check('cli')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,12 @@
+import array
+import collections
+import bisect
+import inspect
+import math
+import random
 import re
+import threading
+import time
 
 """Yet another mocking library.
 
@@ -24,7 +32,7 @@ def _normalize_args(arg_map, *args, **kwargs):
     elif arg_map is None:
         return args
 
-    all_args_kw = kwargs
+    all_args_kw = dict(kwargs)
     for index, arg in enumerate(args):
         varname = arg_map[index]
         all_args_kw[varname] = arg
@@ -32,6 +40,29 @@ def _normalize_args(arg_map, *args, **kwargs):
     return all_args_kw
 
 
+def _arg_map(fn):
+    """Named positional parameters of fn (without self for bound methods), None if unknown.
+
+    *args, keyword-only parameters and locals are not part of the map.
+    """
+    if inspect.ismethod(fn):
+        code = getattr(fn.__func__, '__code__', None)
+        return list(code.co_varnames[1:code.co_argcount]) if code is not None else None
+    code = getattr(fn, '__code__', None)
+    return list(code.co_varnames[:code.co_argcount]) if code is not None else None
+
+
+def _recorded_args(arg_map, args, kwargs):
+    """_normalize_args that never fails, for calls that go through to a real object.
+
+    Returns (args, kwargs) as passed when they cannot be merged (unknown signature with
+    keyword arguments, positionals beyond the named parameters).
+    """
+    if (arg_map is None and kwargs) or (arg_map is not None and len(args) > len(arg_map)):
+        return args, kwargs
+    return _normalize_args(arg_map, *args, **kwargs)
+
+
 def _args_match(expected, actual):
     """Checks whether merged arguments match.
 
@@ -87,8 +118,100 @@ class Like(object):
         return 'Like object, pattern="{}"'.format(self.pattern)
 
 
+# Call recording
+class CallRecorder(object):
+    """Decides what Expectation keeps of each call.
+
+    Attributes:
+        calls: container of retained normalized arguments
+    """
+    calls = ()
+
+    def record(self, args):
+        raise RuntimeError('abstract recorder called')
+
+    def fresh(self):
+        """Returns an empty recorder with the same settings."""
+        raise RuntimeError('abstract recorder called')
+
+
+class RecordAll(CallRecorder):
+    """Keeps every call (default)."""
+    def __init__(self):
+        self.calls = []
+
+    def record(self, args):
+        self.calls.append(args)
+
+    def fresh(self):
+        return RecordAll()
+
+
+class RecordCount(CallRecorder):
+    """Keeps nothing but the call count (tracked by Expectation)."""
+    def record(self, args):
+        pass
+
+    def fresh(self):
+        return RecordCount()
+
+
+class RecordLast(CallRecorder):
+    """Ring buffer of the last n calls."""
+    def __init__(self, n_calls):
+        self.n_calls = n_calls
+        self.calls = collections.deque(maxlen=n_calls)
+
+    def record(self, args):
+        self.calls.append(args)
+
+    def fresh(self):
+        return RecordLast(self.n_calls)
+
+
+class RecordColumns(CallRecorder):
+    """Columnar recording of selected arguments.
+
+    Each column is an array.array of given typecode (or a list if typecode is None).
+    Arguments missing from a call are recorded as None (list columns) or 0 (array columns).
+
+    Args:
+        columns: dict of argument name (or position if the function is unknown) to typecode
+
+    Usage:
+        mf.record(RecordColumns({'user_id': 'q', 'query': None}))
+        mf.recorder.columns['user_id'] # array('q', [...])
+    """
+    def __init__(self, columns):
+        self.typecodes = dict(columns)
+        self.columns = {key: array.array(typecode) if typecode else []
+                        for key, typecode in self.typecodes.items()}
+
+    def record(self, args):
+        if isinstance(args, dict):
+            for key, column in self.columns.items():
+                column.append(args.get(key, 0 if isinstance(column, array.array) else None))
+        else:
+            for key, column in self.columns.items():
+                column.append(args[key] if key < len(args) else (0 if isinstance(column, array.array) else None))
+
+    def fresh(self):
+        return RecordColumns(self.typecodes)
+
+
 # Expectation Checks
 class ExpectationCheck(object):
+    """Verification rule.
+
+    Checks are fed calls as they arrive (on_call), so that verification
+    does not depend on what the recorder retains.
+    """
+    # Whether on_call needs the arguments (count-only checks let spies skip normalization)
+    needs_args = False
+
+    def on_call(self, args):
+        pass
+
     def __call__(self, expectation):
         raise RuntimeError('abstract expectation called')
 
@@ -98,8 +221,8 @@ class CalledExactly(ExpectationCheck):
         self.n_times = n_times
 
     def __call__(self, expectation):
-        if len(expectation.calls) != self.n_times:
-            raise AssertionError('{} was called {} time(s) but expected exactly {} time(s)'.format(expectation.method_name, len(expectation.calls), self.n_times))
+        if expectation.n_calls != self.n_times:
+            raise AssertionError('{} was called {} time(s) but expected exactly {} time(s)'.format(expectation.method_name, expectation.n_calls, self.n_times))
 
 
 class CalledAtLeast(ExpectationCheck):
@@ -107,21 +230,156 @@ class CalledAtLeast(ExpectationCheck):
         self.n_times = n_times
 
     def __call__(self, expectation):
-        if len(expectation.calls) < self.n_times:
-            raise AssertionError('{} was called {} times but expected at least{}'.format(expectation.method_name, len(expectation.calls), self.n_times))
+        if expectation.n_calls < self.n_times:
+            raise AssertionError('{} was called {} times but expected at least{}'.format(expectation.method_name, expectation.n_calls, self.n_times))
 
 
 class CalledWith(ExpectationCheck):
+    needs_args = True
+
     def __init__(self, args):
         self.args = args
+        self.matched = False
+
+    def on_call(self, args):
+        if not self.matched and _args_match(self.args, args):
+            self.matched = True
 
     def __call__(self, expectation):
-        for call in expectation.calls:
-            if _args_match(self.args, call):
-                return True
+        if self.matched:
+            return True
         raise AssertionError('{} was not called with {}'.format(expectation.method_name, self.args))
 
 
+# Latency profiles
+class Fixed(object):
+    """Constant latency in seconds."""
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def sample(self, rng):
+        return self.seconds
+
+
+class Uniform(object):
+    """Latency uniformly distributed between low and high seconds."""
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+
+    def sample(self, rng):
+        return rng.uniform(self.low, self.high)
+
+
+class LogNormal(object):
+    """Log-normally distributed latency, the usual shape of service response times.
+
+    Args:
+        median: median latency in seconds
+        sigma: standard deviation of the underlying normal distribution (tail heaviness)
+    """
+    def __init__(self, median, sigma):
+        self.median = median
+        self.sigma = sigma
+        self._mu = math.log(median)
+
+    def sample(self, rng):
+        return rng.lognormvariate(self._mu, self.sigma)
+
+
+class Histogram(object):
+    """Empirical latency histogram, e.g. taken from production metrics.
+
+    Args:
+        buckets: list of (upper bound in seconds, weight), sorted by upper bound;
+            latency is uniform within a bucket, first bucket starts at 0
+
+    Usage:
+        mf.delay(Histogram([(0.01, 90), (0.1, 9), (2.0, 1)]))
+    """
+    def __init__(self, buckets):
+        self.bounds = [0.] + [bound for bound, _ in buckets]
+        self.cum_weights = []
+        total = 0
+        for _, weight in buckets:
+            total += weight
+            self.cum_weights.append(total)
+
+    def sample(self, rng):
+        index = bisect.bisect_right(self.cum_weights, rng.random() * self.cum_weights[-1])
+        index = min(index, len(self.cum_weights) - 1)
+        return rng.uniform(self.bounds[index], self.bounds[index + 1])
+
+
+def _payload_size(rv):
+    if isinstance(rv, (bytes, bytearray, str)):
+        return len(rv)
+    if isinstance(rv, memoryview):
+        return rv.nbytes
+    return 0
+
+
+class _Faults(object):
+    """Latency, error rate and bandwidth applied when an expectation responds, None where not set."""
+    _FIELDS = ('latency', 'error_rate', 'error', 'bytes_per_second')
+
+    def __init__(self):
+        self.latency = None
+        self.error_rate = None
+        self.error = None
+        self.bytes_per_second = None
+        self.rng = random.Random()
+        self.seeded = False
+
+    @staticmethod
+    def inherited(chain):
+        """Profile taking each field from the first of chain (rule first, then its parents) setting it.
+
+        Sampling uses the random generator of the first seeded profile, else of the rule's own one.
+        """
+        merged = _Faults()
+        for field in _Faults._FIELDS:
+            setattr(merged, field, next((getattr(faults, field) for faults in chain if getattr(faults, field) is not None), None))
+        merged.rng = next((faults.rng for faults in chain if faults.seeded), chain[0].rng)
+        return merged
+
+    def apply(self, returns, args):
+        """Evaluates returns(args) under the profile.
+
+        Returns (delay in seconds, return value, exception to raise).
+        """
+        delay = self.latency.sample(self.rng) if self.latency is not None else 0.
+        if self.error_rate and self.rng.random() < self.error_rate:
+            return delay, None, self.error.with_traceback(None)
+        try:
+            rv = returns(args)
+        except Exception as ex:
+            return delay, None, ex
+        if self.bytes_per_second:
+            delay += _payload_size(rv) / self.bytes_per_second
+        return delay, rv, None
+
+
+# Calls buffered per thread before being folded into an Expectation (thread-safe mode)
+_SHARD_FLUSH_SIZE = 256
+
+
+async def _async_respond(expectation, merged_args):
+    faults = expectation._fault_profile()
+    if faults is None:
+        rv = expectation._returns(merged_args)
+    else:
+        import asyncio
+        delay, rv, ex = faults.apply(expectation._returns, merged_args)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if ex is not None:
+            raise ex
+    if inspect.isawaitable(rv):
+        rv = await rv
+    return rv
+
+
 # User-facing classes (Expectation and Mock)
 class Expectation(object):
     """Class Expectation. Holds logic and data on how given function should behave.
@@ -129,6 +387,7 @@ class Expectation(object):
     * Keeps track of the number of calls and checks it against expectation (once, never)
     * Wraps functions to allow returning different mocked values for different arguments (on)
     * Allows exception injection on function call with certain arguments
+    * Simulates slow and flaky dependencies (delay, fails, bandwidth)
 
     Should always be used within Mock.
     Basic usage:
@@ -142,34 +401,118 @@ class Expectation(object):
     Args:
         fn: function to be mocked, for arguments deduction
         method_name: self-explanatory, used for debug prints
+        recorder: CallRecorder deciding what is kept of each call (RecordAll by default)
+        threadsafe: buffer calls per thread, calls/n_calls are up to date after merge() or verify()
     """
 
-    def __init__(self, fn=None, method_name=''):
+    def __init__(self, fn=None, method_name='', recorder=None, threadsafe=False):
         self.fn = fn
         self.method_name = method_name
+        self.recorder = recorder if recorder is not None else RecordAll()
 
-        self.arg_map = None
-        if self.fn is not None:
-            self.arg_map = list(self.fn.__code__.co_varnames)
+        self.arg_map = _arg_map(self.fn) if self.fn is not None else None
 
-        self._returns = lambda: None
+        self._returns = lambda args: None
+        self._faults = None
+        self._parent = None
 
-        self.calls = []
+        self.n_calls = 0
+        self.calls = self.recorder.calls
+        self._needs_args = not isinstance(self.recorder, RecordCount)
         self.checks = []
         self.call_expectations = []
 
+        self.threadsafe = threadsafe
+        if threadsafe:
+            self._lock = threading.Lock()
+            self._local = threading.local()
+            self._shards = []
+
     def __call__(self, *args, **kwargs):
         merged_args = _normalize_args(self.arg_map, *args, **kwargs)
-        self.calls.append(merged_args)
-        for expected_call in self.call_expectations:
-            if _args_match(merged_args, expected_call[0]):
-                return expected_call[-1](*args, **kwargs)
+        return self._route(merged_args)._respond(merged_args)
+
+    def _respond(self, merged_args):
+        faults = self._fault_profile()
+        if faults is None:
+            return self._returns(merged_args)
+        delay, rv, ex = faults.apply(self._returns, merged_args)
+        if delay > 0:
+            time.sleep(delay)
+        if ex is not None:
+            raise ex
+        return rv
+
+    def _fault_profile(self):
+        """Fault profile of the expectation, .on rules inherit each unset field from their parents."""
+        chain = []
+        expectation = self
+        while expectation is not None:
+            if expectation._faults is not None:
+                chain.append(expectation._faults)
+            expectation = expectation._parent
+        if not chain:
+            return None
+        return chain[0] if len(chain) == 1 else _Faults.inherited(chain)
+
+    def _route(self, merged_args):
+        """Records the call and returns expectation responding to it (self or an .on rule)."""
+        if self.threadsafe:
+            self._record_shard(merged_args)
+        else:
+            self._record(merged_args)
+        for matcher, expectation in self.call_expectations:
+            if _args_match(merged_args, matcher):
+                return expectation._route(merged_args)
+        return self
 
-        return self._returns()
+    def _record(self, merged_args):
+        self.n_calls += 1
+        self.recorder.record(merged_args)
+        for check in self.checks:
+            check.on_call(merged_args)
+
+    def _record_shard(self, merged_args):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = collections.deque()
+            with self._lock:
+                self._shards.append(shard)
+        shard.append(merged_args)
+        if len(shard) >= _SHARD_FLUSH_SIZE:
+            self.merge()
+
+    def merge(self):
+        """Folds per-thread call buffers into calls and n_calls (thread-safe mode only)."""
+        if not self.threadsafe:
+            return self
+        with self._lock:
+            for shard in self._shards:
+                # deque.popleft is atomic, owning threads may keep appending meanwhile
+                while shard:
+                    self._record(shard.popleft())
+        for _, expectation in self.call_expectations:
+            expectation.merge()
+        return self
 
     def restore(self):
         """Reset all expectations."""
-        self.__init__(self.method_name, self.fn)
+        self.__init__(method_name=self.method_name, fn=self.fn, recorder=self.recorder.fresh(), threadsafe=self.threadsafe)
+        return self
+
+    def record(self, recorder):
+        """Changes what is kept of each call (also for .on rules).
+
+        Usage:
+            mf.record(RecordCount())
+            mf.record(RecordLast(100))
+            mf.record(RecordColumns({'arg': 'q'}))
+        """
+        self.recorder = recorder
+        self.calls = recorder.calls
+        self._needs_args = not isinstance(recorder, RecordCount) or any(check.needs_args for check in self.checks)
+        for _, expectation in self.call_expectations:
+            expectation.record(recorder.fresh())
         return self
 
     def on(self, *args, **kwargs):
@@ -192,30 +535,47 @@ class Expectation(object):
         Returns expectation.
         """
         call_matcher = _normalize_args(self.arg_map, *args, **kwargs)
-        self.call_expectations.append((call_matcher, Expectation(method_name=self.method_name, fn=self.fn)))
-        return self.call_expectations[-1][-1]
+        expectation = Expectation(method_name=self.method_name, fn=self.fn, recorder=self.recorder.fresh(), threadsafe=self.threadsafe)
+        expectation._parent = self
+        self.call_expectations.append((call_matcher, expectation))
+        return expectation
+
+    def _add_check(self, check):
+        # Calls made before the check was added are only seen as far as the recorder kept them
+        for call in self.calls:
+            check.on_call(call)
+        self.checks.append(check)
+        self._needs_args = self._needs_args or check.needs_args
 
     def never(self):
         """Verification fails with assertion error if never called."""
-        self.checks.append(CalledExactly(0))
+        self._add_check(CalledExactly(0))
         return self
 
     def once(self):
         """Throws assertion error if called more than once."""
-        self.checks.append(CalledExactly(1))
+        self._add_check(CalledExactly(1))
         return self
 
     def at_least(self, n_times):
-        self.checks.append(CalledAtLeast(n_times))
+        self._add_check(CalledAtLeast(n_times))
         return self
 
     def called_with(self, *args, **kwargs):
         merged_args = _normalize_args(self.arg_map, *args, **kwargs)
-        self.checks.append(CalledWith(merged_args))
+        self._add_check(CalledWith(merged_args))
 
     def returns(self, rv):
-        """Makes given expectation return rv."""
-        self._returns = lambda: rv
+        """Makes given expectation return rv.
+
+        Coroutine objects can only be awaited once and are rejected with TypeError,
+        use calls_fake with an async def to respond with a fresh one to every call.
+        """
+        if inspect.iscoroutine(rv):
+            rv.close()
+            raise TypeError('{} cannot return a coroutine object on every call, use calls_fake with an async def'.format(
+                self.method_name or 'mock'))
+        self._returns = lambda args: rv
         return self
 
     def raises(self, ex):
@@ -227,11 +587,73 @@ class Expectation(object):
         Usage:
             mf.raises(ValueError(5))
         """
-        self._returns = lambda: _raise(ex)
+        self._returns = lambda args: _raise(ex)
+        return self
+
+    def calls_fake(self, fn):
+        """Makes given expectation respond with fn called with the call's arguments.
+
+        Usage:
+            mf.calls_fake(lambda a, b: a + b)
+        """
+        self._returns = lambda args: fn(**args) if isinstance(args, dict) else fn(*args)
+        return self
+
+    def _faults_for_update(self, seed):
+        if self._faults is None:
+            self._faults = _Faults()
+        if seed is not None:
+            self._faults.rng = random.Random(seed)
+            self._faults.seeded = True
+        return self._faults
+
+    def delay(self, latency, seed=None):
+        """Delays responses (sleeps, or awaits in AsyncMock) by sampled latency.
+
+        .on rules inherit the delay, error rate and bandwidth of their parents separately,
+        each unless they set it themselves.
+
+        Arguments:
+            latency: seconds, or a latency profile (Fixed, Uniform, LogNormal, Histogram)
+            seed: seed for reproducible sampling
+
+        Usage:
+            mf.delay(0.05)
+            mf.delay(LogNormal(median=0.02, sigma=0.8), seed=42)
+        """
+        if isinstance(latency, (int, float)):
+            latency = Fixed(latency)
+        self._faults_for_update(seed).latency = latency
+        return self
+
+    def fails(self, rate, error=ConnectionError, seed=None):
+        """Raises error on a random fraction of calls.
+
+        Arguments:
+            rate: probability of failure in [0, 1]
+            error: exception class or object
+            seed: seed for reproducible injection
+
+        .on rules inherit it unless they set a rate of their own (fails(0) turns it off).
+
+        Usage:
+            mf.fails(0.01, TimeoutError('injected timeout'))
+        """
+        if isinstance(error, type):
+            error = error('injected fault')
+        faults = self._faults_for_update(seed)
+        faults.error_rate = rate
+        faults.error = error
+        return self
+
+    def bandwidth(self, bytes_per_second):
+        """Adds transfer time of returned bytes/str payloads to the delay, .on rules inherit it."""
+        self._faults_for_update(None).bytes_per_second = bytes_per_second
         return self
 
     def verify(self):
         """Verifies expectations."""
+        self.merge()
         for check in self.checks:
             check(self)
         return True
@@ -249,10 +671,12 @@ class Mock(Expectation):
     Args:
         fn: function to be mocked, for arguments deduction
         method_name: self-explanatory, used for debug prints
+        recorder: CallRecorder used by the mock and its members
+        threadsafe: thread-safe mode for the mock and its members
     """
 
-    def __init__(self, method_name='', fn=None):
-        Expectation.__init__(self, method_name=method_name, fn=fn)
+    def __init__(self, method_name='', fn=None, recorder=None, threadsafe=False):
+        Expectation.__init__(self, method_name=method_name, fn=fn, recorder=recorder, threadsafe=threadsafe)
         self.member_mocks = []
 
     def restore(self):
@@ -263,9 +687,13 @@ class Mock(Expectation):
         return self
 
     def expects(self, method_name='', fn=None):
-        """Creates new member mock and returns it."""
+        """Creates new member mock and returns it.
+
+        Members of coroutine functions (async def) are AsyncMocks.
+        """
+        member_type = AsyncMock if inspect.iscoroutinefunction(fn) else type(self)
         self.member_mocks.append(method_name)
-        setattr(self, method_name, Mock(method_name=method_name, fn=fn))
+        setattr(self, method_name, member_type(method_name=method_name, fn=fn, recorder=self.recorder.fresh(), threadsafe=self.threadsafe))
         return getattr(self, method_name)
 
     def verify(self):
@@ -275,6 +703,319 @@ class Mock(Expectation):
         return Expectation.verify(self)
 
 
+class AsyncMock(Mock):
+    """Mock of coroutine functions.
+
+    Calls are recorded immediately, returned (or raised) values are delivered on await.
+    Awaitables passed to .returns (futures) and returned by .calls_fake (async def fakes)
+    are awaited as well.
+
+    Basic usage:
+        m = AsyncMock()
+        fetch = m.expects('fetch', lambda url: None)
+        fetch.on('a').returns(5)
+        assert await m.fetch('a') == 5
+        m.verify()
+    """
+
+    def __call__(self, *args, **kwargs):
+        merged_args = _normalize_args(self.arg_map, *args, **kwargs)
+        return _async_respond(self._route(merged_args), merged_args)
+
+
+# Spies
+def _spy_call(expectation, real, args, kwargs):
+    """Slow path of spied calls: .on rules, fault profiles or thread-safe recording."""
+    merged_args = _recorded_args(expectation.arg_map, args, kwargs)
+    responder = expectation._route(merged_args)
+    if responder is not expectation:
+        # .on rules stub the real method
+        return responder._respond(merged_args)
+    faults = expectation._fault_profile()
+    if faults is None:
+        return real(*args, **kwargs)
+    delay, rv, ex = faults.apply(lambda _: real(*args, **kwargs), merged_args)
+    if delay > 0:
+        time.sleep(delay)
+    if ex is not None:
+        raise ex
+    return rv
+
+
+# Forwarding methods are generated per spied class, so that calls go through
+# plain attribute lookups instead of __getattr__ and Expectation.__call__.
+_SPY_INSTANCE_METHOD = """
+def {name}(self, *args, **kwargs):
+    expectation = self._spy.{name}
+    if expectation.call_expectations or expectation._faults is not None or expectation.threadsafe:
+        return _spy_call(expectation, self._spy_target.{name}, args, kwargs)
+    if expectation._needs_args:
+        expectation._record(_recorded_args(expectation.arg_map, args, kwargs))
+    else:
+        expectation.n_calls += 1
+    return self._spy_target.{name}(*args, **kwargs)
+"""
+
+_SPY_CLASS_METHOD = """
+def {name}(self, *args, **kwargs):
+    expectation = _spy.{name}
+    if expectation.call_expectations or expectation._faults is not None or expectation.threadsafe:
+        return _spy_call(expectation, lambda *args, **kwargs: _base_{name}(self, *args, **kwargs), args, kwargs)
+    if expectation._needs_args:
+        expectation._record(_recorded_args(expectation.arg_map, args, kwargs))
+    else:
+        expectation.n_calls += 1
+    return _base_{name}(self, *args, **kwargs)
+"""
+
+_spy_instance_classes = {}
+# Instance attributes of a Spy (target, proxy, calls, checks, ...), set on first use
+_spy_attributes = None
+
+
+def _spied_methods(cl):
+    """Names of methods that can be spied on instances of cl.
+
+    Names of Spy members and instance attributes are left out, they are forwarded unrecorded.
+    """
+    global _spy_attributes
+    if _spy_attributes is None:
+        _spy_attributes = frozenset(vars(Mock(threadsafe=True))) | {'target', 'proxy'}
+    names = []
+    for name in dir(cl):
+        if name.startswith('__') or hasattr(Spy, name) or name in _spy_attributes or not name.isidentifier():
+            continue
+        if callable(inspect.getattr_static(cl, name)):
+            names.append(name)
+    return names
+
+
+def _spy_instance_class(cl):
+    """Proxy class forwarding spied methods of cl instances, generated once per class."""
+    if cl in _spy_instance_classes:
+        return _spy_instance_classes[cl]
+
+    namespace = {'_spy_call': _spy_call, '_recorded_args': _recorded_args}
+    for name in _spied_methods(cl):
+        exec(_SPY_INSTANCE_METHOD.format(name=name), namespace)
+
+    def __getattr__(self, name):
+        return getattr(self._spy_target, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._spy_target, name, value)
+
+    members = {name: fn for name, fn in namespace.items() if name in _spied_methods(cl)}
+    members.update(__slots__=('_spy', '_spy_target'), __getattr__=__getattr__, __setattr__=__setattr__)
+    proxy_class = type('Spied' + cl.__name__, (object,), members)
+    _spy_instance_classes[cl] = proxy_class
+    return proxy_class
+
+
+def _spy_class(spy, cl):
+    """Subclass of cl whose methods record into spy (fresh for every spy)."""
+    namespace = {'_spy_call': _spy_call, '_recorded_args': _recorded_args, '_spy': spy}
+    names = [name for name in _spied_methods(cl)
+             if not isinstance(inspect.getattr_static(cl, name), (staticmethod, classmethod))]
+    for name in names:
+        namespace['_base_' + name] = getattr(cl, name)
+        exec(_SPY_CLASS_METHOD.format(name=name), namespace)
+
+    members = {name: namespace[name] for name in names}
+    proxy_class = type(cl.__name__, (cl,), members)
+    proxy_class.__qualname__ = cl.__qualname__
+    proxy_class.__module__ = cl.__module__
+    return proxy_class, names
+
+
+class Spy(Mock):
+    """Records calls on a real object while still executing them.
+
+    Spied methods are members of the spy and support the usual Expectation API
+    (checks, recording modes, .on rules that stub the real method, delays).
+    Calls go through proxy: a forwarding object for instances, a subclass for classes.
+
+    Basic usage:
+        spy = Spy(cache)
+        spy.proxy.get('a')        # calls cache.get('a')
+        spy.get.called_with('a')
+        spy.verify()
+
+        spy = Spy(Cache)
+        spy.proxy().get('a')      # instances of the spied class record into spy
+        spy.get.once()
+        spy.verify()
+
+    Members named like Mock members or attributes (verify, on, calls, proxy, ...) are
+    forwarded but not recorded.
+    Count-only spies (RecordCount recorder, no called_with) skip argument normalization.
+    Calls whose arguments cannot be merged by name (positionals taken by *args, keywords to
+    builtin methods) are recorded as (args, kwargs), the real call is never affected.
+
+    Args:
+        target: instance or class to spy on
+        recorder: CallRecorder used by members
+        threadsafe: thread-safe recording
+    """
+
+    def __init__(self, target, recorder=None, threadsafe=False):
+        Mock.__init__(self, method_name=getattr(target, '__name__', type(target).__name__), recorder=recorder, threadsafe=threadsafe)
+        self.target = target
+        if isinstance(target, type):
+            self.proxy, names = _spy_class(self, target)
+            for name in names:
+                # Unbound: the map starts with self, builtin methods have no map
+                arg_map = _arg_map(getattr(target, name))
+                self.expects(name).arg_map = arg_map[1:] if arg_map is not None else None
+        else:
+            self.proxy = _spy_instance_class(type(target)).__new__(_spy_instance_class(type(target)))
+            object.__setattr__(self.proxy, '_spy', self)
+            object.__setattr__(self.proxy, '_spy_target', target)
+            for name in _spied_methods(type(target)):
+                self.expects(name, getattr(target, name))
+
+    def expects(self, method_name='', fn=None):
+        """Creates member mock of a spied method (members are plain Mocks)."""
+        self.member_mocks.append(method_name)
+        setattr(self, method_name, Mock(method_name=method_name, fn=fn, recorder=self.recorder.fresh(), threadsafe=self.threadsafe))
+        return getattr(self, method_name)
+
+    def restore(self):
+        """Resets expectations of all spied members."""
+        for method_name in self.member_mocks:
+            member = getattr(self, method_name)
+            # Members of class spies get their map (without self) from __init__, not from fn
+            arg_map = member.arg_map
+            member.restore()
+            member.arg_map = arg_map
+        return self
+
+
+# Virtual time
+def _virtual_event_loop_policy(clock):
+    """Event loop policy creating loops that run on clock.
+
+    The loop selector polls real I/O without blocking and, when nothing is ready,
+    advances the clock to the next scheduled timer instead of waiting for it.
+    While sockets other than the loop's own wakeup pipe are registered, it waits
+    for them up to the next timer in real time first, so that I/O guarded by a
+    timeout is not timed out before it had a chance to complete.
+    """
+    import asyncio
+    import selectors
+
+    class VirtualSelector(selectors.DefaultSelector):
+        # File descriptors of the loop itself (self-pipe), not waited on in real time
+        internal = frozenset()
+
+        def _waits_on_io(self):
+            return any(fd not in self.internal for fd in self.get_map())
+
+        def select(self, timeout=None):
+            events = super().select(0)
+            if events or (timeout is not None and timeout <= 0):
+                return events
+            if timeout is None:
+                return super().select(None)
+            if self._waits_on_io():
+                events = super().select(timeout)
+                if events:
+                    return events
+            clock.advance(timeout)
+            return []
+
+    class VirtualEventLoop(asyncio.SelectorEventLoop):
+        def __init__(self):
+            selector = VirtualSelector()
+            asyncio.SelectorEventLoop.__init__(self, selector=selector)
+            selector.internal = frozenset(selector.get_map())
+
+        def time(self):
+            return clock.monotonic()
+
+    class VirtualEventLoopPolicy(asyncio.DefaultEventLoopPolicy):
+        def new_event_loop(self):
+            return VirtualEventLoop()
+
+    return VirtualEventLoopPolicy()
+
+
+class VirtualClock(object):
+    """Virtual time for tests.
+
+    Within the block time.sleep returns immediately after advancing the clock, and
+    time.time, time.monotonic, time.perf_counter (and their _ns variants) read it.
+    Event loops created within the block (asyncio.run included) use the clock as well,
+    asyncio.sleep and timeouts complete instantly. While a loop waits on sockets
+    (e.g. a client of MockServer), its timers run in real time instead.
+
+    Sleeps from several threads advance the same clock one after another.
+
+    Basic usage:
+        with VirtualClock() as clock:
+            time.sleep(3600)            # returns immediately
+            assert clock.monotonic() == 3600
+            asyncio.run(asyncio.sleep(60))
+
+    Args:
+        start: initial value of time.time(), current time by default
+    """
+
+    def __init__(self, start=None):
+        self._epoch_ns = time.time_ns() if start is None else int(start * 1e9)
+        self._now_ns = 0
+        self._lock = threading.Lock()
+        self._patched = None
+        self._policy = None
+
+    def advance(self, seconds):
+        """Moves the clock forward."""
+        with self._lock:
+            self._now_ns += int(seconds * 1e9)
+
+    def sleep(self, seconds):
+        if seconds < 0:
+            raise ValueError('sleep length must be non-negative')
+        self.advance(seconds)
+
+    def monotonic_ns(self):
+        return self._now_ns
+
+    def monotonic(self):
+        return self._now_ns / 1e9
+
+    def time_ns(self):
+        return self._epoch_ns + self._now_ns
+
+    def time(self):
+        return (self._epoch_ns + self._now_ns) / 1e9
+
+    def __enter__(self):
+        import asyncio
+
+        replacements = {
+            'sleep': self.sleep,
+            'time': self.time, 'time_ns': self.time_ns,
+            'monotonic': self.monotonic, 'monotonic_ns': self.monotonic_ns,
+            'perf_counter': self.monotonic, 'perf_counter_ns': self.monotonic_ns,
+        }
+        self._patched = {name: getattr(time, name) for name in replacements}
+        for name, fn in replacements.items():
+            setattr(time, name, fn)
+
+        self._policy = asyncio.get_event_loop_policy()
+        asyncio.set_event_loop_policy(_virtual_event_loop_policy(self))
+        return self
+
+    def __exit__(self, *exc_info):
+        import asyncio
+
+        for name, fn in self._patched.items():
+            setattr(time, name, fn)
+        asyncio.set_event_loop_policy(self._policy)
+        self._patched = None
+
+
 # Tests
 import unittest
 
@@ -474,7 +1215,396 @@ class MockTests(unittest.TestCase):
         with self.assertRaises(AssertionError):
             mf.verify()
 
+class MockRecordingTests(unittest.TestCase):
+    def test_record_count(self):
+        def f(a): pass
+        m = Mock(fn=f, recorder=RecordCount())
+        m.at_least(2).called_with(5)
+        m.on(6).returns(1)
+
+        m(5)
+        self.assertEqual(m(6), 1)
+        self.assertEqual(m.n_calls, 2)
+        self.assertEqual(len(m.calls), 0)
+        self.assertEqual(m.verify(), True)
+
+    def test_record_last(self):
+        def f(a): pass
+        m = Mock(fn=f).record(RecordLast(2))
+        m.called_with(1)
+        m.once()
+        for i in range(3):
+            m(i)
+
+        self.assertEqual(list(m.calls), [{'a': 1}, {'a': 2}])
+        with self.assertRaisesRegex(AssertionError, 'called 3 time'):
+            m.verify()
+
+    def test_record_columns(self):
+        def f(a, b): pass
+        m = Mock(fn=f).record(RecordColumns({'a': 'q', 'b': None}))
+        m(1, 'x')
+        m(2, b='y')
+        m(b='z')
+
+        self.assertEqual(m.recorder.columns['a'].tolist(), [1, 2, 0])
+        self.assertEqual(m.recorder.columns['b'], ['x', 'y', 'z'])
+
+    def test_record_columns_positional(self):
+        m = Mock().record(RecordColumns({1: 'd'}))
+        m(1, 2.5)
+        m(1)
+        self.assertEqual(m.recorder.columns[1].tolist(), [2.5, 0.])
+
+    def test_check_added_late(self):
+        def f(a): pass
+        m = Mock(fn=f)
+        m(5)
+        m.called_with(5)
+        self.assertEqual(m.verify(), True)
+
+    def test_members_inherit_recorder(self):
+        m = Mock(recorder=RecordLast(1))
+        mf = m.expects('mf')
+        sub = mf.on(5)
+        self.assertIsInstance(mf.recorder, RecordLast)
+        self.assertIsInstance(sub.recorder, RecordLast)
+        self.assertIsNot(mf.recorder, m.recorder)
+
+        m.restore()
+        self.assertIsInstance(m.recorder, RecordLast)
+
+
+class MockConcurrencyTests(unittest.TestCase):
+    def test_threadsafe(self):
+        def f(a): pass
+        m = Mock(threadsafe=True)
+        mf = m.expects('mf', f)
+        mf.on(1).returns('one')
+        mf.called_with(1)
+        mf.at_least(4000)
+
+        def worker():
+            for i in range(1000):
+                self.assertEqual(mf(i % 2), 'one' if i % 2 else None)
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+
+        self.assertEqual(m.verify(), True)
+        self.assertEqual(mf.n_calls, 4000)
+        self.assertEqual(len(mf.calls), 4000)
+        self.assertEqual(mf.call_expectations[0][1].n_calls, 2000)
+
+    def test_async_mock(self):
+        import asyncio
+
+        async def fetch(url): pass
+        m = Mock()
+        mf = m.expects('fetch', fetch)
+        mf.on('a').returns(5)
+        mf.on('b').raises(ValueError('b'))
+        async def fake(url):
+            return await asyncio.sleep(0, result=7)
+        mf.on('c').calls_fake(fake)
+        with self.assertRaises(TypeError):
+            mf.on('e').returns(asyncio.sleep(0))
+        mf.called_with('a')
+        self.assertIsInstance(mf, AsyncMock)
+
+        async def run():
+            self.assertEqual(await m.fetch('a'), 5)
+            self.assertEqual(await m.fetch('c'), 7)
+            self.assertEqual(await m.fetch('c'), 7)
+            self.assertEqual(await m.fetch('d'), None)
+            with self.assertRaises(ValueError):
+                await m.fetch('b')
+
+        asyncio.run(run())
+        self.assertEqual(mf.n_calls, 5)
+        self.assertEqual(m.verify(), True)
+
+
+class MockFaultsTests(unittest.TestCase):
+    def test_latency_profiles(self):
+        for profile in (Fixed(0.5), Uniform(0.1, 0.2), LogNormal(0.02, 0.5), Histogram([(0.01, 9), (0.1, 1)])):
+            samples = [profile.sample(random.Random(7)) for _ in range(2)]
+            self.assertEqual(samples[0], samples[1])
+
+        self.assertTrue(0.1 <= Uniform(0.1, 0.2).sample(random.Random()) <= 0.2)
+        rng = random.Random(1)
+        samples = [Histogram([(0.01, 9), (0.1, 1)]).sample(rng) for _ in range(1000)]
+        self.assertTrue(all(0 <= s <= 0.1 for s in samples))
+        self.assertTrue(800 < len([s for s in samples if s <= 0.01]) < 980)
+
+    def test_delay(self):
+        m = Mock()
+        m.delay(0.02).returns(5)
+        m.on(1).returns(6)
+        m.on(2).delay(0).returns(7)
+
+        ts = time.perf_counter()
+        self.assertEqual(m(), 5)
+        self.assertEqual(m(1), 6)
+        self.assertGreaterEqual(time.perf_counter() - ts, 0.04)
+
+        ts = time.perf_counter()
+        self.assertEqual(m(2), 7)
+        self.assertLess(time.perf_counter() - ts, 0.02)
+
+    def test_fails(self):
+        def failures(seed):
+            m = Mock().fails(0.3, TimeoutError('injected'), seed=seed).returns(1)
+            result = []
+            for _ in range(100):
+                try:
+                    result.append(m())
+                except TimeoutError:
+                    result.append(None)
+            return result
+
+        self.assertEqual(failures(3), failures(3))
+        self.assertTrue(10 < failures(3).count(None) < 50)
+
+        with self.assertRaises(ConnectionError):
+            Mock().fails(1.)()
+
+    def test_inherited_fields(self):
+        m = Mock().returns(b'x' * 1000)
+        m.fails(1.).bandwidth(50000)
+        m.on(1).delay(0.01)
+        m.on(2).fails(0).returns(b'x' * 1000)
+        with self.assertRaises(ConnectionError):
+            m(1)
+        ts = time.perf_counter()
+        m(2)
+        self.assertGreaterEqual(time.perf_counter() - ts, 0.02)
+
+    def test_bandwidth(self):
+        m = Mock().returns(b'x' * 1000).bandwidth(50000)
+        ts = time.perf_counter()
+        m()
+        self.assertGreaterEqual(time.perf_counter() - ts, 0.02)
+
+    def test_async_delay(self):
+        import asyncio
+
+        async def fetch(): pass
+        m = Mock()
+        m.expects('fetch', fetch).delay(0.02).returns(5)
+
+        async def run():
+            ts = time.perf_counter()
+            results = await asyncio.gather(*[m.fetch() for _ in range(10)])
+            return results, time.perf_counter() - ts
+
+        results, elapsed = asyncio.run(run())
+        self.assertEqual(results, [5] * 10)
+        self.assertTrue(0.02 <= elapsed < 0.15)
+
+
+class SpyTests(unittest.TestCase):
+    class Cache(object):
+        def __init__(self):
+            self.data = {'a': 1}
+
+        def get(self, key, default=None):
+            return self.data.get(key, default)
+
+        def put(self, key, value):
+            self.data[key] = value
+
+        @staticmethod
+        def version():
+            return 2
+
+    def test_instance(self):
+        cache = SpyTests.Cache()
+        spy = Spy(cache)
+        spy.get.called_with('a')
+        spy.put.once()
+
+        self.assertEqual(spy.proxy.get('a'), 1)
+        self.assertEqual(spy.proxy.get('b', default=3), 3)
+        spy.proxy.put('b', 2)
+        self.assertEqual(spy.proxy.data, {'a': 1, 'b': 2})
+        self.assertEqual(spy.proxy.version(), 2)
+
+        self.assertEqual(spy.get.calls, [{'key': 'a'}, {'key': 'b', 'default': 3}])
+        self.assertEqual(spy.verify(), True)
+
+        spy.proxy.put('c', 3)
+        with self.assertRaises(AssertionError):
+            spy.verify()
+        spy.restore()
+        self.assertEqual(spy.put.n_calls, 0)
+
+    def test_class(self):
+        spy = Spy(SpyTests.Cache)
+        spy.get.at_least(2)
+        first, second = spy.proxy(), spy.proxy()
+        self.assertIsInstance(first, SpyTests.Cache)
+        self.assertEqual(first.get('a'), 1)
+        self.assertEqual(second.get(key='x', default=0), 0)
+        self.assertEqual(spy.get.calls, [{'key': 'a'}, {'key': 'x', 'default': 0}])
+        self.assertEqual(spy.verify(), True)
+
+    def test_rules_stub(self):
+        spy = Spy(SpyTests.Cache())
+        spy.get.on('a').returns('stubbed')
+        self.assertEqual(spy.proxy.get('a'), 'stubbed')
+        self.assertEqual(spy.proxy.get('z', 5), 5)
+        self.assertEqual(spy.get.n_calls, 2)
+
+    def test_count_only(self):
+        spy = Spy(SpyTests.Cache(), recorder=RecordCount())
+        spy.get.once()
+        spy.proxy.get('a')
+        self.assertEqual(spy.get.n_calls, 1)
+        self.assertEqual(spy.verify(), True)
+
+    def test_proxy_class_shared(self):
+        self.assertIs(type(Spy(SpyTests.Cache()).proxy), type(Spy(SpyTests.Cache()).proxy))
+
+    def test_varargs(self):
+        class Store(object):
+            def put_many(self, first, *rest, **options):
+                total = first + sum(rest)
+                return total
+
+        spy = Spy(Store())
+        self.assertEqual(spy.proxy.put_many(1), 1)
+        self.assertEqual(spy.proxy.put_many(1, 2, 3), 6)
+        self.assertEqual(spy.proxy.put_many(first=4, sync=True), 4)
+        self.assertEqual(spy.put_many.calls, [{'first': 1}, ((1, 2, 3), {}), {'first': 4, 'sync': True}])
+
+        spy = Spy(Store)
+        self.assertEqual(spy.proxy().put_many(1, 2), 3)
+        self.assertEqual(spy.put_many.calls, [((1, 2), {})])
+
+    def test_builtin_subclass(self):
+        class Registry(dict):
+            pass
+
+        spy = Spy(Registry)
+        registry = spy.proxy(a=1)
+        self.assertEqual(registry.get('a'), 1)
+        self.assertEqual(registry.get('b', 2), 2)
+        registry.update(b=3)
+        self.assertEqual(registry, {'a': 1, 'b': 3})
+        self.assertEqual(spy.get.calls, [('a',), ('b', 2)])
+        self.assertEqual(spy.update.calls, [((), {'b': 3})])
+
+        spy = Spy(Registry(a=1))
+        self.assertEqual(spy.proxy.get('a'), 1)
+        spy.proxy.update(c=4)
+        self.assertEqual(spy.update.calls, [((), {'c': 4})])
+
+    def test_class_restore(self):
+        spy = Spy(SpyTests.Cache)
+        spy.proxy().get('a')
+        spy.restore()
+        spy.get.called_with(key='b')
+        spy.proxy().get('b')
+        self.assertEqual(spy.get.calls, [{'key': 'b'}])
+        self.assertEqual(spy.verify(), True)
+
+    def test_attribute_names(self):
+        class Pipeline(object):
+            def proxy(self):
+                return 'proxy'
+
+            def checks(self):
+                return ['check']
+
+            def run(self):
+                return self.checks()
+
+        for target in (Pipeline(), Pipeline):
+            spy = Spy(target)
+            proxy = spy.proxy() if target is Pipeline else spy.proxy
+            self.assertEqual(proxy.run(), ['check'])
+            self.assertEqual(proxy.proxy(), 'proxy')
+            self.assertEqual(spy.run.n_calls, 1)
+            self.assertEqual(spy.checks, [])
+            self.assertEqual(spy.verify(), True)
+
+
+class VirtualClockTests(unittest.TestCase):
+    def test_sleep(self):
+        real_start = time.perf_counter()
+        with VirtualClock(start=1000.) as clock:
+            start = time.monotonic()
+            time.sleep(3600)
+            self.assertEqual(time.monotonic() - start, 3600)
+            self.assertEqual(time.perf_counter_ns(), 3600 * 10**9)
+            self.assertEqual(time.time(), 4600.)
+            clock.advance(0.5)
+            self.assertEqual(clock.monotonic(), 3600.5)
+        self.assertLess(time.perf_counter() - real_start, 1)
+        self.assertGreater(time.time(), 1e9)
+
+    def test_asyncio(self):
+        import asyncio
+
+        async def run():
+            start = asyncio.get_running_loop().time()
+            await asyncio.gather(asyncio.sleep(60), asyncio.sleep(120))
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(asyncio.sleep(3600), 10)
+            return asyncio.get_running_loop().time() - start
+
+        real_start = time.perf_counter()
+        with VirtualClock():
+            self.assertAlmostEqual(asyncio.run(run()), 130, places=3)
+        self.assertLess(time.perf_counter() - real_start, 1)
+
+    def test_asyncio_socket_timeout(self):
+        import asyncio
+        import socket
+
+        ours, theirs = socket.socketpair()
+        async def run():
+            reader, writer = await asyncio.open_connection(sock=ours)
+            # The peer answers after 50ms of real time, well within the virtual timeout
+            threading.Timer(0.05, theirs.sendall, [b'x']).start()
+            data = await asyncio.wait_for(reader.read(1), 5)
+            writer.close()
+            return data
+
+        try:
+            with VirtualClock():
+                self.assertEqual(asyncio.run(run()), b'x')
+        finally:
+            theirs.close()
+
+    def test_delay_on_virtual_clock(self):
+        m = Mock().delay(LogNormal(median=5, sigma=1), seed=1).returns(1)
+        with VirtualClock() as clock:
+            for _ in range(100):
+                m()
+            self.assertGreater(clock.monotonic(), 100)
+
+
 class MockBasicUsageTests(unittest.TestCase):
+    def test_calls_fake(self):
+        def f(a, b): pass
+        m = Mock(fn=f).calls_fake(lambda a, b: a + b)
+        m.on(1, 1).returns(0)
+        self.assertEqual(m(2, b=3), 5)
+        self.assertEqual(m(1, 1), 0)
+
+        m = Mock().calls_fake(lambda *args: len(args))
+        self.assertEqual(m(1, 2, 3), 3)
+
+    def test_bound_method(self):
+        class C(object):
+            def mf(self, a, b=None): pass
+        m = Mock(fn=C().mf)
+        m(1, b=2)
+        self.assertEqual(m.calls, [{'a': 1, 'b': 2}])
+
     def test_basic_usage(self):
         db_mock = Mock()
         sql_exec_fn = db_mock.expects('exec_sql')
@@ -0,0 +1,368 @@
+import asyncio
+import inspect
+import json
+import threading
+
+from mock import _normalize_args
+
+"""Mock as a local network stand-in service.
+
+Exposes a Mock over a localhost socket, so out-of-process clients can be load-tested
+without the real dependency. Requests are matched against the mock's .on rules and
+recorded for verify(), delay/fails/bandwidth profiles are applied without blocking the loop.
+
+Protocols:
+    json: newline-delimited JSON over TCP
+        request  {"method": "get", "args": [1], "kwargs": {"b": 2}}
+        response {"result": ...} or {"error": {"type": "ValueError", "message": "..."}}
+    http: minimal HTTP/1.1 with keep-alive
+        POST /get with body {"args": [1], "kwargs": {"b": 2}} (GET / empty body for no arguments)
+        200 with {"result": ...} or 500 with {"error": ...}
+
+Method "" (path "/") calls the mock itself, otherwise member mocks created with .expects.
+"""
+
+
+def _error_payload(ex):
+    return {'error': {'type': type(ex).__name__, 'message': str(ex)}}
+
+
+def _request_object(body):
+    """Decoded JSON request, ValueError (as for malformed JSON) unless it is an object."""
+    request = json.loads(body)
+    if not isinstance(request, dict):
+        raise ValueError('request must be a JSON object, got {}'.format(type(request).__name__))
+    return request
+
+
+class _JsonLines(object):
+    """Newline-delimited JSON codec."""
+    def parse(self, buffer):
+        """Consumes complete requests from buffer, yields (method, args, kwargs, keep_alive)."""
+        start = 0
+        while True:
+            end = buffer.find(b'\n', start)
+            if end < 0: break
+            line = bytes(buffer[start:end])
+            start = end + 1
+            if not line.strip(): continue
+            request = _request_object(line)
+            yield request.get('method', ''), request.get('args', ()), request.get('kwargs', {}), True
+        del buffer[:start]
+
+    def encode(self, payload, ok):
+        return json.dumps(payload).encode() + b'\n'
+
+
+class _Http(object):
+    """Minimal HTTP/1.1 codec (Content-Length bodies, keep-alive)."""
+    def parse(self, buffer):
+        start = 0
+        while True:
+            head_end = buffer.find(b'\r\n\r\n', start)
+            if head_end < 0: break
+            lines = bytes(buffer[start:head_end]).decode('latin-1').split('\r\n')
+            _, path, version = lines[0].split(' ', 2)
+            headers = {}
+            for line in lines[1:]:
+                key, _, value = line.partition(':')
+                headers[key.strip().lower()] = value.strip()
+            body_start = head_end + 4
+            body_end = body_start + int(headers.get('content-length', 0))
+            if body_end > len(buffer): break
+            body = bytes(buffer[body_start:body_end])
+            start = body_end
+
+            connection = headers.get('connection', '').lower()
+            keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+            request = _request_object(body) if body.strip() else {}
+            yield path.lstrip('/'), request.get('args', ()), request.get('kwargs', {}), keep_alive
+        del buffer[:start]
+
+    def encode(self, payload, ok):
+        body = json.dumps(payload).encode()
+        status = b'200 OK' if ok else b'500 Internal Server Error'
+        return (b'HTTP/1.1 ' + status + b'\r\nContent-Type: application/json\r\nContent-Length: '
+                + str(len(body)).encode() + b'\r\n\r\n' + body)
+
+
+_CODECS = {'json': _JsonLines, 'http': _Http}
+
+
+class _Connection(asyncio.Protocol):
+    """Serves requests of one client.
+
+    Responses without delay are written straight from data_received, delayed ones are
+    chained through tasks so that pipelined responses keep request order.
+    """
+    def __init__(self, server):
+        self.server = server
+        self.codec = server.codec
+        self.transport = None
+        self.buffer = bytearray()
+        self.tail = None
+        self.batch = None
+        self.closing = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.buffer += data
+        # Immediate responses to a pipelined batch go out in a single write
+        self.batch = []
+        try:
+            for method, args, kwargs, keep_alive in self.codec.parse(self.buffer):
+                self._handle(method, args, kwargs, keep_alive)
+        except ValueError as ex:
+            # Malformed request, there is no telling where the next one starts
+            self.batch.append(self.codec.encode(_error_payload(ex), False))
+            self.closing = True
+        batch, self.batch = self.batch, None
+        self._write(batch)
+
+    def _handle(self, method, args, kwargs, keep_alive):
+        delay, rv, ex = 0., None, None
+        try:
+            expectation = self.server.member(method)
+            merged_args = _normalize_args(expectation.arg_map, *args, **kwargs)
+            responder = expectation._route(merged_args)
+            faults = responder._fault_profile()
+            if faults is None:
+                rv = responder._returns(merged_args)
+            else:
+                delay, rv, ex = faults.apply(responder._returns, merged_args)
+        except Exception as route_ex:
+            ex = route_ex
+
+        if delay > 0 or inspect.isawaitable(rv) or (self.tail is not None and not self.tail.done()):
+            self.tail = asyncio.get_running_loop().create_task(
+                self._respond_later(self.tail, delay, rv, ex, keep_alive))
+        else:
+            self._respond(rv, ex, keep_alive)
+
+    async def _respond_later(self, previous, delay, rv, ex, keep_alive):
+        if previous is not None:
+            await previous
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if inspect.isawaitable(rv):
+            try:
+                rv = await rv
+            except Exception as await_ex:
+                rv, ex = None, await_ex
+        self._respond(rv, ex, keep_alive)
+
+    def _respond(self, rv, ex, keep_alive):
+        if ex is None:
+            try:
+                response = self.codec.encode({'result': rv}, True)
+            except TypeError as encode_ex:
+                response = self.codec.encode(_error_payload(encode_ex), False)
+        else:
+            response = self.codec.encode(_error_payload(ex), False)
+        self.closing = self.closing or not keep_alive
+
+        if self.batch is not None:
+            self.batch.append(response)
+        else:
+            self._write([response])
+
+    def _write(self, responses):
+        if self.transport.is_closing():
+            return
+        if responses:
+            self.transport.write(b''.join(responses))
+        if self.closing:
+            self.transport.close()
+
+
+class MockServer(object):
+    """Serves a Mock over a localhost socket.
+
+    Calls reach the mock from the server's event loop thread; use Mock(threadsafe=True)
+    to verify while the server is still running.
+
+    Basic usage:
+        db = Mock()
+        db.expects('get', lambda key: None).on('a').returns(5)
+        with MockServer(db, protocol='http') as server:
+            run_load_test('http://{}:{}/get'.format(*server.address))
+        db.verify()
+
+    Args:
+        mock: Mock to serve
+        host: interface to bind, localhost by default
+        port: port to bind, 0 picks a free one (see address)
+        protocol: 'json' (newline-delimited JSON over TCP) or 'http'
+    """
+
+    def __init__(self, mock, host='127.0.0.1', port=0, protocol='json'):
+        if protocol not in _CODECS:
+            raise ValueError('unknown protocol {}, expected one of {}'.format(protocol, sorted(_CODECS)))
+        self.mock = mock
+        self.host = host
+        self.port = port
+        self.codec = _CODECS[protocol]()
+        self.address = None
+
+        self._server = None
+        self._loop = None
+        self._thread = None
+
+    def member(self, method):
+        if not method:
+            return self.mock
+        if method not in self.mock.member_mocks:
+            raise AttributeError('{} has no member mock {}'.format(self.mock.method_name or 'mock', method))
+        return getattr(self.mock, method)
+
+    async def serve(self):
+        """Starts serving on the running loop, returns (host, port)."""
+        loop = asyncio.get_running_loop()
+        self._server = await loop.create_server(lambda: _Connection(self), self.host, self.port)
+        self.address = self._server.sockets[0].getsockname()[:2]
+        return self.address
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    def start(self):
+        """Starts serving from a background thread."""
+        ready = threading.Event()
+        failure = []
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            try:
+                self._loop.run_until_complete(self.serve())
+            except Exception as ex:
+                failure.append(ex)
+                ready.set()
+                return
+            ready.set()
+            self._loop.run_forever()
+            self._loop.run_until_complete(self.close())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, name='MockServer', daemon=True)
+        self._thread.start()
+        ready.wait()
+        if failure:
+            raise failure[0]
+        return self
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+# Tests
+import socket
+import time
+import unittest
+
+from mock import Mock
+
+
+def _read_until(sock, n_terminators, terminator=b'\n'):
+    data = b''
+    while data.count(terminator) < n_terminators:
+        chunk = sock.recv(65536)
+        if not chunk: break
+        data += chunk
+    return data
+
+
+class MockServerTests(unittest.TestCase):
+    def setUp(self):
+        self.mock = Mock()
+        get = self.mock.expects('get', lambda key: None)
+        get.on('a').returns(5)
+        get.on('b').raises(KeyError('b'))
+        get.on('slow').delay(0.05).returns('slow')
+        get.on(key='c').returns([1, 2])
+        self.mock.expects('ping').returns('pong').once()
+
+    def test_json(self):
+        with MockServer(self.mock) as server:
+            with socket.create_connection(server.address) as sock:
+                requests = [
+                    {'method': 'get', 'args': ['slow']},
+                    {'method': 'get', 'args': ['a']},
+                    {'method': 'get', 'kwargs': {'key': 'c'}},
+                    {'method': 'get', 'args': ['b']},
+                    {'method': 'ping'},
+                    {'method': 'missing'},
+                ]
+                sock.sendall(b''.join(json.dumps(r).encode() + b'\n' for r in requests))
+                responses = [json.loads(line) for line in _read_until(sock, len(requests)).splitlines()]
+
+        self.assertEqual(responses[:3], [{'result': 'slow'}, {'result': 5}, {'result': [1, 2]}])
+        self.assertEqual(responses[3]['error']['type'], 'KeyError')
+        self.assertEqual(responses[4], {'result': 'pong'})
+        self.assertEqual(responses[5]['error']['type'], 'AttributeError')
+        self.assertEqual(self.mock.get.n_calls, 4)
+        self.assertEqual(self.mock.verify(), True)
+
+    def test_http(self):
+        import http.client
+
+        with MockServer(self.mock, protocol='http') as server:
+            conn = http.client.HTTPConnection(*server.address)
+            conn.request('POST', '/get', body=json.dumps({'args': ['a']}))
+            response = conn.getresponse()
+            self.assertEqual((response.status, json.loads(response.read())), (200, {'result': 5}))
+
+            conn.request('POST', '/get', body=json.dumps({'args': ['b']}))
+            response = conn.getresponse()
+            self.assertEqual(response.status, 500)
+            self.assertEqual(json.loads(response.read())['error']['type'], 'KeyError')
+
+            conn.request('GET', '/ping')
+            response = conn.getresponse()
+            self.assertEqual((response.status, json.loads(response.read())), (200, {'result': 'pong'}))
+            conn.close()
+
+        self.assertEqual(self.mock.verify(), True)
+
+    def test_not_an_object(self):
+        with MockServer(self.mock) as server:
+            with socket.create_connection(server.address) as sock:
+                sock.sendall(b'[1, 2]\n')
+                response = json.loads(_read_until(sock, 1))
+        self.assertEqual(response['error']['type'], 'ValueError')
+
+        import http.client
+        with MockServer(self.mock, protocol='http') as server:
+            conn = http.client.HTTPConnection(*server.address)
+            conn.request('POST', '/get', body='"a"')
+            response = conn.getresponse()
+            self.assertEqual(response.status, 500)
+            self.assertEqual(json.loads(response.read())['error']['type'], 'ValueError')
+            conn.close()
+
+    def test_pipelined_throughput(self):
+        n_requests = 20000
+        request = json.dumps({'method': 'get', 'args': ['a']}).encode() + b'\n'
+        with MockServer(self.mock) as server:
+            with socket.create_connection(server.address) as sock:
+                ts = time.perf_counter()
+                sock.sendall(request * n_requests)
+                data = _read_until(sock, n_requests)
+                elapsed = time.perf_counter() - ts
+
+        self.assertEqual(data.count(b'{"result": 5}'), n_requests)
+        self.assertLess(elapsed, 10)
+        self.assertEqual(self.mock.get.n_calls, n_requests)
+
+
+if __name__ == '__main__':
+    unittest.main()
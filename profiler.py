@@ -1,56 +1,827 @@
+import collections
+import contextvars
 import functools
+import gc
+import itertools
+import marshal
+import math
+import os
+import sys
+import threading
 import time
+from array import array
 
-# TODO: add call graph of monitored functions
+# Histogram buckets: exact below 2**_SUB_BUCKET_BITS, then 2**_SUB_BUCKET_BITS
+# linear sub-buckets per power of two (~3% relative bucket width)
+_SUB_BUCKET_BITS = 5
+_SUB_BUCKETS = 1 << _SUB_BUCKET_BITS
+
+# Percentiles shown in reports
+_PERCENTILES = (50, 90, 99, 99.9)
+
+
+def _bucket(value):
+    """Index of the log-linear histogram bucket of non-negative integer value."""
+    if value < 2 * _SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - _SUB_BUCKET_BITS - 1
+    return ((shift + 1) << _SUB_BUCKET_BITS) + (value >> shift) - _SUB_BUCKETS
+
+
+def _bucket_bounds(index):
+    """Range [low, high) of values falling into bucket index."""
+    if index < 2 * _SUB_BUCKETS:
+        return index, index + 1
+    shift = (index >> _SUB_BUCKET_BITS) - 1
+    low = ((index & (_SUB_BUCKETS - 1)) + _SUB_BUCKETS) << shift
+    return low, low + (1 << shift)
+
+
+class _Stats(object):
+    """Constant-memory streaming aggregate of integer samples (nanoseconds).
+
+    Keeps count, sum, min, max, sum of squares and a log-linear histogram.
+    """
+    __slots__ = ('count', 'total', 'min', 'max', 'sumsq', 'histogram')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.sumsq = 0
+        self.histogram = array('Q')
+
+    def add(self, value):
+        if value < 0:
+            value = 0
+        self.count += 1
+        self.total += value
+        self.sumsq += value * value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+        index = _bucket(value)
+        histogram = self.histogram
+        if index >= len(histogram):
+            histogram.frombytes(bytes(8 * (index + 1 - len(histogram))))
+        histogram[index] += 1
+
+    def merge(self, other):
+        if not other.count:
+            return
+        self.count += other.count
+        self.total += other.total
+        self.sumsq += other.sumsq
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+        if len(other.histogram) > len(self.histogram):
+            self.histogram.frombytes(bytes(8 * (len(other.histogram) - len(self.histogram))))
+        for index, count in enumerate(other.histogram):
+            if count:
+                self.histogram[index] += count
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.
+
+    def stddev(self):
+        if not self.count:
+            return 0.
+        mean = self.mean()
+        return max(self.sumsq / self.count - mean * mean, 0.) ** 0.5
+
+    def subtract(self, earlier):
+        """Stats of samples added since earlier, a previous state of these stats.
+
+        Min and max are estimated from the histogram buckets.
+        """
+        delta = _Stats()
+        delta.count = self.count - earlier.count
+        delta.total = self.total - earlier.total
+        delta.sumsq = self.sumsq - earlier.sumsq
+        delta.histogram = array('Q', self.histogram)
+        for index, count in enumerate(earlier.histogram):
+            delta.histogram[index] -= count
+        occupied = [index for index, count in enumerate(delta.histogram) if count]
+        if occupied:
+            delta.min = max(_bucket_bounds(occupied[0])[0], self.min)
+            delta.max = min(_bucket_bounds(occupied[-1])[1] - 1, self.max)
+        return delta
+
+    def percentile(self, q):
+        """Value at percentile q (0-100), exact up to the histogram bucket width."""
+        if not self.count:
+            return 0
+        rank = max(1, math.ceil(q / 100 * self.count))
+        seen = 0
+        for index, count in enumerate(self.histogram):
+            seen += count
+            if seen >= rank:
+                return max(self.min, min(_bucket_bounds(index)[1] - 1, self.max))
+        return self.max
+
+    def to_dict(self):
+        """JSON-serializable form, see from_dict. Percentiles are informative only."""
+        return {
+            'count': self.count, 'total': self.total, 'min': self.min, 'max': self.max, 'sumsq': self.sumsq,
+            'percentiles': {'p{:g}'.format(q): self.percentile(q) for q in _PERCENTILES},
+            'histogram': [[index, count] for index, count in enumerate(self.histogram) if count],
+        }
+
+    @staticmethod
+    def from_dict(d):
+        stats = _Stats()
+        stats.count, stats.total, stats.min, stats.max, stats.sumsq = d['count'], d['total'], d['min'], d['max'], d['sumsq']
+        if d['histogram']:
+            stats.histogram.frombytes(bytes(8 * (d['histogram'][-1][0] + 1)))
+            for index, count in d['histogram']:
+                stats.histogram[index] = count
+        return stats
+
+    def describe(self, scale=1e9):
+        """Percentiles and max divided by scale (ns to seconds by default), for reports."""
+        return ' '.join(['p{:g} {}'.format(q, self.percentile(q) / scale) for q in _PERCENTILES] + ['max {}'.format(self.max / scale)])
+
+
+class _Reservoir(object):
+    """Bounded uniform sample of raw values (reservoir sampling, algorithm R)."""
+    __slots__ = ('size', 'seen', 'samples', 'lock', 'randrange')
+
+    def __init__(self, size):
+        from random import randrange
+        self.randrange = randrange
+        self.size = size
+        self.seen = 0
+        self.samples = []
+        self.lock = threading.Lock()
+
+    def add(self, sample):
+        with self.lock:
+            self.seen += 1
+            if len(self.samples) < self.size:
+                self.samples.append(sample)
+                return
+            index = self.randrange(self.seen)
+            if index < self.size:
+                self.samples[index] = sample
+
+
+class _Edge(object):
+    """Aggregate of calls along one caller -> callee edge of the call graph."""
+    __slots__ = ('count', 'primitive', 'self_time', 'total_time')
+
+    def __init__(self):
+        self.count = 0
+        self.primitive = 0
+        self.self_time = 0
+        self.total_time = 0
+
+    def merge(self, other):
+        self.count += other.count
+        self.primitive += other.primitive
+        self.self_time += other.self_time
+        self.total_time += other.total_time
+
+
+class _ProfileShard(object):
+    """Aggregates of one CallProfile updated by a single thread."""
+    __slots__ = ('ok_stats', 'error_stats', 'exceptions', 'self_stats', 'cpu_stats', 'subcalls', 'callers',
+                 'peak_stats', 'net_stats', 'gc_stats', 'lines', 'instances')
+
+    def __init__(self):
+        self.ok_stats = _Stats()
+        self.error_stats = _Stats()
+        self.exceptions = {}
+        self.self_stats = _Stats()
+        self.cpu_stats = _Stats()
+        self.subcalls = {}
+        self.callers = {}
+        self.peak_stats = _Stats()
+        self.net_stats = _Stats()
+        self.gc_stats = _Stats()
+        # Line number -> [hits, time], line profiles only
+        self.lines = {}
+        # Instance id -> [calls, total time, self time], per-instance member profiles only
+        self.instances = {}
+
+
+class _ProfileData(object):
+    """Everything one CallProfile recorded within a generation."""
+    __slots__ = ('shards', 'reservoir', 'samples', 'self_samples')
+
+    def __init__(self, reservoir):
+        # Thread id -> _ProfileShard
+        self.shards = {}
+        self.reservoir = _Reservoir(reservoir) if reservoir else None
+        self.samples = 0
+        self.self_samples = 0
+
+
+class _Generation(object):
+    """Data of all profiles since the last Profiler.reset.
+
+    Profiles look their data up in the current generation on every update, so
+    Profiler.reset starts all of them over at once by swapping _generation.
+    """
+    __slots__ = ('profiles', 'paths')
+
+    def __init__(self):
+        # CallProfile -> _ProfileData
+        self.profiles = {}
+        # Thread id -> {call path: self time}, for collapsed stacks
+        self.paths = {}
+
+
+def _merge_shards(shards, attr):
+    merged = _Stats()
+    for shard in shards:
+        merged.merge(getattr(shard, attr))
+    return merged
+
+
+def _merge_dicts(dicts, factory):
+    merged = {}
+    for d in dicts:
+        for key, value in list(d.items()):
+            if key not in merged:
+                merged[key] = factory()
+            merged[key].merge(value)
+    return merged
+
+
+def _merge_stats_dicts(a, b):
+    merged = _Stats.from_dict(a)
+    merged.merge(_Stats.from_dict(b))
+    return merged.to_dict()
+
+
+def _merge_profile_dicts(a, b):
+    """Merges two CallProfile.to_dict() results."""
+    subcalls = dict(a['subcalls'])
+    for name, stats in b['subcalls'].items():
+        subcalls[name] = _merge_stats_dicts(subcalls[name], stats) if name in subcalls else stats
+    return {
+        'total': _merge_stats_dicts(a['total'], b['total']),
+        'errors': _merge_stats_dicts(a['errors'], b['errors']),
+        'exceptions': {name: a['exceptions'].get(name, 0) + b['exceptions'].get(name, 0)
+                       for name in set(a['exceptions']) | set(b['exceptions'])},
+        'peak': _merge_stats_dicts(a['peak'], b['peak']),
+        'net': _merge_stats_dicts(a['net'], b['net']),
+        'gc': _merge_stats_dicts(a['gc'], b['gc']),
+        'self': _merge_stats_dicts(a['self'], b['self']),
+        'cpu': _merge_stats_dicts(a['cpu'], b['cpu']),
+        'subcalls': subcalls,
+        'samples': a['samples'] + b['samples'],
+        'self_samples': a['self_samples'] + b['self_samples'],
+        'lines': {line: [x + y for x, y in zip(a['lines'].get(line, (0, 0)), b['lines'].get(line, (0, 0)))]
+                  for line in set(a['lines']) | set(b['lines'])},
+    }
+
+
+def _merge_into(profiles, name, profile):
+    profiles[name] = _merge_profile_dicts(profiles[name], profile) if name in profiles else profile
+
+
+def _snapshot(calls, classes):
+    """Snapshot of function profiles and (class name, object count, member profiles) of classes."""
+    functions = {}
+    for call in calls:
+        _merge_into(functions, call.name, call.to_dict())
+    merged_classes = {}
+    for cl_name, n_objects, member_profiles in classes:
+        merged = merged_classes.setdefault(cl_name, {'n_objects': 0, 'members': {}})
+        merged['n_objects'] += n_objects
+        for mf_name, mf_profile in member_profiles.items():
+            _merge_into(merged['members'], mf_name, mf_profile.to_dict())
+    return {'functions': functions, 'classes': merged_classes}
+
+
+def _snapshot_delta(current, previous):
+    """Difference of two snapshots (or parts of them), previous may be None or lack entries."""
+    if isinstance(current, dict):
+        if 'histogram' in current:
+            stats = _Stats.from_dict(current)
+            if previous is not None:
+                stats = stats.subtract(_Stats.from_dict(previous))
+            return stats.to_dict()
+        previous = previous or {}
+        return {key: _snapshot_delta(value, previous.get(key)) for key, value in current.items()}
+    if isinstance(current, list):
+        return [c - p for c, p in zip(current, previous or [0] * len(current))]
+    return current - (previous or 0)
 
-from collections import namedtuple
 
 class CallTrace(object):
-    """Helper structure keeping track of callers and call times
+    """Helper structure keeping track of a single call in progress.
+
+    Traces form a linked stack (through caller) kept in a context variable, so every
+    thread and asyncio task sees its own chain of monitored calls.
+
     Attributes:
-        self_time: elapsed time not counting subcalls
-        total_time: total elapsed time (including subcalls and excluded)
-        caller: placeholder for call site
+        profile: CallProfile of the called function
+        start: perf_counter_ns at call start
+        excluded: time not counted as self time (subcalls, excluded and monitored calls)
+        paused_at: perf_counter_ns when measurement was paused
+        caller: CallTrace of the closest monitored caller, None for roots
+        path: _CallPath of monitored functions from root to this call
+        primitive: whether the function is not already on the stack (not recursive)
+        cpu: time spent running (not awaiting) for coroutines, None otherwise
+        owner: (thread id, asyncio task id) the call runs in, the task is looked up only for
+            coroutines, calls below a call with a task and while tracing (0 otherwise)
+        token: context variable token restoring the caller on exit
+        overhead: instrumentation overhead of monitored callees to subtract from total time
+        mem_start: traced memory at call start for memory profiles, None otherwise
+        mem_peak: highest traced memory peak reported by callees (tracemalloc peak is reset per call)
+        gc_start: number of gc collections at call start for memory profiles
+        instance: _profile_id of the instance a member is called on, for per-instance breakdowns
     """
-    def __init__(self, caller):
-        self.self_time = -time.time()
-        self.total_time = self.self_time
+    __slots__ = ('profile', 'start', 'excluded', 'paused_at', 'caller', 'path', 'primitive', 'cpu', 'owner', 'token', 'overhead',
+                 'mem_start', 'mem_peak', 'gc_start', 'instance')
+
+    def __init__(self, profile, caller, mem_start=None, coroutine=False):
+        self.profile = profile
+        self.mem_start = mem_start
+        self.mem_peak = None
+        self.gc_start = _gc_collections[0] if mem_start is not None else None
+        self.instance = None
         self.caller = caller
+        if coroutine or _tracer is not None or (caller is not None and caller.owner[1]):
+            self.owner = _owner()
+        else:
+            # Plain calls below plain calls run in their caller's task, no need to tell tasks apart
+            self.owner = (threading.get_ident(), 0)
+        self.excluded = 0
+        self.overhead = 0
+        self.paused_at = None
+        self.cpu = None
+        path = (_ROOT_PATH if caller is None else caller.path).child(profile)
+        self.path = path
+        self.primitive = not path.recursive
+        self.start = time.perf_counter_ns()
+
+
+class _CallPath(object):
+    """Interned node of the tree of call paths (profiles from the root down to a call).
+
+    Nodes are created once per distinct path and linked to their parent, so entering a
+    call costs a dict lookup however deep the stack. names() builds the path for reports.
+    """
+    __slots__ = ('parent', 'profile', 'recursive', 'children')
+
+    def __init__(self, parent, profile):
+        self.parent = parent
+        self.profile = profile
+        # Whether profile is already on the path above, i.e. the call is not primitive
+        self.recursive = parent is not None and any(node.profile is profile for node in parent._nodes())
+        self.children = {}
+
+    def child(self, profile):
+        node = self.children.get(profile)
+        if node is None:
+            node = self.children.setdefault(profile, _CallPath(self, profile))
+        return node
+
+    def _nodes(self):
+        node = self
+        while node.profile is not None:
+            yield node
+            node = node.parent
+
+    def names(self):
+        """Names of the profiles from the root to this node."""
+        return tuple(reversed([node.profile.name for node in self._nodes()]))
+
+
+_ROOT_PATH = _CallPath(None, None)
+
+
+def _owner():
+    """(thread id, id of the running asyncio task or 0)."""
+    asyncio = sys.modules.get('asyncio')
+    loop = asyncio._get_running_loop() if asyncio is not None else None
+    task = asyncio.current_task(loop) if loop is not None else None
+    return threading.get_ident(), id(task) if task is not None else 0
+
+
+def _ancestors(trace):
+    while trace is not None:
+        yield trace
+        trace = trace.caller
+
+
+class _Overhead(object):
+    """Calibrated instrumentation overhead (ns), see Profiler.calibrate.
+
+    Attributes:
+        call_inner: wrapper cost inside the measured window of a call, subtracted from its total time
+        call_outer: wrapper cost outside the window, subtracted from the caller's total and self time
+        subcall: subcall wrapper cost inside the measured subcall time
+        calibrated: whether calibration ran (or was turned off)
+    """
+    __slots__ = ('call_inner', 'call_outer', 'subcall', 'calibrated')
+
+    def __init__(self, call_inner=0, call_outer=0, subcall=0, calibrated=False):
+        self.call_inner = call_inner
+        self.call_outer = call_outer
+        self.subcall = subcall
+        self.calibrated = calibrated
+
+
+_overhead = _Overhead()
+# Calibration runs before the first profiled call, not when functions are decorated
+_calibration_lock = threading.Lock()
+
+
+# Number of garbage collections, counted by _on_gc while memory profiles are open
+_gc_collections = [0]
+
+
+def _on_gc(phase, info):
+    if phase == 'stop':
+        _gc_collections[0] += 1
+
+
+class _MemoryTracking(object):
+    """Reference count of open memory profiles sharing tracemalloc and the gc callback.
+
+    The first user starts tracemalloc (unless it was already tracing) and installs _on_gc,
+    the last one to release stops what was started here, so that allocations and
+    collections do not keep paying for memory profiling nobody uses.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.users = 0
+        self.started_tracing = False
+
+    def acquire(self):
+        import tracemalloc
+        with self.lock:
+            if not self.users:
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    self.started_tracing = True
+                gc.callbacks.append(_on_gc)
+            self.users += 1
+
+    def release(self):
+        import tracemalloc
+        with self.lock:
+            self.users -= 1
+            if not self.users:
+                gc.callbacks.remove(_on_gc)
+                if self.started_tracing:
+                    tracemalloc.stop()
+                    self.started_tracing = False
+
+
+_memory_tracking = _MemoryTracking()
+
+
+def _memory_start(caller):
+    """Traced memory at call start; resets the tracemalloc peak, handing the peak so far to caller."""
+    import tracemalloc
+    current, peak = tracemalloc.get_traced_memory()
+    if caller is not None and (caller.mem_peak is None or peak > caller.mem_peak):
+        caller.mem_peak = peak
+    tracemalloc.reset_peak()
+    return current
+
+
+# Innermost monitored call in progress, per thread and per asyncio task
+_current_call = contextvars.ContextVar('profiler_current_call', default=None)
+
+# Data of the current reset interval
+_generation = _Generation()
+
+
+def _path_times():
+    """Self time per call path (tuple of names), merged over threads."""
+    merged = {}
+    for shard in list(_generation.paths.values()):
+        for path, self_time in list(shard.items()):
+            names = path.names()
+            merged[names] = merged.get(names, 0) + self_time
+    return merged
+
+
+class _Tracer(object):
+    """Streams begin/end events of monitored calls to a Chrome trace-event file.
+
+    Events are appended to a bounded in-memory queue and written out by a background
+    thread, events arriving while the queue is full are dropped (counted in dropped).
+    Every thread, and every asyncio task, gets its own track (tid) named by a metadata event.
+    The output loads in Perfetto (ui.perfetto.dev) and chrome://tracing.
+    """
+    def __init__(self, path, max_queue=100000, flush_interval=0.1):
+        self.path = path
+        self.max_queue = max_queue
+        self.flush_interval = flush_interval
+        self.events = collections.deque()
+        self.dropped = 0
+        self.tracks = {}
+        self.pid = os.getpid()
+        self._tracks_lock = threading.Lock()
+        self._file = open(path, 'w', buffering=1 << 16)
+        self._file.write('[')
+        self._n_written = 0
+        # Held while tracing, stop() releases it to wake the writer thread
+        self._stop = threading.Lock()
+        self._stop.acquire()
+        self._thread = threading.Thread(target=self._run, name='ProfilerTraceWriter', daemon=True)
+        self._thread.start()
+
+    def _track(self, owner):
+        with self._tracks_lock:
+            track = self.tracks.get(owner)
+            if track is not None:
+                return track
+            track = self.tracks[owner] = len(self.tracks) + 1
+        name = threading.current_thread().name
+        if owner[1]:
+            task = sys.modules['asyncio'].current_task()
+            name = 'task {} ({})'.format(task.get_name() if task is not None else owner[1], name)
+        # Metadata is never dropped, otherwise the track would lose its name
+        self.events.append(('M', '', name, 0, track))
+        return track
+
+    def emit(self, phase, category, name, ts, owner):
+        track = self.tracks.get(owner)
+        if track is None:
+            track = self._track(owner)
+        if len(self.events) >= self.max_queue:
+            self.dropped += 1
+            return
+        self.events.append((phase, category, name, ts, track))
+
+    def _drain(self):
+        import json
+        events = self.events
+        write = self._file.write
+        pid = self.pid
+        while events:
+            phase, category, name, ts, track = events.popleft()
+            write(',\n' if self._n_written else '\n')
+            self._n_written += 1
+            if phase == 'M':
+                write('{{"name":"thread_name","ph":"M","pid":{},"tid":{},"args":{{"name":{}}}}}'.format(pid, track, json.dumps(name)))
+            else:
+                write('{{"name":{},"cat":"{}","ph":"{}","ts":{:.3f},"pid":{},"tid":{}}}'.format(
+                    json.dumps(name), category, phase, ts / 1e3, pid, track))
+
+    def _run(self):
+        while not self._stop.acquire(timeout=self.flush_interval):
+            self._drain()
+
+    def stop(self):
+        self._stop.release()
+        self._thread.join()
+        self._drain()
+        self._file.write('\n]\n')
+        self._file.close()
+
+
+# Active _Tracer, None when not tracing
+_tracer = None
+
+
+# Profiles by id of the code object of the profiled function, for attributing stack samples.
+# Keyed by id since code objects do not cache their hash, which dominated the cost of a sample
+_code_profiles = {}
+
 
 class CallProfile(object):
     """Function profile.
 
     Profile is injected into function dict as `profile`.
+    Calls are timed with time.perf_counter_ns, so profiles follow mock.VirtualClock in tests.
+    Times are kept as streaming aggregates (_Stats), memory does not grow with call count.
+    Time spent in monitored callees is not counted as self time, callers are kept
+    per call graph edge (callers maps caller profile, None for roots, to _Edge).
+
+    Call stacks live in a context variable and aggregates are sharded per thread,
+    so threads and asyncio tasks can be profiled concurrently. Aggregate properties
+    (total_stats, self_stats, cpu_stats, subcalls, callers) merge the shards.
+
+    Calls raising an exception are timed like returning ones; ok_stats and error_stats
+    keep their total times apart and exceptions counts raised exception types.
+
+    With memory=True, calls also record peak and net traced memory (tracemalloc, started on
+    demand) and garbage collections while running. tracemalloc counts the whole process, so
+    allocations of concurrently running threads are included, and its peak is process-wide:
+    every memory-profiled call resets it, so peaks are not isolated between threads running
+    memory-profiled calls at the same time. tracemalloc and the gc callback stay on while
+    memory profiles are open, close() (or Profiler.close_memory) releases them.
+
+    Args:
+        fn: profiled function, None for regions (see Profiler.region)
+        reservoir: number of raw (total, self) samples to keep, 0 to keep none
+        memory: record memory usage of calls
+        name: name to report, fn's qualified name by default
     """
-    # TODO: also keep track of total time in function
-    # TODO: (maybe) monitor stack
-    # TODO: (maybe) monitor exceptions
-    def __init__(self, fn):
+    def __init__(self, fn, reservoir=0, memory=False, name=None):
         self.fn = fn
-        self.call_stack = [] # time deltas
-        self.calls = []
-        self.subcalls = {}
+        self.memory = memory
+        if memory:
+            _memory_tracking.acquire()
+        self.name = name if name is not None else getattr(fn, '__qualname__', repr(fn))
+        self._reservoir_size = reservoir
+        # Data of a profile returned by reset, live profiles use the current _generation
+        self._detached = None
+        code = getattr(fn, '__code__', None)
+        if code is not None:
+            # Kept alive with the profile, so that its id is not reused
+            self._code = code
+            _code_profiles[id(code)] = self
+
+    def _data(self):
+        data = self._detached
+        if data is not None:
+            return data
+        profiles = _generation.profiles
+        data = profiles.get(self)
+        if data is None:
+            data = profiles.setdefault(self, _ProfileData(self._reservoir_size))
+        return data
+
+    def _shard(self):
+        shards = self._data().shards
+        try:
+            return shards[threading.get_ident()]
+        except KeyError:
+            shard = shards[threading.get_ident()] = _ProfileShard()
+            return shard
+
+    @property
+    def _shards(self):
+        return self._data().shards
+
+    @property
+    def reservoir(self):
+        """Raw (total, self) samples (_Reservoir), None without reservoir."""
+        return self._data().reservoir
+
+    @property
+    def samples(self):
+        """Stack samples with this function on the stack."""
+        return self._data().samples
+
+    @property
+    def self_samples(self):
+        """Stack samples with this function as the innermost monitored function."""
+        return self._data().self_samples
+
+    @property
+    def total_stats(self):
+        shards = list(self._shards.values())
+        merged = _merge_shards(shards, 'ok_stats')
+        merged.merge(_merge_shards(shards, 'error_stats'))
+        return merged
+
+    @property
+    def ok_stats(self):
+        """Total time of calls that returned."""
+        return _merge_shards(list(self._shards.values()), 'ok_stats')
+
+    @property
+    def error_stats(self):
+        """Total time of calls that raised."""
+        return _merge_shards(list(self._shards.values()), 'error_stats')
+
+    @property
+    def peak_stats(self):
+        """Peak traced memory during the call above memory at call start (bytes), memory profiles only."""
+        return _merge_shards(list(self._shards.values()), 'peak_stats')
+
+    @property
+    def net_stats(self):
+        """Traced memory retained by the call (bytes, 0 if it freed more), memory profiles only."""
+        return _merge_shards(list(self._shards.values()), 'net_stats')
+
+    @property
+    def gc_stats(self):
+        """Garbage collections during the call, memory profiles only."""
+        return _merge_shards(list(self._shards.values()), 'gc_stats')
+
+    @property
+    def instances(self):
+        """Instance id -> (calls, total time, self time) of per-instance member profiles."""
+        merged = {}
+        for shard in list(self._shards.values()):
+            for instance, entry in list(shard.instances.items()):
+                merged_entry = merged.get(instance, (0, 0, 0))
+                merged[instance] = tuple(x + y for x, y in zip(merged_entry, entry))
+        return merged
+
+    @property
+    def line_stats(self):
+        """Line number -> (hits, time) of line profiles, time includes callees."""
+        merged = {}
+        for shard in list(self._shards.values()):
+            for line, (hits, line_time) in list(shard.lines.items()):
+                merged_hits, merged_time = merged.get(line, (0, 0))
+                merged[line] = (merged_hits + hits, merged_time + line_time)
+        return merged
+
+    @property
+    def exceptions(self):
+        """Number of calls per raised exception type name."""
+        merged = {}
+        for shard in list(self._shards.values()):
+            for name, count in list(shard.exceptions.items()):
+                merged[name] = merged.get(name, 0) + count
+        return merged
+
+    @property
+    def self_stats(self):
+        return _merge_shards(list(self._shards.values()), 'self_stats')
+
+    @property
+    def cpu_stats(self):
+        """On-CPU time of coroutine calls (wall time minus time spent awaiting)."""
+        return _merge_shards(list(self._shards.values()), 'cpu_stats')
+
+    @property
+    def subcalls(self):
+        return _merge_dicts([shard.subcalls for shard in list(self._shards.values())], _Stats)
+
+    @property
+    def callers(self):
+        return _merge_dicts([shard.callers for shard in list(self._shards.values())], _Edge)
+
+    def close(self):
+        """Stops recording memory usage, the last open memory profile stops tracemalloc."""
+        if self.memory:
+            self.memory = False
+            _memory_tracking.release()
+
+    def reset(self):
+        """Starts this profile from zero, returns a profile holding what it recorded.
+
+        To reset all profiles at the same instant use Profiler.reset.
+        """
+        return self._detach(_generation.profiles.pop(self, None))
+
+    def _detach(self, data):
+        """Copy of this profile reporting data (a _ProfileData, None for no calls)."""
+        import copy
+        detached = copy.copy(self)
+        detached._detached = data if data is not None else _ProfileData(self._reservoir_size)
+        return detached
+
+    def to_dict(self):
+        """JSON-serializable aggregates, mergeable with _merge_profile_dicts."""
+        return {
+            'total': self.total_stats.to_dict(),
+            'errors': self.error_stats.to_dict(),
+            'exceptions': self.exceptions,
+            'peak': self.peak_stats.to_dict(),
+            'net': self.net_stats.to_dict(),
+            'gc': self.gc_stats.to_dict(),
+            'self': self.self_stats.to_dict(),
+            'cpu': self.cpu_stats.to_dict(),
+            'subcalls': {name: stats.to_dict() for name, stats in self.subcalls.items()},
+            'samples': self.samples,
+            'self_samples': self.self_samples,
+            'lines': {str(line): list(entry) for line, entry in self.line_stats.items()},
+        }
 
     def exclude(self, fn):
         """Exclude subcall from function metrics.
 
         Useful for calls that are present in test env (prints, logs, waits).
+        Outside of a call of the function, or while profiling is disabled, fn is called as is.
 
         Usage:
             func.profile.exclude(print)('something that will take a long time to do')
         """
+        name = getattr(fn, '__qualname__', repr(fn))
         def wrapper(*args, **kwargs):
-            self._pause()
-            rv = fn(*args, **kwargs)
-            self._unpause()
-            return rv
+            call = self._pause()
+            if call is None:
+                return fn(*args, **kwargs)
+            self._trace('B', 'excluded', name, call.paused_at, call.owner)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self._unpause(call)
+                self._trace('E', 'excluded', name, time.perf_counter_ns(), call.owner)
         functools.update_wrapper(wrapper, fn)
         return wrapper
 
+    def _trace(self, phase, category, name, ts, owner):
+        tracer = _tracer
+        if tracer is not None:
+            tracer.emit(phase, category, name, ts, owner)
+
     def subcall(self, fn):
         """Measure call within a function.
 
         Useful for keeping track of function self-time and external calls.
+        Outside of a call of the function, or while profiling is disabled, fn is called as is.
 
         Usage:
             func.profile.subcall(other_internal_fn)()
@@ -60,33 +831,438 @@ class CallProfile(object):
         functools.update_wrapper(wrapper, fn)
         return wrapper
 
-    def on_start(self):
-        ct = CallTrace(caller=None)
-        self.call_stack.append(ct)
+    def on_start(self, coroutine=False):
+        if not _overhead.calibrated:
+            _calibrate_pending()
+        caller = _current_call.get()
+        # Memory is read before the clock starts, so it does not count towards call time
+        call = CallTrace(self, caller, _memory_start(caller) if self.memory else None, coroutine)
+        call.token = _current_call.set(call)
+        if _tracer is not None:
+            _tracer.emit('B', 'call', self.name, call.start, call.owner)
+        return call
+
+    def on_done(self, error=None, call=None):
+        """Records the call, error is the exception it raised (None if it returned)."""
+        end = time.perf_counter_ns()
+        if call is None:
+            call = _current_call.get()
+        try:
+            _current_call.reset(call.token)
+        except ValueError:
+            # Coroutine closed from another context (e.g. garbage collected)
+            pass
+        if _tracer is not None:
+            _tracer.emit('E', 'call', self.name, end, call.owner)
+        overhead = _overhead
+        total_time = max(end - call.start - overhead.call_inner - call.overhead, 0)
+        self_time = max(total_time - call.excluded, 0)
+
+        thread = threading.get_ident()
+        data = self._data()
+        try:
+            shard = data.shards[thread]
+        except KeyError:
+            shard = data.shards[thread] = _ProfileShard()
+        if error is None:
+            shard.ok_stats.add(total_time)
+        else:
+            shard.error_stats.add(total_time)
+            error_name = type(error).__qualname__
+            shard.exceptions[error_name] = shard.exceptions.get(error_name, 0) + 1
+        shard.self_stats.add(self_time)
+        if call.cpu is not None:
+            shard.cpu_stats.add(call.cpu)
+        if data.reservoir is not None:
+            data.reservoir.add((total_time, self_time))
+
+        if call.instance is not None:
+            entry = shard.instances.get(call.instance)
+            if entry is None:
+                entry = shard.instances[call.instance] = [0, 0, 0]
+            entry[0] += 1
+            entry[1] += total_time
+            entry[2] += self_time
+
+        caller = call.caller
+        if call.mem_start is not None or call.mem_peak is not None:
+            self._memory_done(shard, call, caller)
+        if caller is not None and caller.paused_at is None and caller.owner == call.owner:
+            # Calls from other tasks run concurrently with the caller, calls within
+            # the caller's subcall/exclude are already excluded
+            caller.excluded += total_time
+            caller.overhead += overhead.call_inner + overhead.call_outer + call.overhead
+        edge_key = caller.profile if caller is not None else None
+        edge = shard.callers.get(edge_key)
+        if edge is None:
+            edge = shard.callers[edge_key] = _Edge()
+        edge.count += 1
+        edge.self_time += self_time
+        if call.primitive:
+            edge.primitive += 1
+            edge.total_time += total_time
 
-    def on_done(self):
-        call = self.call_stack.pop()
-        call.self_time += time.time()
-        call.total_time += time.time()
-        self.calls.append(call)
+        paths = _generation.paths
+        path_times = paths.get(thread)
+        if path_times is None:
+            path_times = paths[thread] = {}
+        path_times[call.path] = path_times.get(call.path, 0) + self_time
+
+    def _memory_done(self, shard, call, caller):
+        import tracemalloc
+        current, peak = tracemalloc.get_traced_memory()
+        if call.mem_peak is not None and call.mem_peak > peak:
+            peak = call.mem_peak
+        if call.mem_start is not None:
+            shard.peak_stats.add(peak - call.mem_start)
+            shard.net_stats.add(current - call.mem_start)
+            shard.gc_stats.add(_gc_collections[0] - call.gc_start)
+        if caller is not None and (caller.mem_peak is None or peak > caller.mem_peak):
+            caller.mem_peak = peak
+
+    def _current(self):
+        """Innermost call of this function in progress, None if there is none."""
+        for call in _ancestors(_current_call.get()):
+            if call.profile is self:
+                return call
+        return None
 
     def _pause(self):
-        self.call_stack[-1].self_time += time.time()
+        """Stops the clock of the current call, None (nothing to pause) if disabled or not called."""
+        if not _enabled:
+            return None
+        call = self._current()
+        if call is not None:
+            call.paused_at = time.perf_counter_ns()
+        return call
 
-    def _unpause(self):
-        self.call_stack[-1].self_time -= time.time()
+    def _unpause(self, call):
+        call.excluded += time.perf_counter_ns() - call.paused_at
+        call.paused_at = None
 
     def _subcall(self, fn, *args, **kwargs):
-        self._pause()
+        call = self._pause()
+        if call is None:
+            return fn(*args, **kwargs)
         fn_key = fn.__qualname__
-        ts = time.time()
-        rv = fn(*args, **kwargs)
-        te = time.time()
-        if fn_key not in self.subcalls:
-            self.subcalls[fn_key] = []
-        self.subcalls[fn_key].append(te - ts)
-        self._unpause()
-        return rv
+        ts = time.perf_counter_ns()
+        self._trace('B', 'subcall', fn_key, ts, call.owner)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            te = time.perf_counter_ns()
+            self._trace('E', 'subcall', fn_key, te, call.owner)
+            subcalls = self._shard().subcalls
+            if fn_key not in subcalls:
+                subcalls[fn_key] = _Stats()
+            subcalls[fn_key].add(te - ts - _overhead.subcall)
+            self._unpause(call)
+
+
+class _TimedCoroutine(object):
+    """Drives a coroutine of a monitored function, timing the steps it spends running."""
+    __slots__ = ('profile', 'coro')
+
+    def __init__(self, profile, coro):
+        self.profile = profile
+        self.coro = coro
+
+    def __await__(self):
+        call = self.profile.on_start(coroutine=True)
+        call.cpu = 0
+        coro = self.coro
+        value, error = None, None
+        while True:
+            step_start = time.perf_counter_ns()
+            try:
+                if error is None:
+                    future = coro.send(value)
+                else:
+                    future = coro.throw(error)
+            except StopIteration as stop:
+                call.cpu += time.perf_counter_ns() - step_start
+                self.profile.on_done(call=call)
+                return stop.value
+            except BaseException as ex:
+                call.cpu += time.perf_counter_ns() - step_start
+                self.profile.on_done(ex, call=call)
+                raise
+            call.cpu += time.perf_counter_ns() - step_start
+            try:
+                value, error = (yield future), None
+            except BaseException as ex:
+                value, error = None, ex
+
+
+# Code flags (inspect.CO_*), read directly so that decorating does not import inspect
+_CO_GENERATOR = 0x20
+_CO_COROUTINE = 0x80
+
+
+def _code_flags(fn):
+    """co_flags of the code behind fn (partials and methods unwrapped), 0 if it has none."""
+    while isinstance(fn, functools.partial):
+        fn = fn.func
+    code = getattr(getattr(fn, '__func__', fn), '__code__', None)
+    return code.co_flags if code is not None else 0
+
+
+def _wrap(fn, profile, per_instance=False):
+    """Returns fn wrapper reporting calls to profile.
+
+    With per_instance, calls are also broken down by _profile_id of the first argument (self).
+    """
+    if _code_flags(fn) & _CO_COROUTINE:
+        async def wrapper(*args, **kwargs):
+            if not _enabled:
+                return await fn(*args, **kwargs)
+            return await _TimedCoroutine(profile, fn(*args, **kwargs))
+    elif per_instance:
+        def wrapper(self, *args, **kwargs):
+            if not _enabled:
+                return fn(self, *args, **kwargs)
+            profile.on_start().instance = getattr(self, '_profile_id', None)
+            try:
+                rv = fn(self, *args, **kwargs)
+            except BaseException as ex:
+                profile.on_done(ex)
+                raise
+            profile.on_done()
+            return rv
+    else:
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            profile.on_start()
+            try:
+                rv = fn(*args, **kwargs)
+            except BaseException as ex:
+                profile.on_done(ex)
+                raise
+            profile.on_done()
+            return rv
+    functools.update_wrapper(wrapper, fn)
+    wrapper.profile = profile
+    return wrapper
+
+
+# Per-thread stack of [profile, line, line start, code] of line-profiled calls in progress
+_line_state = threading.local()
+# Code objects of line-profiled functions, for the settrace fallback
+_line_codes = set()
+# Whether line events come from sys.monitoring (3.12+), None before first use
+_line_monitoring = None
+
+
+def _line_stack():
+    try:
+        return _line_state.stack
+    except AttributeError:
+        stack = _line_state.stack = []
+        return stack
+
+
+def _record_line(state, now):
+    line = state[1]
+    if line is not None:
+        lines = state[0]._shard().lines
+        entry = lines.get(line)
+        if entry is None:
+            entry = lines[line] = [0, 0]
+        entry[0] += 1
+        entry[1] += now - state[2]
+
+
+def _on_line(code, line):
+    now = time.perf_counter_ns()
+    stack = _line_stack()
+    if not stack or stack[-1][3] is not code:
+        # Called bypassing the wrapper
+        return
+    state = stack[-1]
+    _record_line(state, now)
+    state[1] = line
+    state[2] = time.perf_counter_ns()
+
+
+def _trace_lines(frame, event, arg):
+    if event == 'line':
+        _on_line(frame.f_code, frame.f_lineno)
+    return _trace_lines
+
+
+def _trace_calls(frame, event, arg):
+    if event == 'call' and frame.f_code in _line_codes:
+        return _trace_lines
+    return None
+
+
+def _use_line_monitoring():
+    """Registers the line callback with sys.monitoring, False if unavailable (< 3.12 or tool id taken)."""
+    global _line_monitoring
+    if _line_monitoring is None:
+        monitoring = getattr(sys, 'monitoring', None)
+        _line_monitoring = False
+        if monitoring is not None:
+            try:
+                monitoring.use_tool_id(monitoring.PROFILER_ID, 'funkpy profiler')
+            except ValueError:
+                return False
+            monitoring.register_callback(monitoring.PROFILER_ID, monitoring.events.LINE, _on_line)
+            _line_monitoring = True
+    return _line_monitoring
+
+
+def _wrap_lines(fn, profile):
+    """Returns fn wrapper timing its lines into profile.
+
+    Line events are enabled with sys.monitoring for fn's code object only. Before 3.12
+    sys.settrace is installed for the duration of the call, so only code running inside
+    line-profiled functions is traced.
+    """
+    if _code_flags(fn) & (_CO_COROUTINE | _CO_GENERATOR):
+        raise ValueError('line profiling supports plain functions only, {} is not'.format(profile.name))
+    code = fn.__code__
+    _line_codes.add(code)
+    monitoring = _use_line_monitoring()
+    if monitoring:
+        sys.monitoring.set_local_events(sys.monitoring.PROFILER_ID, code, sys.monitoring.events.LINE)
+
+    def wrapper(*args, **kwargs):
+        if not _enabled:
+            return fn(*args, **kwargs)
+        stack = _line_stack()
+        state = [profile, None, 0, code]
+        stack.append(state)
+        if not monitoring:
+            previous = sys.gettrace()
+            sys.settrace(_trace_calls)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            if not monitoring:
+                sys.settrace(previous)
+            _record_line(state, time.perf_counter_ns())
+            stack.pop()
+    functools.update_wrapper(wrapper, fn)
+    return wrapper
+
+
+class _Sampler(object):
+    """Periodic stack sampler attributing samples to monitored functions.
+
+    Every sample counts towards each monitored function on the stack (samples) and
+    the innermost one (self_samples); stacks without monitored functions are counted
+    per innermost code object in unattributed.
+
+    Modes:
+        thread: a daemon thread samples all other threads through sys._current_frames()
+            (wall-clock, blocked threads are sampled too)
+        signal: SIGPROF handler samples the main thread on ITIMER_PROF (process CPU time, Unix only)
+
+    The requested rate is an upper bound: the sampler thread gets the GIL about once per
+    sys.getswitchinterval() (5 ms by default, ~200 samples/s) and timer signals are coalesced
+    at the kernel's timer resolution. Time per sample (seconds_per_sample) is therefore
+    measured, the wall-clock (thread) or CPU (signal) time sampled over the number of ticks.
+
+    Each sample walks the whole stack, up to max_depth frames: 3 to 6 us for a 30 frame
+    stack (a dict lookup per frame), under 1% of a 1 kHz interval.
+    """
+    def __init__(self, rate, mode, max_depth=None):
+        if mode not in ('thread', 'signal'):
+            raise ValueError('unknown sampling mode {}, expected thread or signal'.format(mode))
+        self.interval = 1. / rate
+        self.mode = mode
+        self.max_depth = max_depth if max_depth is not None else sys.maxsize
+        self.n_samples = 0
+        self.ticks = 0
+        self.unattributed = {}
+        self._clock = time.perf_counter if mode == 'thread' else time.process_time
+        self._started = None
+        self._stopped = None
+        # Held while sampling, stop() releases it to wake the sampler thread
+        self._stop = threading.Lock()
+        self._stop.acquire()
+        self._thread = None
+        self._previous_handler = None
+        self.running = False
+
+    def seconds_per_sample(self):
+        """Measured time between ticks, the configured interval before the first tick."""
+        if not self.ticks:
+            return self.interval
+        end = self._clock() if self.running else self._stopped
+        return (end - self._started) / self.ticks
+
+    def sample(self, frame):
+        self.n_samples += 1
+        lookup = _code_profiles.get
+        code_id = id
+        innermost = None
+        seen = None
+        depth = self.max_depth
+        while frame is not None and depth:
+            depth -= 1
+            profile = lookup(code_id(frame.f_code))
+            if profile is not None:
+                if innermost is None:
+                    innermost = profile
+                    data = profile._data()
+                    data.self_samples += 1
+                    data.samples += 1
+                    seen = [profile]
+                elif profile not in seen:
+                    # Recursive calls count once per sample
+                    profile._data().samples += 1
+                    seen.append(profile)
+            frame = frame.f_back
+        return innermost
+
+    def _sample_unattributed(self, frame):
+        code = frame.f_code
+        if self.sample(frame) is None:
+            self.unattributed[code] = self.unattributed.get(code, 0) + 1
+
+    def _run(self):
+        own = threading.get_ident()
+        current_frames = sys._current_frames
+        sample = self._sample_unattributed
+        wait = self._stop.acquire
+        interval = self.interval
+        # Lock timeouts do not go through time.sleep, so mock.VirtualClock does not affect sampling
+        while not wait(timeout=interval):
+            self.ticks += 1
+            for ident, frame in current_frames().items():
+                if ident != own:
+                    sample(frame)
+
+    def _on_signal(self, signum, frame):
+        self.ticks += 1
+        if frame is not None:
+            self._sample_unattributed(frame)
+
+    def start(self):
+        import signal
+        self._started = self._clock()
+        if self.mode == 'thread':
+            self._thread = threading.Thread(target=self._run, name='ProfilerSampler', daemon=True)
+            self._thread.start()
+        else:
+            # Raises ValueError off the main thread, the sampler is left stopped
+            self._previous_handler = signal.signal(signal.SIGPROF, self._on_signal)
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self.running = True
+
+    def stop(self):
+        import signal
+        self.running = False
+        if self.mode == 'thread':
+            self._stop.release()
+            self._thread.join()
+        else:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, self._previous_handler)
+        self._stopped = self._clock()
 
 
 _WRAPPER_EXCLUDED_METHODS = [
@@ -97,50 +1273,199 @@ _WRAPPER_EXCLUDED_METHODS = [
 ]
 
 
-def wrapClassProfile(cl):
-    class ClassProfile(cl):
-        # Not mt-safe
+def _instance_finalized(cl):
+    with cl._n_objects_lock:
+        cl._n_live -= 1
+
+
+def _class_attribute(cl, attr):
+    """(class of cl's MRO defining attr, raw attribute) as inspect.getattr_static finds it, (None, None) if none does."""
+    for base in cl.__mro__:
+        if attr in base.__dict__:
+            return base, base.__dict__[attr]
+    return None, None
+
 
+def wrapClassProfile(cl, reservoir=0, memory=False, per_instance=False, include=None, exclude=()):
+    """Returns subclass of cl with profiled members.
+
+    Counts created objects, live objects and the peak of live objects (through weakref
+    finalizers). Every instance gets a sequential _profile_id; with per_instance=True
+    calls of members are also broken down by instance (see Profiler.instance_breakdown).
+
+    Args:
+        cl: class to profile
+        reservoir, memory: see CallProfile
+        per_instance: break member calls down by instance
+        include: names of the only members to profile, by default all callable attributes
+            except those inherited from builtin types (object, dict, list, ...)
+        exclude: names of members not to profile
+    """
+    import weakref
+    finalize = weakref.finalize
+    instance_ids = itertools.count(1)
+
+    class ClassProfile(cl):
         _n_objects = 0
+        _n_live = 0
+        _peak_live = 0
+        _n_objects_lock = threading.Lock()
         _member_profiles = {}
 
         def __init__(self, *args, **kwargs):
-            ClassProfile._n_objects += 1
+            with ClassProfile._n_objects_lock:
+                ClassProfile._n_objects += 1
+                ClassProfile._n_live += 1
+                if ClassProfile._n_live > ClassProfile._peak_live:
+                    ClassProfile._peak_live = ClassProfile._n_live
+            object.__setattr__(self, '_profile_id', next(instance_ids))
+            try:
+                finalize(self, _instance_finalized, ClassProfile).atexit = False
+            except TypeError:
+                # Not weak-referenceable, never counted as gone
+                pass
             return cl.__init__(self, *args, **kwargs)
     
     functools.update_wrapper(ClassProfile.__init__, cl.__init__)
 
     for attr in dir(cl):
-        if attr in _WRAPPER_EXCLUDED_METHODS: continue
+        if attr in _WRAPPER_EXCLUDED_METHODS or attr in exclude: continue
+        owner, static = _class_attribute(cl, attr)
+        if owner is None: continue
+        if include is not None:
+            if attr not in include: continue
+        elif owner.__module__ == 'builtins': continue
 
-        fn = getattr(cl, attr)
-        if not callable(fn): continue
+        if isinstance(static, type): continue # nested classes
+        if isinstance(static, (staticmethod, classmethod)):
+            fn = static.__func__
+        else:
+            fn = getattr(cl, attr)
+            if not callable(fn): continue
 
-        ClassProfile._member_profiles[attr] = CallProfile(fn)
+        profile = ClassProfile._member_profiles[attr] = CallProfile(fn, reservoir=reservoir, memory=memory)
 
         try:
-            fn.profile = ClassProfile._member_profiles[attr]
+            fn.profile = profile
         except:
             # wrappers
             pass
 
-        def wrapper(*args, fn=fn, profile=ClassProfile._member_profiles[attr], **kwargs):
-            profile.on_start()
-            rv = fn(*args, **kwargs)
-            profile.on_done()
-            return rv
+        if isinstance(static, (staticmethod, classmethod)):
+            setattr(ClassProfile, attr, type(static)(_wrap(fn, profile)))
+        else:
+            setattr(ClassProfile, attr, _wrap(fn, profile, per_instance=per_instance))
 
-        wrapper.profile = ClassProfile._member_profiles[attr]
+    return ClassProfile
 
-        functools.update_wrapper(wrapper, fn)
-        setattr(ClassProfile, attr, wrapper)
 
-    return ClassProfile
-        
+def _noop():
+    pass
+
+
+def _timed_loop(fn, n):
+    ts = time.perf_counter_ns()
+    for _ in range(n):
+        fn()
+    return time.perf_counter_ns() - ts
 
 
+def _calibrate_pending():
+    with _calibration_lock:
+        if not _overhead.calibrated:
+            Profiler.calibrate()
+
+
+def _calibrate(n, repeat):
+    """Measures instrumentation overhead on a no-op function, run in a fresh context."""
+    global _overhead
+    # Zero while measuring, marked calibrated so that probe calls do not start another calibration
+    _overhead = _Overhead(calibrated=True)
+    # Probe calls must not show up in collapsed stacks
+    saved_paths = _generation.paths.pop(threading.get_ident(), None)
+    probe = parent = None
+    try:
+        probe = CallProfile(_noop)
+        wrapped = _wrap(_noop, probe)
+        plain = min(_timed_loop(_noop, n) for _ in range(repeat))
+        instrumented = min(_timed_loop(wrapped, n) for _ in range(repeat))
+        call_inner = probe.total_stats.percentile(50)
+        call_outer = max((instrumented - plain) // n - call_inner, 0)
+
+        parent = CallProfile(_noop)
+        subcall = parent.subcall(_noop)
+        def run_subcalls():
+            for _ in range(n):
+                subcall()
+        for _ in range(repeat):
+            _wrap(run_subcalls, parent)()
+        subcall_inner = parent.subcalls[_noop.__qualname__].percentile(50)
+    finally:
+        _generation.paths.pop(threading.get_ident(), None)
+        if saved_paths is not None:
+            _generation.paths[threading.get_ident()] = saved_paths
+        _generation.profiles.pop(probe, None)
+        _generation.profiles.pop(parent, None)
+    return _Overhead(call_inner, call_outer, subcall_inner, calibrated=True)
+
+
+class _Region(object):
+    """Context manager timing a block as a call of its profile, see Profiler.region.
+
+    Blocks entered while profiling is disabled are not timed.
+    """
+    __slots__ = ('profile',)
+
+    def __init__(self, profile):
+        self.profile = profile
+
+    def __enter__(self):
+        if _enabled:
+            self.profile.on_start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Regions are shared, the block was timed if it is the current call
+        call = _current_call.get()
+        if call is not None and call.profile is self.profile:
+            self.profile.on_done(exc, call=call)
+        return False
+
+
+class _DisabledRegion(object):
+    """Shared no-op region handed out while profiling is disabled."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+class _DisabledProfile(object):
+    """Stands in for fn.profile of functions decorated while profiling is disabled."""
+    __slots__ = ()
+
+    def exclude(self, fn):
+        return fn
+
+    def subcall(self, fn):
+        return fn
+
+
+_DISABLED_REGION = _DisabledRegion()
+_DISABLED_PROFILE = _DisabledProfile()
+
+# Profiling switch, FUNKPY_PROFILE=0 in the environment disables it from the start
+_enabled = os.environ.get('FUNKPY_PROFILE', '1').lower() not in ('0', 'false', 'no', 'off')
+
 _monitored_calls = []
 _monitored_classes = []
+# Region profiles by name
+_regions = {}
+# Last started _Sampler, kept after stop_sampling for report
+_sampler = None
 
 class Profiler(object):
     """Profiler facade class.
@@ -154,103 +1479,680 @@ class Profiler(object):
     """
 
     @staticmethod
-    def profile(fn):
+    def profile(fn=None, *, reservoir=0, instrument=True, memory=False, lines=False):
         """Profiler function decorator.
 
         Profiler then keeps track of various stats about the wrapped function.
+        With instrument=False the function is only registered for sampling
+        (see start_sampling) and returned unwrapped, calls cost nothing extra.
+
+        Usage:
+            @Profiler.profile
+            def f(): pass
+
+            @Profiler.profile(reservoir=100) # also keep 100 raw samples
+            def g(): pass
+
+            @Profiler.profile(instrument=False) # sampled only
+            def h(): pass
+
+            @Profiler.profile(memory=True) # also peak/net memory and gc collections per call
+            def i(): pass
+
+            @Profiler.profile(lines=True) # also hits and time per line, see annotate
+            def j(): pass
         """
-        profile = CallProfile(fn)
+        if fn is None:
+            return functools.partial(Profiler.profile, reservoir=reservoir, instrument=instrument, memory=memory, lines=lines)
+        if not _enabled:
+            try:
+                fn.profile = _DISABLED_PROFILE
+            except AttributeError:
+                pass
+            return fn
+        profile = CallProfile(fn, reservoir=reservoir, memory=memory)
         _monitored_calls.append(profile)
-        def wrapper(*args, **kwargs):
-            profile.on_start()
-            rv = fn(*args, **kwargs)
-            profile.on_done()
-            return rv
-        functools.update_wrapper(wrapper, fn)
-        wrapper.profile = profile
-        return wrapper
+        if not instrument:
+            try:
+                fn.profile = profile
+            except AttributeError:
+                pass
+            return fn
+        if lines:
+            return _wrap(_wrap_lines(fn, profile), profile)
+        return _wrap(fn, profile)
 
     @staticmethod
-    def profile_class(cl):
-        profile = wrapClassProfile(cl)
+    def profile_class(cl=None, *, reservoir=0, memory=False, per_instance=False, include=None, exclude=()):
+        """Profiler class decorator, see wrapClassProfile.
+
+        Usage:
+            @Profiler.profile_class
+            class C: pass
+
+            @Profiler.profile_class(per_instance=True, include=['get', 'put'])
+            class Cache: pass
+        """
+        if cl is None:
+            return functools.partial(Profiler.profile_class, reservoir=reservoir, memory=memory,
+                                     per_instance=per_instance, include=include, exclude=exclude)
+        if not _enabled:
+            return cl
+        profile = wrapClassProfile(cl, reservoir=reservoir, memory=memory, per_instance=per_instance,
+                                   include=include, exclude=exclude)
         functools.update_wrapper(profile, cl, assigned=('__module__', '__name__', '__qualname__', '__doc__', '__annotations__'), updated=())
         _monitored_classes.append(profile)
         return profile
 
     @staticmethod
-    def report():
+    def region(name):
+        """Context manager profiling a block like a call of a function named name.
+
+        Regions nest with monitored calls (and other regions) in the same call graph.
+
+        Usage:
+            with Profiler.region('parse'):
+                parse(data)
+        """
+        if not _enabled:
+            return _DISABLED_REGION
+        region = _regions.get(name)
+        if region is None:
+            profile = CallProfile(None, name=name)
+            region = _regions.setdefault(name, _Region(profile))
+            if region.profile is profile:
+                _monitored_calls.append(profile)
+        return region
+
+    @staticmethod
+    def enable():
+        """Turns profiling back on, see disable."""
+        global _enabled
+        _enabled = True
+        if _line_monitoring:
+            for code in _line_codes:
+                sys.monitoring.set_local_events(sys.monitoring.PROFILER_ID, code, sys.monitoring.events.LINE)
+
+    @staticmethod
+    def disable():
+        """Turns profiling off at runtime.
+
+        Profiled functions call straight through and regions are no-ops until enable().
+        While disabled (also when started with FUNKPY_PROFILE=0 in the environment),
+        profile and profile_class return what they decorate unchanged.
+        """
+        global _enabled
+        _enabled = False
+        if _line_monitoring:
+            for code in _line_codes:
+                sys.monitoring.set_local_events(sys.monitoring.PROFILER_ID, code, 0)
+
+    @staticmethod
+    def enabled():
+        return _enabled
+
+    @staticmethod
+    def close_memory():
+        """Stops memory recording of all profiles, releasing tracemalloc and the gc callback.
+
+        Recorded memory stats are kept. Calls keep being timed.
+        """
+        for profile in _monitored_calls:
+            profile.close()
+        for cl in _monitored_classes:
+            for profile in cl._member_profiles.values():
+                profile.close()
+
+    @staticmethod
+    def calibrate(enabled=True, n=1000, repeat=3):
+        """Measures the profiler's own per-call and per-subcall overhead.
+
+        Calibrated overhead is subtracted from recorded times (clamped at zero).
+        Runs before the first profiled call (about 50 ms), call it up front to pay that
+        cost elsewhere, again to recalibrate, or with enabled=False to record raw times.
+
+        Usage:
+            Profiler.calibrate()
+            Profiler.calibrate(enabled=False)
+
+        Args:
+            enabled: False sets the overhead to zero
+            n: calls per measurement
+            repeat: measurements, the fastest one is used
+        """
+        global _overhead
+        if not enabled:
+            _overhead = _Overhead(calibrated=True)
+        elif not _enabled:
+            # Wrappers call straight through, calibrate before the next profiled call instead
+            _overhead = _Overhead()
+        else:
+            _overhead = contextvars.Context().run(_calibrate, n, repeat)
+        return _overhead
+
+    @staticmethod
+    def start_sampling(rate=1000, mode='thread', max_depth=None):
+        """Starts sampling stacks rate times a second.
+
+        Samples are attributed to functions registered through profile and profile_class
+        (including instrument=False ones) and shown in report.
+
+        Usage:
+            Profiler.start_sampling(rate=1000)
+            run_workload()
+            Profiler.stop_sampling()
+            Profiler.report()
+
+        Args:
+            rate: samples per second
+            mode: 'thread' (all threads, wall-clock) or 'signal' (main thread, CPU time, Unix only)
+            max_depth: frames walked per sample from the innermost one, None for whole stacks
+
+        The rate is an upper bound (see _Sampler), reported seconds use the measured time per sample.
+        """
+        global _sampler
+        if _sampler is not None and _sampler.running:
+            raise RuntimeError('sampling already started')
+        sampler = _Sampler(rate, mode, max_depth)
+        sampler.start()
+        _sampler = sampler
+
+    @staticmethod
+    def stop_sampling():
+        _sampler.stop()
+
+    @staticmethod
+    def start_trace(path, max_queue=100000):
+        """Starts writing a timeline of monitored calls, subcalls and excluded regions.
+
+        Output is in Chrome trace-event format (Perfetto, chrome://tracing), with a
+        track per thread and asyncio task.
+
+        Usage:
+            Profiler.start_trace('trace.json')
+            run_workload()
+            Profiler.stop_trace()
+
+        Args:
+            path: output file
+            max_queue: events buffered before the writer thread catches up, further events are dropped
+        """
+        global _tracer
+        if _tracer is not None:
+            raise RuntimeError('tracing already started')
+        _tracer = _Tracer(path, max_queue=max_queue)
+
+    @staticmethod
+    def stop_trace():
+        """Flushes and closes the trace, returns the number of dropped events."""
+        global _tracer
+        tracer, _tracer = _tracer, None
+        tracer.stop()
+        return tracer.dropped
+
+    @staticmethod
+    def snapshot():
+        """JSON-serializable aggregates of all monitored calls.
+
+        Snapshots of several processes can be combined with merge_snapshots.
+
+        Usage:
+            json.dump(Profiler.snapshot(), f)
+        """
+        return _snapshot(_monitored_calls, [(cl.__qualname__, cl._n_objects, cl._member_profiles) for cl in _monitored_classes])
+
+    @staticmethod
+    def reset():
+        """Starts all counters from zero, returns the snapshot of what they held.
+
+        All profiles switch at the same instant: they record into one generation, which is
+        replaced by a single reference swap, so the snapshot covers the same interval for every
+        function. Instrumented threads are not locked, a call storing its result at the very
+        moment of the swap may be missed. Class object counts are swapped per class.
+
+        Usage:
+            stats = Profiler.reset() # e.g. once per reporting interval
+        """
+        global _generation
+        generation, _generation = _generation, _Generation()
+        calls = [call._detach(generation.profiles.get(call)) for call in _monitored_calls]
+        classes = []
+        for cl in _monitored_classes:
+            with cl._n_objects_lock:
+                n_objects, cl._n_objects = cl._n_objects, 0
+                cl._peak_live = cl._n_live
+            members = {name: mf._detach(generation.profiles.get(mf)) for name, mf in cl._member_profiles.items()}
+            classes.append((cl.__qualname__, n_objects, members))
+        return _snapshot(calls, classes)
+
+    @staticmethod
+    def serve_stats(host='127.0.0.1', port=0, path=None):
+        """Starts a StatsServer in a background thread, see StatsServer."""
+        return StatsServer(host=host, port=port, path=path).start()
+
+    @staticmethod
+    def merge_snapshots(snapshots):
+        """Combines snapshots (e.g. of several processes), profiles are matched by name.
+
+        Usage:
+            merged = Profiler.merge_snapshots([json.load(f) for f in files])
+            merged['functions']['handle_request']['total']['percentiles']['p99']
+        """
+        functions = {}
+        classes = {}
+        for snapshot in snapshots:
+            for name, profile in snapshot['functions'].items():
+                _merge_into(functions, name, profile)
+            for cl_name, cl in snapshot['classes'].items():
+                merged = classes.setdefault(cl_name, {'n_objects': 0, 'members': {}})
+                merged['n_objects'] += cl['n_objects']
+                for mf_name, mf_profile in cl['members'].items():
+                    _merge_into(merged['members'], mf_name, mf_profile)
+        return {'functions': functions, 'classes': classes}
+
+    @staticmethod
+    def report(format='text'):
         """Produce report for monitored calls.
 
         Usage:
             Profiler.report()
+            Profiler.report(format='json') # snapshot() as JSON
         """
+        if format == 'json':
+            import json
+            print(json.dumps(Profiler.snapshot()))
+            return
+        if format != 'text':
+            raise ValueError('unknown report format {}, expected text or json'.format(format))
+
+        if _overhead.calibrated:
+            print('profiler overhead subtracted: {} second(s) per call ({} inside the call), {} second(s) per subcall'.format(
+                (_overhead.call_inner + _overhead.call_outer) / 1e9, _overhead.call_inner / 1e9, _overhead.subcall / 1e9))
+
         for call in _monitored_calls:
-            # called ... times from ...
-            # total ... avg ...
-            self_time = sum([ct.self_time for ct in call.calls])
-            total_time = sum([ct.total_time for ct in call.calls])
-            print('function {}'.format(call.fn))
-            print('  called {} time(s)'.format(len(call.calls)))
-            print('  avg. total time {} second(s)'.format(total_time/len(call.calls)))
-            print('  avg. self time {} second(s)'.format(self_time/len(call.calls)))
-            for subcall_fn, subcall_calls in call.subcalls.items():
-                print('  subcall {} ran {} time(s), took avg {}'.format(subcall_fn, len(subcall_calls), sum(subcall_calls)/len(subcall_calls)))
+            total_stats = call.total_stats
+            if not total_stats.count and not call.samples: continue # ignore if not called
+            if call.fn is None:
+                print('region {}'.format(call.name))
+            else:
+                print('function {}'.format(call.fn))
+            if total_stats.count:
+                Profiler._report_calls(call, total_stats)
+            if call.samples:
+                Profiler._report_samples(call, '  ')
 
         for cl in _monitored_classes:
             total_time = 0
-            print('class {} created {} time(s)'.format(cl, cl._n_objects))
+            print('class {} created {} time(s), {} live, peak {} live'.format(cl, cl._n_objects, cl._n_live, cl._peak_live))
             for mf_name, mf_profile in cl._member_profiles.items():
-                if not mf_profile.calls: continue # ignore if not called
-                mf_self_time = sum([call.self_time for call in mf_profile.calls])
-                mf_total_time = sum([call.total_time for call in mf_profile.calls])
-                total_time += mf_total_time
+                mf_total_stats = mf_profile.total_stats
+                if not mf_total_stats.count: continue # ignore if not called
+                total_time += mf_total_stats.total
                 print('  member {}'.format(mf_name))
-                print('     called {} time(s)'.format(len(mf_profile.calls)))
-                print('     avg. self time {} second(s)'.format(mf_self_time/len(mf_profile.calls)))
-                print('     avg. total time {} second(s)'.format(mf_total_time/len(mf_profile.calls)))
-            print('  spent a total of {} second(s) inside the class'.format(total_time))
+                print('     called {} time(s)'.format(mf_total_stats.count))
+                if mf_profile.samples:
+                    Profiler._report_samples(mf_profile, '     ')
+                print('     avg. self time {} second(s)'.format(mf_profile.self_stats.mean() / 1e9))
+                print('     avg. total time {} second(s)'.format(mf_total_stats.mean() / 1e9))
+                print('     total time {} second(s)'.format(mf_total_stats.describe()))
+                Profiler._report_errors(mf_profile, '     ')
+                Profiler._report_memory(mf_profile, '     ')
+                mf_cpu_stats = mf_profile.cpu_stats
+                if mf_cpu_stats.count:
+                    print('     avg. on-CPU time {} second(s)'.format(mf_cpu_stats.mean() / 1e9))
+            print('  spent a total of {} second(s) inside the class'.format(total_time / 1e9))
+            breakdown = Profiler.instance_breakdown(cl)
+            if breakdown:
+                print('  hottest instances')
+                totals = {instance: sum(entry[1] for entry in members.values()) for instance, members in breakdown.items()}
+                for instance in sorted(totals, key=lambda instance: -totals[instance])[:5]:
+                    members = breakdown[instance]
+                    print('    #{} spent {} second(s) in {} call(s) ({})'.format(
+                        instance, totals[instance] / 1e9, sum(entry[0] for entry in members.values()),
+                        ', '.join('{} x{}'.format(name, entry[0]) for name, entry in sorted(members.items()))))
+
+        if _sampler is not None and _sampler.unattributed:
+            print('sampled outside monitored functions ({} of {} sample(s))'.format(
+                sum(_sampler.unattributed.values()), _sampler.n_samples))
+            top = sorted(_sampler.unattributed.items(), key=lambda item: -item[1])[:10]
+            for code, n_samples in top:
+                print('  {} ({}:{}) {} sample(s)'.format(getattr(code, 'co_qualname', code.co_name), code.co_filename, code.co_firstlineno, n_samples))
+
+    @staticmethod
+    def _report_calls(call, total_stats):
+        self_stats = call.self_stats
+        cpu_stats = call.cpu_stats
+        print('  called {} time(s)'.format(total_stats.count))
+        for caller, edge in call.callers.items():
+            if caller is not None:
+                print('  called {} time(s) from {}, took avg {} (self {})'.format(
+                    edge.count, caller.name, edge.total_time / max(edge.primitive, 1) / 1e9, edge.self_time / edge.count / 1e9))
+        print('  avg. total time {} second(s)'.format(total_stats.mean() / 1e9))
+        print('  avg. self time {} second(s)'.format(self_stats.mean() / 1e9))
+        if cpu_stats.count:
+            print('  avg. on-CPU time {} second(s)'.format(cpu_stats.mean() / 1e9))
+        print('  total time min {} max {} stddev {} second(s)'.format(
+            total_stats.min / 1e9, total_stats.max / 1e9, total_stats.stddev() / 1e9))
+        print('  total time {} second(s)'.format(total_stats.describe()))
+        print('  self time {} second(s)'.format(self_stats.describe()))
+        Profiler._report_errors(call, '  ')
+        Profiler._report_memory(call, '  ')
+        if call.line_stats:
+            print(Profiler.annotate(call))
+        for subcall_fn, subcall_stats in call.subcalls.items():
+            print('  subcall {} ran {} time(s), took avg {}'.format(subcall_fn, subcall_stats.count, subcall_stats.mean() / 1e9))
+            print('    {} second(s)'.format(subcall_stats.describe()))
+
+    @staticmethod
+    def _report_errors(profile, indent):
+        error_stats = profile.error_stats
+        if not error_stats.count:
+            return
+        ok_stats = profile.ok_stats
+        print('{}raised {} time(s): {}'.format(indent, error_stats.count, ', '.join(
+            '{} x{}'.format(name, count) for name, count in sorted(profile.exceptions.items()))))
+        print('{}failed calls avg. total time {} second(s), {} second(s)'.format(indent, error_stats.mean() / 1e9, error_stats.describe()))
+        if ok_stats.count:
+            print('{}returning calls avg. total time {} second(s), {} second(s)'.format(indent, ok_stats.mean() / 1e9, ok_stats.describe()))
+
+    @staticmethod
+    def _report_memory(profile, indent):
+        if not profile.memory and not profile.peak_stats.count:
+            return
+        peak_stats = profile.peak_stats
+        net_stats = profile.net_stats
+        gc_stats = profile.gc_stats
+        print('{}avg. peak memory {} byte(s), {} byte(s)'.format(indent, peak_stats.mean(), peak_stats.describe(1)))
+        print('{}avg. net memory {} byte(s), {} byte(s) retained in total'.format(indent, net_stats.mean(), net_stats.total))
+        print('{}gc collections {} during {} call(s)'.format(indent, gc_stats.total, gc_stats.count))
+
+    @staticmethod
+    def annotate(fn):
+        """Source of a line-profiled function annotated with hits and time per line.
+
+        Usage:
+            print(Profiler.annotate(f))
+        """
+        import inspect
+        profile = fn if isinstance(fn, CallProfile) else fn.profile
+        line_stats = profile.line_stats
+        source, first_line = inspect.getsourcelines(profile.fn)
+        total_time = sum(line_time for _, line_time in line_stats.values()) or 1
+        rows = ['{:>6} {:>9} {:>14} {:>14} {:>7}  {}'.format('line', 'hits', 'time (s)', 'per hit (s)', '% time', 'source')]
+        for line, text in enumerate(source, first_line):
+            hits, line_time = line_stats.get(line, (0, 0))
+            if hits:
+                rows.append('{:>6} {:>9} {:>14.6g} {:>14.6g} {:>7.1f}  {}'.format(
+                    line, hits, line_time / 1e9, line_time / hits / 1e9, 100 * line_time / total_time, text.rstrip()))
+            else:
+                rows.append('{:>6} {:>9} {:>14} {:>14} {:>7}  {}'.format(line, '', '', '', '', text.rstrip()))
+        return '\n'.join(rows)
+
+    @staticmethod
+    def _report_samples(profile, indent):
+        interval = _sampler.seconds_per_sample() if _sampler is not None else 0.
+        print('{}sampled {} time(s) (~{} second(s)), self {} time(s) (~{} second(s))'.format(
+            indent, profile.samples, profile.samples * interval, profile.self_samples, profile.self_samples * interval))
+
+    @staticmethod
+    def instance_breakdown(cl):
+        """Instance id -> member name -> (calls, total time, self time) of a per_instance profiled class.
+
+        Instance ids are the _profile_id attributes of instances.
+        """
+        breakdown = {}
+        for mf_name, mf_profile in cl._member_profiles.items():
+            for instance, entry in mf_profile.instances.items():
+                breakdown.setdefault(instance, {})[mf_name] = entry
+        return breakdown
+
+    @staticmethod
+    def _all_profiles():
+        profiles = list(_monitored_calls)
+        for cl in _monitored_classes:
+            profiles.extend(cl._member_profiles.values())
+        return profiles
+
+    @staticmethod
+    def write_collapsed(path):
+        """Writes self time (ns) per call path of monitored functions as collapsed stacks.
+
+        Output is readable by flamegraph.pl, speedscope, inferno and similar tools.
+
+        Usage:
+            Profiler.write_collapsed('profile.folded')
+            # flamegraph.pl profile.folded > profile.svg
+        """
+        with open(path, 'w') as f:
+            for call_path, self_time in sorted(_path_times().items()):
+                f.write('{} {}\n'.format(';'.join(call_path), self_time))
+
+    @staticmethod
+    def dump_stats(path):
+        """Writes monitored calls in pstats format.
+
+        Usage:
+            Profiler.dump_stats('profile.pstats')
+            pstats.Stats('profile.pstats').sort_stats('cumulative').print_stats()
+        """
+        def key(profile):
+            code = getattr(profile.fn, '__code__', None)
+            if code is None:
+                return ('~', 0, profile.name)
+            return (code.co_filename, code.co_firstlineno, profile.name)
+
+        stats = {}
+        for profile in Profiler._all_profiles():
+            if not profile.total_stats.count: continue
+            callers = {}
+            primitive = 0
+            total_time = 0
+            for caller, edge in profile.callers.items():
+                primitive += edge.primitive
+                total_time += edge.total_time
+                if caller is not None:
+                    # Caller entries are (nc, cc, tt, ct), unlike (cc, nc, ...) of functions
+                    callers[key(caller)] = (edge.count, edge.primitive, edge.self_time / 1e9, edge.total_time / 1e9)
+            stats[key(profile)] = (primitive, profile.total_stats.count, profile.self_stats.total / 1e9, total_time / 1e9, callers)
+
+        with open(path, 'wb') as f:
+            marshal.dump(stats, f)
+
+
+
+def _prometheus_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _prometheus(snapshot):
+    """Snapshot in Prometheus text exposition format."""
+    profiles = list(snapshot['functions'].items())
+    for cl_name, cl in snapshot['classes'].items():
+        profiles.extend(('{}.{}'.format(cl_name, mf_name), mf) for mf_name, mf in cl['members'].items())
+
+    lines = [
+        '# HELP funkpy_calls_total Calls of monitored functions.',
+        '# TYPE funkpy_calls_total counter',
+    ]
+    lines.extend('funkpy_calls_total{{function="{}"}} {}'.format(_prometheus_label(name), profile['total']['count'])
+                 for name, profile in profiles)
+    lines.extend([
+        '# HELP funkpy_errors_total Calls of monitored functions that raised.',
+        '# TYPE funkpy_errors_total counter',
+    ])
+    lines.extend('funkpy_errors_total{{function="{}"}} {}'.format(_prometheus_label(name), profile['errors']['count'])
+                 for name, profile in profiles)
+    lines.extend([
+        '# HELP funkpy_self_seconds_total Self time of monitored functions.',
+        '# TYPE funkpy_self_seconds_total counter',
+    ])
+    lines.extend('funkpy_self_seconds_total{{function="{}"}} {}'.format(_prometheus_label(name), profile['self']['total'] / 1e9)
+                 for name, profile in profiles)
+    lines.extend([
+        '# HELP funkpy_call_seconds Total time of monitored function calls.',
+        '# TYPE funkpy_call_seconds summary',
+    ])
+    for name, profile in profiles:
+        label = _prometheus_label(name)
+        stats = profile['total']
+        for q in _PERCENTILES:
+            lines.append('funkpy_call_seconds{{function="{}",quantile="{:g}"}} {}'.format(
+                label, q / 100, stats['percentiles']['p{:g}'.format(q)] / 1e9))
+        lines.append('funkpy_call_seconds_sum{{function="{}"}} {}'.format(label, stats['total'] / 1e9))
+        lines.append('funkpy_call_seconds_count{{function="{}"}} {}'.format(label, stats['count']))
+    lines.extend([
+        '# HELP funkpy_objects_total Objects created of monitored classes.',
+        '# TYPE funkpy_objects_total counter',
+    ])
+    lines.extend('funkpy_objects_total{{class="{}"}} {}'.format(_prometheus_label(cl_name), cl['n_objects'])
+                 for cl_name, cl in snapshot['classes'].items())
+    return '\n'.join(lines) + '\n'
+
 
+class StatsServer(object):
+    """Serves live profiler stats over localhost HTTP or a Unix domain socket.
 
-@Profiler.profile
-def run_f():
-    run_f.profile.exclude(time.sleep)(0.01)
-    run_f.profile.subcall(time.sleep)(0.1)
-    time.sleep(0.1)
-    return 5
+    Endpoints:
+        GET /stats    Profiler.snapshot() as JSON
+        GET /delta    changes since the previous /delta (or server start) as JSON
+        GET /metrics  snapshot in Prometheus text format
+        POST /reset   Profiler.reset(), responds with the snapshot of the reset counters
 
-@Profiler.profile
-def sort_items(items):
-    sort_items.profile.subcall(items.sort)()
+    Requests are served from a background thread reading aggregates without locks,
+    instrumented threads never wait for it.
+
+    Basic usage:
+        with StatsServer(port=9100) as server:
+            serve_forever()
+
+        curl localhost:9100/metrics
+        curl --unix-socket /tmp/profiler.sock localhost/stats
+
+    Args:
+        host: interface to bind, localhost by default
+        port: port to bind, 0 picks a free one (see address)
+        path: Unix domain socket path, used instead of host and port
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, path=None):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.address = None
+        self._previous = None
+        self._server = None
+        self._thread = None
+
+    def _respond(self, method, url):
+        """(status, content type, body) for a request."""
+        import json
+        route = url.split('?', 1)[0].rstrip('/')
+        if method == 'GET' and route == '/stats':
+            return 200, 'application/json', json.dumps(Profiler.snapshot())
+        if method == 'GET' and route == '/delta':
+            current = Profiler.snapshot()
+            delta = _snapshot_delta(current, self._previous)
+            self._previous = current
+            return 200, 'application/json', json.dumps(delta)
+        if method == 'GET' and route == '/metrics':
+            return 200, 'text/plain; version=0.0.4', _prometheus(Profiler.snapshot())
+        if method == 'POST' and route == '/reset':
+            reset = Profiler.reset()
+            self._previous = None
+            return 200, 'application/json', json.dumps(reset)
+        return 404, 'text/plain', 'not found\n'
+
+    def start(self):
+        import http.server
+        import socketserver
+
+        stats_server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def _handle(self):
+                status, content_type, body = stats_server._respond(self.command, self.path)
+                body = body.encode()
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_POST = _handle
+
+            def address_string(self):
+                return str(self.client_address)
+
+            def log_message(self, format, *args):
+                pass
+
+        if self.path is not None:
+            self._server = socketserver.UnixStreamServer(self.path, Handler)
+            self.address = self.path
+        else:
+            self._server = http.server.HTTPServer((self.host, self.port), Handler)
+            self.address = self._server.server_address[:2]
+        self._thread = threading.Thread(target=self._server.serve_forever, name='ProfilerStatsServer', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        if self.path is not None:
+            os.remove(self.path)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+if __name__ == '__main__':
+    # Demo
+    import random
 
-class C:
     @Profiler.profile
-    def mf(self):
+    def run_f():
+        run_f.profile.exclude(time.sleep)(0.01)
+        run_f.profile.subcall(time.sleep)(0.1)
         time.sleep(0.1)
-        run_f()
+        return 5
 
-c = C()
+    @Profiler.profile
+    def sort_items(items):
+        sort_items.profile.subcall(items.sort)()
+
+    class C:
+        @Profiler.profile
+        def mf(self):
+            time.sleep(0.1)
+            run_f()
 
-import random
-for _ in range(2):
-    run_f()
-    c.mf()
-    sort_items([random.randint(0, 1000) for _ in range(10000)])
+    c = C()
 
-@Profiler.profile_class
-class D:
-    def __init__(self, somearg):
-        self.somearg = somearg
+    for _ in range(2):
+        run_f()
+        c.mf()
+        sort_items([random.randint(0, 1000) for _ in range(10000)])
+
+    @Profiler.profile_class
+    class D:
+        def __init__(self, somearg):
+            self.somearg = somearg
 
-    def get_member_fn(self):
-        """docstr"""
-        return self.somearg
+        def get_member_fn(self):
+            """docstr"""
+            return self.somearg
 
-    def other_mf(self):
-        pass
+        def other_mf(self):
+            pass
 
-d = D(10)
-d.get_member_fn()
-d.other_mf()
+    d = D(10)
+    d.get_member_fn()
+    d.other_mf()
 
 
-Profiler.report()
+    Profiler.report()
@@ -0,0 +1,977 @@
+import asyncio
+import collections
+import contextlib
+import gc
+import inspect
+import io
+import json
+import os
+import pstats
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import unittest
+
+import profiler
+from mock import VirtualClock
+from profiler import Profiler, StatsServer, _Overhead, _Stats, _bucket, _bucket_bounds
+
+
+def setUpModule():
+    # Exact virtual times below, OverheadTests calibrates on its own
+    Profiler.calibrate(enabled=False)
+
+
+class StatsTests(unittest.TestCase):
+    def test_buckets(self):
+        values = list(range(200)) + [10**k + j for k in range(3, 13) for j in (0, 1, 7)]
+        for value in values:
+            low, high = _bucket_bounds(_bucket(value))
+            self.assertTrue(low <= value < high)
+            self.assertLessEqual(high - low, max(1, value // 16))
+
+        for index in range(1, 2000):
+            self.assertEqual(_bucket_bounds(index - 1)[1], _bucket_bounds(index)[0])
+
+    def test_stats(self):
+        stats = _Stats()
+        for value in (10, 20, 30, 40):
+            stats.add(value)
+        self.assertEqual((stats.count, stats.total, stats.min, stats.max), (4, 100, 10, 40))
+        self.assertEqual(stats.mean(), 25)
+        self.assertAlmostEqual(stats.stddev(), 125 ** 0.5)
+        self.assertEqual(sum(stats.histogram), 4)
+
+    def test_percentiles(self):
+        stats = _Stats()
+        for value in range(1, 100001):
+            stats.add(value * 1000)
+        for q in (50, 90, 99, 99.9):
+            expected = q * 1000 * 1000
+            self.assertLess(abs(stats.percentile(q) - expected), expected * 0.04)
+        self.assertEqual(stats.percentile(100), stats.max)
+
+        restored = _Stats.from_dict(json.loads(json.dumps(stats.to_dict())))
+        self.assertEqual(restored.percentile(99), stats.percentile(99))
+        self.assertEqual((restored.count, restored.total, restored.sumsq), (stats.count, stats.total, stats.sumsq))
+
+
+class CallProfileTests(unittest.TestCase):
+    def test_profile(self):
+        def wait(seconds):
+            time.sleep(seconds)
+
+        with VirtualClock():
+            @Profiler.profile(reservoir=2)
+            def f(n):
+                time.sleep(n)
+                f.profile.subcall(wait)(1)
+                f.profile.exclude(wait)(2)
+
+            for n in range(1, 5):
+                f(n)
+
+        profile = f.profile
+        self.assertEqual(profile.total_stats.count, 4)
+        self.assertEqual(profile.total_stats.total, (10 + 4 * 3) * 10**9)
+        self.assertEqual(profile.self_stats.total, 10 * 10**9)
+        self.assertEqual(profile.self_stats.min, 10**9)
+        self.assertEqual(profile.subcalls[wait.__qualname__].count, 4)
+        self.assertEqual(len(profile.reservoir.samples), 2)
+        self.assertEqual(profile.reservoir.seen, 4)
+
+    def test_profile_class(self):
+        with VirtualClock():
+            @Profiler.profile_class
+            class C(object):
+                def mf(self):
+                    time.sleep(1)
+
+            C().mf()
+            C().mf()
+
+        self.assertEqual(C._n_objects, 2)
+        self.assertEqual(C._member_profiles['mf'].total_stats.total, 2 * 10**9)
+
+    def test_profile_class_breakdown(self):
+        with VirtualClock():
+            @Profiler.profile_class(per_instance=True, exclude=['skipped'])
+            class Cache(object):
+                def get(self, n):
+                    time.sleep(n)
+
+                def skipped(self):
+                    pass
+
+                @staticmethod
+                def make():
+                    return Cache()
+
+                @classmethod
+                def name(cls):
+                    return cls.__name__
+
+            hot, cold = Cache.make(), Cache()
+            for _ in range(3):
+                hot.get(2)
+            cold.get(1)
+            self.assertEqual(Cache.name(), 'Cache')
+            self.assertEqual((Cache._n_live, Cache._peak_live), (2, 2))
+            del hot, cold
+            gc.collect()
+
+        self.assertEqual((Cache._n_objects, Cache._n_live, Cache._peak_live), (2, 0, 2))
+        self.assertEqual(set(Cache._member_profiles), {'get', 'make', 'name'})
+        self.assertEqual(Cache._member_profiles['make'].total_stats.count, 1)
+        breakdown = Profiler.instance_breakdown(Cache)
+        self.assertEqual(breakdown[1], {'get': (3, 6 * 10**9, 6 * 10**9)})
+        self.assertEqual(breakdown[2]['get'][:2], (1, 10**9))
+
+    def test_profile_class_include(self):
+        @Profiler.profile_class(include=['__eq__', 'mf'])
+        class Included(object):
+            def mf(self):
+                pass
+
+            def other(self):
+                pass
+
+        self.assertTrue(Included() != Included())
+        self.assertEqual(set(Included._member_profiles), {'__eq__', 'mf'})
+        self.assertEqual(Included._member_profiles['__eq__'].total_stats.count, 2)
+
+    def test_profile_class_builtin_base(self):
+        @Profiler.profile_class
+        class Cache(dict):
+            def lookup(self, key):
+                return self.get(key)
+
+        cache = Cache(a=1)
+        self.assertEqual(cache.lookup('a'), 1)
+        self.assertEqual(set(Cache._member_profiles), {'lookup'})
+
+        @Profiler.profile_class(include=['get', 'lookup'])
+        class IncludedCache(Cache):
+            pass
+
+        self.assertEqual(IncludedCache(a=2).lookup('a'), 2)
+        self.assertEqual(set(IncludedCache._member_profiles), {'get', 'lookup'})
+        self.assertEqual(IncludedCache._member_profiles['get'].total_stats.count, 1)
+
+
+class ExceptionTests(unittest.TestCase):
+    def test_failures(self):
+        def wait(seconds):
+            time.sleep(seconds)
+            raise TimeoutError()
+
+        with VirtualClock():
+            @Profiler.profile
+            def flaky(n):
+                time.sleep(1)
+                if n % 2:
+                    flaky.profile.subcall(wait)(5)
+                if n % 3 == 0:
+                    flaky.profile.exclude(wait)(7)
+                return n
+
+            @Profiler.profile
+            def outer():
+                for n in range(6):
+                    try:
+                        flaky(n)
+                    except TimeoutError:
+                        pass
+                time.sleep(1)
+
+            outer()
+
+        profile = flaky.profile
+        self.assertEqual(profile.total_stats.count, 6)
+        self.assertEqual((profile.ok_stats.count, profile.error_stats.count), (2, 4))
+        self.assertEqual(profile.error_stats.total, (8 + 3 * 6) * 10**9)
+        self.assertEqual(profile.ok_stats.max, 10**9)
+        self.assertEqual(profile.exceptions, {'TimeoutError': 4})
+        self.assertEqual(profile.subcalls[wait.__qualname__].count, 3)
+        self.assertEqual(profile.self_stats.total, 6 * 10**9)
+        # outer's stack and self time are intact
+        self.assertEqual(outer.profile.self_stats.total, 10**9)
+        self.assertEqual(set(outer.profile.callers), {None})
+
+    def test_coroutine_failures(self):
+        @Profiler.profile
+        async def failing():
+            await asyncio.sleep(1)
+            raise ValueError()
+
+        @Profiler.profile
+        async def cancelled():
+            await asyncio.sleep(100)
+
+        async def run():
+            task = asyncio.ensure_future(cancelled())
+            with self.assertRaises(ValueError):
+                await failing()
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        with VirtualClock():
+            asyncio.run(run())
+
+        self.assertEqual(failing.profile.exceptions, {'ValueError': 1})
+        self.assertEqual(failing.profile.error_stats.total, 10**9)
+        self.assertEqual(cancelled.profile.exceptions, {'CancelledError': 1})
+
+    def test_member_failures(self):
+        @Profiler.profile_class
+        class Failing(object):
+            def mf(self):
+                raise KeyError()
+
+        with self.assertRaises(KeyError):
+            Failing().mf()
+        self.assertEqual(Failing._member_profiles['mf'].exceptions, {'KeyError': 1})
+
+
+class MemoryTests(unittest.TestCase):
+    def tearDown(self):
+        tracemalloc.stop()
+
+    def test_memory(self):
+        retained = []
+
+        @Profiler.profile(memory=True)
+        def allocating():
+            temporary = bytearray(10**6)
+            del temporary
+            retained.append(bytearray(10**5))
+
+        @Profiler.profile
+        def unmonitored():
+            allocating()
+
+        @Profiler.profile(memory=True)
+        def parent():
+            unmonitored()
+            gc.collect()
+            retained.append(bytearray(10**4))
+
+        parent()
+        parent()
+
+        peak_stats, net_stats = allocating.profile.peak_stats, allocating.profile.net_stats
+        self.assertEqual(peak_stats.count, 2)
+        self.assertGreaterEqual(peak_stats.min, 10**6)
+        self.assertLess(peak_stats.max, 2 * 10**6)
+        self.assertGreaterEqual(net_stats.min, 10**5)
+        self.assertLess(net_stats.max, 2 * 10**5)
+
+        # The peak of the callee is the peak of the caller too
+        self.assertGreaterEqual(parent.profile.peak_stats.min, 10**6)
+        self.assertGreaterEqual(parent.profile.net_stats.min, 10**5 + 10**4)
+        self.assertGreaterEqual(parent.profile.gc_stats.total, 2)
+        self.assertEqual(unmonitored.profile.peak_stats.count, 0)
+
+        allocating.profile.close()
+        self.assertTrue(tracemalloc.is_tracing())
+        self.assertIn(profiler._on_gc, gc.callbacks)
+        parent.profile.close()
+        parent.profile.close()
+        self.assertFalse(tracemalloc.is_tracing())
+        self.assertNotIn(profiler._on_gc, gc.callbacks)
+        # Closed profiles keep their stats and time calls
+        parent()
+        self.assertEqual((parent.profile.total_stats.count, parent.profile.peak_stats.count), (3, 2))
+
+    def test_memory_tracing_started_elsewhere(self):
+        tracemalloc.start()
+        try:
+            @Profiler.profile(memory=True)
+            def allocating():
+                return bytearray(10**4)
+
+            allocating()
+            Profiler.close_memory()
+            self.assertFalse(allocating.profile.memory)
+            self.assertNotIn(profiler._on_gc, gc.callbacks)
+            self.assertTrue(tracemalloc.is_tracing())
+        finally:
+            tracemalloc.stop()
+
+
+class LineTests(unittest.TestCase):
+    def test_lines(self):
+        def helper():
+            time.sleep(1)
+
+        with VirtualClock():
+            @Profiler.profile(lines=True)
+            def lined(n):
+                total = 0
+                for i in range(n):
+                    total += i
+                helper()
+                if n:
+                    lined(n - 1)
+                return total
+
+            lined(3)
+
+        first = inspect.getsourcelines(lined.profile.fn)[1]
+        line_stats = lined.profile.line_stats
+        self.assertEqual(line_stats[first + 2][0], 4)      # total = 0
+        self.assertEqual(line_stats[first + 4][0], 6)      # total += i
+        self.assertEqual(line_stats[first + 5], (4, 4 * 10**9))  # helper()
+        self.assertEqual(line_stats[first + 7][0], 3)      # lined(n - 1)
+        self.assertIsNone(sys.gettrace())
+        self.assertIn('helper()', Profiler.annotate(lined))
+
+    def test_plain_functions_only(self):
+        async def coroutine():
+            pass
+
+        with self.assertRaises(ValueError):
+            Profiler.profile(coroutine, lines=True)
+
+
+class RegionTests(unittest.TestCase):
+    def tearDown(self):
+        Profiler.enable()
+
+    def test_regions(self):
+        with VirtualClock():
+            @Profiler.profile
+            def parsing():
+                with Profiler.region('parse'):
+                    time.sleep(1)
+                    with Profiler.region('tokenize'):
+                        time.sleep(2)
+                time.sleep(4)
+
+            parsing()
+            with self.assertRaises(KeyError):
+                with Profiler.region('parse'):
+                    raise KeyError()
+
+        parse = Profiler.region('parse').profile
+        tokenize = Profiler.region('tokenize').profile
+        self.assertEqual(parse.total_stats.count, 2)
+        self.assertEqual(parse.exceptions, {'KeyError': 1})
+        self.assertEqual(parse.ok_stats.total, 3 * 10**9)
+        self.assertEqual(parse.self_stats.total, 10**9)
+        self.assertEqual(tokenize.callers[parse].count, 1)
+        self.assertEqual(parse.callers[parsing.profile].count, 1)
+        self.assertEqual(parsing.profile.self_stats.total, 4 * 10**9)
+
+    def test_disable(self):
+        def plain():
+            return 1
+
+        Profiler.disable()
+        self.assertIs(Profiler.profile(plain), plain)
+        self.assertIs(Profiler.profile(reservoir=5)(plain), plain)
+        self.assertIs(plain.profile.subcall(len), len)
+        self.assertIs(Profiler.region('a'), Profiler.region('b'))
+
+        class Plain(object):
+            pass
+        self.assertIs(Profiler.profile_class(Plain), Plain)
+
+        Profiler.enable()
+        profiled = Profiler.profile(lambda: 1)
+        Profiler.disable()
+        profiled()
+        Profiler.enable()
+        profiled()
+        self.assertEqual(profiled.profile.total_stats.count, 1)
+
+    def test_disable_at_runtime(self):
+        @Profiler.profile
+        def uses_profile(n):
+            uses_profile.profile.exclude(time.sleep)(n)
+            return uses_profile.profile.subcall(len)('abc')
+
+        region = Profiler.region('disabled_region')
+        Profiler.disable()
+        try:
+            self.assertEqual(uses_profile(0), 3)
+            with Profiler.region('disabled_region'):
+                pass
+        finally:
+            Profiler.enable()
+        self.assertEqual(uses_profile.profile.total_stats.count, 0)
+        self.assertEqual(uses_profile.profile.subcalls, {})
+        self.assertEqual(region.profile.total_stats.count, 0)
+
+        # Outside of a call of the function, exclude and subcall call through
+        self.assertEqual(uses_profile.profile.subcall(len)('ab'), 2)
+        self.assertEqual(uses_profile.profile.subcalls, {})
+
+        # A region entered while enabled is finished when disabled meanwhile
+        with region:
+            Profiler.disable()
+        Profiler.enable()
+        with region:
+            pass
+        self.assertEqual(region.profile.total_stats.count, 2)
+        self.assertIsNone(profiler._current_call.get())
+
+    def test_environment(self):
+        code = 'import profiler, sys; sys.exit(0 if profiler.Profiler.profile(len) is len else 1)'
+        env = dict(os.environ, FUNKPY_PROFILE='0')
+        result = subprocess.run([sys.executable, '-c', code], env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+                                stdout=subprocess.DEVNULL)
+        self.assertEqual(result.returncode, 0)
+
+
+class OverheadTests(unittest.TestCase):
+    def tearDown(self):
+        Profiler.calibrate(enabled=False)
+
+    def test_calibration(self):
+        n = 2000
+
+        def work():
+            return sum(range(20))
+
+        def profiled_loop():
+            leaf = Profiler.profile(work)
+            def loop():
+                for _ in range(n):
+                    leaf()
+            root = Profiler.profile(loop)
+            for _ in range(3):
+                root()
+            return root.profile, leaf.profile
+
+        raw_root, raw_leaf = profiled_loop()
+        overhead = Profiler.calibrate()
+        self.assertGreater(overhead.call_inner + overhead.call_outer, 0)
+        root, leaf = profiled_loop()
+
+        # Wall clock comparisons are noisy, calibration must only not add time beyond a generous margin
+        margin = n * (overhead.call_inner + overhead.call_outer)
+        self.assertLess(root.total_stats.min, raw_root.total_stats.min + margin)
+        self.assertLess(leaf.total_stats.percentile(50), raw_leaf.total_stats.percentile(50) + overhead.call_inner)
+
+    def test_subtraction(self):
+        overhead = Profiler.calibrate()
+        profiler._overhead = _Overhead(call_inner=10, call_outer=5, subcall=0, calibrated=True)
+        try:
+            with VirtualClock():
+                @Profiler.profile
+                def calibrated_leaf():
+                    time.sleep(1)
+
+                @Profiler.profile
+                def calibrated_root():
+                    time.sleep(100)
+                    for _ in range(3):
+                        calibrated_leaf()
+
+                calibrated_root()
+        finally:
+            profiler._overhead = overhead
+
+        self.assertEqual(calibrated_leaf.profile.total_stats.total, 3 * (10**9 - 10))
+        # Inner and outer cost of each leaf call and the root's own inner cost
+        self.assertEqual(calibrated_root.profile.total_stats.total, 103 * 10**9 - 10 - 3 * 15)
+        self.assertEqual(calibrated_root.profile.self_stats.total, 100 * 10**9 - 10 - 3 * 5)
+
+    def test_lazy(self):
+        code = ('import profiler\n'
+                '@profiler.Profiler.profile\n'
+                'def f(): pass\n'
+                'import sys\n'
+                'assert not profiler._overhead.calibrated and \'inspect\' not in sys.modules\n'
+                'f()\n'
+                'assert profiler._overhead.calibrated and f.profile.total_stats.count == 1\n')
+        result = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(result.returncode, 0)
+
+
+class SnapshotTests(unittest.TestCase):
+    def test_merge_snapshots(self):
+        with VirtualClock():
+            @Profiler.profile
+            def snapshot_fn(n):
+                time.sleep(n)
+
+            for n in range(1, 101):
+                snapshot_fn(n)
+
+        snapshot = Profiler.snapshot()
+        profile = snapshot['functions'][snapshot_fn.profile.name]
+        self.assertEqual(profile['total']['count'], 100)
+        self.assertAlmostEqual(profile['total']['percentiles']['p99'], 99 * 10**9, delta=3 * 10**9)
+
+        merged = Profiler.merge_snapshots([json.loads(json.dumps(snapshot))] * 3)
+        merged_profile = merged['functions'][snapshot_fn.profile.name]
+        self.assertEqual(merged_profile['total']['count'], 300)
+        self.assertEqual(merged_profile['total']['max'], 100 * 10**9)
+        self.assertEqual(merged_profile['total']['percentiles']['p50'], profile['total']['percentiles']['p50'])
+
+    def test_reset(self):
+        @Profiler.profile(reservoir=5)
+        def first():
+            pass
+
+        @Profiler.profile
+        def second():
+            first()
+
+        second()
+        generation = profiler._generation
+        reset = Profiler.reset()
+        self.assertIsNot(profiler._generation, generation)
+        self.assertEqual(reset['functions'][first.profile.name]['total']['count'], 1)
+        self.assertEqual(reset['functions'][second.profile.name]['total']['count'], 1)
+        self.assertEqual((first.profile.total_stats.count, second.profile.total_stats.count), (0, 0))
+        self.assertEqual(first.profile.reservoir.seen, 0)
+
+        second()
+        detached = first.profile.reset()
+        first()
+        self.assertEqual((detached.total_stats.count, detached.reservoir.seen), (1, 1))
+        self.assertEqual(detached.callers[second.profile].count, 1)
+        self.assertEqual((first.profile.total_stats.count, second.profile.total_stats.count), (1, 1))
+
+    def test_json_report(self):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            Profiler.report(format='json')
+        self.assertEqual(set(json.loads(output.getvalue())), {'functions', 'classes'})
+
+
+class StatsServerTests(unittest.TestCase):
+    def test_http(self):
+        import http.client
+
+        with VirtualClock():
+            @Profiler.profile
+            def served(n):
+                time.sleep(n)
+
+            served(1)
+
+        def get(conn, method, url):
+            conn.request(method, url)
+            response = conn.getresponse()
+            return response.status, response.read().decode()
+
+        with StatsServer() as server:
+            conn = http.client.HTTPConnection(*server.address)
+            status, body = get(conn, 'GET', '/stats')
+            self.assertEqual(status, 200)
+            self.assertEqual(json.loads(body)['functions'][served.profile.name]['total']['count'], 1)
+
+            status, body = get(conn, 'GET', '/delta')
+            self.assertEqual(json.loads(body)['functions'][served.profile.name]['total']['count'], 1)
+            with VirtualClock():
+                served(2)
+                served(3)
+            delta = json.loads(get(conn, 'GET', '/delta')[1])['functions'][served.profile.name]['total']
+            self.assertEqual((delta['count'], delta['total']), (2, 5 * 10**9))
+            self.assertLess(abs(delta['max'] - 3 * 10**9), 10**8)
+
+            status, body = get(conn, 'GET', '/metrics')
+            label = 'function="{}"'.format(served.profile.name)
+            self.assertIn('funkpy_calls_total{{{}}} 3'.format(label), body.splitlines())
+            self.assertIn('funkpy_call_seconds_sum{{{}}} 6.0'.format(label), body.splitlines())
+
+            status, body = get(conn, 'POST', '/reset')
+            self.assertEqual(json.loads(body)['functions'][served.profile.name]['total']['count'], 3)
+            self.assertEqual(served.profile.total_stats.count, 0)
+            self.assertEqual(get(conn, 'GET', '/missing')[0], 404)
+            conn.close()
+
+    def test_unix_socket(self):
+        path = os.path.join(tempfile.mkdtemp(), 'stats.sock')
+        with StatsServer(path=path):
+            with socket.socket(socket.AF_UNIX) as sock:
+                sock.connect(path)
+                sock.sendall(b'GET /stats HTTP/1.0\r\n\r\n')
+                response = b''
+                while True:
+                    chunk = sock.recv(65536)
+                    if not chunk: break
+                    response += chunk
+        head, _, body = response.partition(b'\r\n\r\n')
+        self.assertTrue(head.startswith(b'HTTP/1.0 200'))
+        self.assertEqual(set(json.loads(body)), {'functions', 'classes'})
+        self.assertFalse(os.path.exists(path))
+        os.rmdir(os.path.dirname(path))
+
+
+class ConcurrencyTests(unittest.TestCase):
+    def test_threads(self):
+        @Profiler.profile
+        def inner():
+            time.sleep(0.001)
+
+        @Profiler.profile
+        def outer():
+            for _ in range(5):
+                inner()
+
+        barrier = threading.Barrier(4)
+        def worker():
+            barrier.wait()
+            for _ in range(20):
+                outer()
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+
+        self.assertEqual(outer.profile.total_stats.count, 80)
+        self.assertEqual(inner.profile.total_stats.count, 400)
+        self.assertEqual(inner.profile.callers[outer.profile].count, 400)
+        self.assertEqual(set(outer.profile.callers), {None})
+        # self time of outer excludes inner calls of the same thread only
+        self.assertLess(outer.profile.self_stats.total, inner.profile.total_stats.total / 10)
+
+    def test_tasks(self):
+        @Profiler.profile
+        async def child(n):
+            await asyncio.sleep(n)
+            time.sleep(1)
+
+        @Profiler.profile
+        async def parent(n):
+            await asyncio.gather(child(n), child(n))
+
+        async def run():
+            await asyncio.gather(parent(10), parent(20))
+
+        with VirtualClock():
+            asyncio.run(run())
+
+        child_stats = child.profile.total_stats
+        self.assertEqual(child_stats.count, 4)
+        self.assertEqual(child.profile.callers[parent.profile].count, 4)
+        self.assertEqual(child.profile.cpu_stats.total, 4 * 10**9)
+        self.assertGreaterEqual(child_stats.min, 11 * 10**9)
+        self.assertEqual(parent.profile.total_stats.count, 2)
+        self.assertGreater(parent.profile.self_stats.min, 10 * 10**9)
+        self.assertEqual(set(parent.profile.callers), {None})
+
+    def test_task_lookups(self):
+        @Profiler.profile
+        def work():
+            time.sleep(1)
+
+        async def other():
+            work()
+
+        @Profiler.profile
+        async def spawner():
+            # The other task calls work while spawner awaits
+            task = asyncio.ensure_future(other())
+            work()
+            await asyncio.sleep(5)
+            await task
+
+        owner = profiler._owner
+        lookups = []
+        def counted_owner():
+            lookups.append(1)
+            return owner()
+        profiler._owner = counted_owner
+        try:
+            with VirtualClock():
+                work()
+                self.assertEqual(lookups, [])
+                asyncio.run(spawner())
+        finally:
+            profiler._owner = owner
+        # The coroutine and the calls below it tell tasks apart
+        self.assertEqual(len(lookups), 3)
+        self.assertEqual(spawner.profile.total_stats.count, 1)
+        # Only the call from spawner's own task is excluded from its self time
+        self.assertEqual(work.profile.callers[spawner.profile].count, 2)
+        self.assertEqual(work.profile.callers[None].count, 1)
+        self.assertEqual(spawner.profile.total_stats.total, 6 * 10**9)
+        self.assertEqual(spawner.profile.self_stats.total, 5 * 10**9)
+
+
+def _spin(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+class SamplingTests(unittest.TestCase):
+    def test_thread_sampling(self):
+        @Profiler.profile(instrument=False)
+        def hot():
+            _spin(0.2)
+
+        @Profiler.profile
+        def outer():
+            hot()
+
+        Profiler.start_sampling(rate=1000)
+        try:
+            ts = time.perf_counter()
+            outer()
+            elapsed = time.perf_counter() - ts
+        finally:
+            Profiler.stop_sampling()
+
+        # Fewer samples than requested are taken (GIL switch interval), seconds stay right
+        sampled = hot.profile.self_samples * profiler._sampler.seconds_per_sample()
+        self.assertLess(abs(sampled - elapsed), elapsed * 0.4)
+        self.assertEqual(hot.profile.total_stats.count, 0)
+        self.assertGreater(hot.profile.self_samples, 20)
+        self.assertGreaterEqual(outer.profile.samples, hot.profile.self_samples)
+        self.assertLess(outer.profile.self_samples, hot.profile.self_samples)
+
+    @unittest.skipUnless(hasattr(signal, 'setitimer'), 'requires setitimer')
+    def test_signal_sampling(self):
+        @Profiler.profile(instrument=False)
+        def hot():
+            _spin(0.2)
+
+        Profiler.start_sampling(rate=1000, mode='signal')
+        try:
+            hot()
+        finally:
+            Profiler.stop_sampling()
+        self.assertGreater(hot.profile.self_samples, 20)
+        self.assertEqual(signal.getitimer(signal.ITIMER_PROF), (0., 0.))
+
+
+    def test_sample_cost(self):
+        @Profiler.profile(instrument=False)
+        def sampled_outer(depth):
+            return sampled_outer(depth - 1) if depth else sys._getframe()
+
+        def walk(frame):
+            while frame is not None:
+                frame = frame.f_back
+
+        frame = sampled_outer(30)
+        sampler = profiler._Sampler(1000, 'signal')
+        n = 2000
+        costs, walks = [], []
+        for _ in range(5):
+            costs.append(_timed(lambda: [sampler.sample(frame) for _ in range(n)]))
+            walks.append(_timed(lambda: [walk(frame) for _ in range(n)]))
+        # Relative to a bare walk of the same frames timed alongside, 5-8 times on a quiet machine.
+        # Generous for noisy ones, a sample must stay a cheap walk (no per-frame allocation or hashing)
+        self.assertLess(min(costs), 20 * min(walks))
+        self.assertEqual(sampled_outer.profile.self_samples, 5 * n)
+
+        # Profiled frames beyond max_depth from the innermost one are not seen
+        def plain(depth):
+            return plain(depth - 1) if depth else sys._getframe()
+
+        @Profiler.profile(instrument=False)
+        def capped_outer():
+            return plain(10)
+
+        frame = capped_outer()
+        self.assertIsNone(profiler._Sampler(1000, 'signal', max_depth=5).sample(frame))
+        self.assertIs(sampler.sample(frame), capped_outer.profile)
+
+        # Frames walked per sample
+        walked = []
+        class CountedFrame(object):
+            def __init__(self, frame):
+                self.f_code = frame.f_code
+                self._frame = frame
+
+            @property
+            def f_back(self):
+                walked.append(self)
+                back = self._frame.f_back
+                return CountedFrame(back) if back is not None else None
+
+        profiler._Sampler(1000, 'signal', max_depth=5).sample(CountedFrame(frame))
+        self.assertEqual(len(walked), 5)
+        del walked[:]
+        self.assertIs(profiler._Sampler(1000, 'signal', max_depth=12).sample(CountedFrame(frame)), capped_outer.profile)
+        self.assertEqual(len(walked), 12)
+
+
+def _timed(fn):
+    ts = time.perf_counter()
+    fn()
+    return time.perf_counter() - ts
+
+
+    def test_signal_off_main_thread(self):
+        errors = []
+        def start():
+            try:
+                Profiler.start_sampling(mode='signal')
+            except ValueError as e:
+                errors.append(e)
+        thread = threading.Thread(target=start)
+        thread.start()
+        thread.join()
+        self.assertEqual(len(errors), 1)
+        self.assertFalse(profiler._sampler is not None and profiler._sampler.running)
+
+
+class TraceTests(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_trace(self):
+        def wait():
+            pass
+
+        @Profiler.profile
+        def traced_leaf():
+            traced_leaf.profile.subcall(wait)()
+            traced_leaf.profile.exclude(wait)()
+
+        @Profiler.profile
+        async def traced_task():
+            traced_leaf()
+            await asyncio.sleep(0)
+            traced_leaf()
+
+        async def run():
+            await asyncio.gather(traced_task(), traced_task())
+
+        Profiler.start_trace(self.path)
+        try:
+            thread = threading.Thread(target=traced_leaf, name='worker')
+            thread.start()
+            thread.join()
+            asyncio.run(run())
+        finally:
+            self.assertEqual(Profiler.stop_trace(), 0)
+
+        with open(self.path) as f:
+            events = json.load(f)
+        names = {e['tid']: e['args']['name'] for e in events if e['ph'] == 'M'}
+        self.assertEqual(len(names), 3)
+        self.assertIn('worker', names.values())
+
+        stacks = {tid: [] for tid in names}
+        for event in events:
+            if event['ph'] == 'B':
+                stacks[event['tid']].append(event['name'])
+            elif event['ph'] == 'E':
+                self.assertEqual(stacks[event['tid']].pop(), event['name'])
+        self.assertEqual(list(stacks.values()), [[]] * 3)
+
+        categories = collections.Counter(e['cat'] for e in events if e['ph'] == 'B')
+        self.assertEqual(categories, {'call': 7, 'subcall': 5, 'excluded': 5})
+
+    def test_bounded_queue(self):
+        @Profiler.profile
+        def traced_fast():
+            pass
+
+        Profiler.start_trace(self.path, max_queue=10)
+        try:
+            for _ in range(1000):
+                traced_fast()
+        finally:
+            dropped = Profiler.stop_trace()
+        self.assertGreater(dropped, 0)
+
+        with open(self.path) as f:
+            events = json.load(f)
+        self.assertEqual(len([e for e in events if e['ph'] != 'M']) + dropped, 2000)
+
+
+class CallGraphTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with VirtualClock():
+            @Profiler.profile
+            def leaf():
+                time.sleep(1)
+
+            @Profiler.profile
+            def recursive(n):
+                time.sleep(1)
+                if n:
+                    recursive(n - 1)
+                leaf()
+
+            @Profiler.profile
+            def root():
+                time.sleep(2)
+                leaf()
+                recursive(1)
+
+            root()
+        cls.leaf, cls.recursive, cls.root = leaf.profile, recursive.profile, root.profile
+
+    def test_edges(self):
+        self.assertEqual(self.root.self_stats.total, 2 * 10**9)
+        self.assertEqual(self.root.total_stats.total, 7 * 10**9)
+        self.assertEqual(set(self.leaf.callers), {self.root, self.recursive})
+        self.assertEqual(self.leaf.callers[self.recursive].count, 2)
+        self.assertEqual(self.leaf.callers[self.recursive].self_time, 2 * 10**9)
+
+        self_edge = self.recursive.callers[self.recursive]
+        self.assertEqual((self_edge.count, self_edge.primitive), (1, 0))
+        root_edge = self.recursive.callers[self.root]
+        self.assertEqual((root_edge.primitive, root_edge.total_time), (1, 4 * 10**9))
+        self.assertEqual(self.root.callers[None].count, 1)
+
+    def test_mutual_recursion(self):
+        @Profiler.profile
+        def ping(n):
+            if n:
+                pong(n - 1)
+
+        @Profiler.profile
+        def pong(n):
+            if n:
+                ping(n - 1)
+
+        ping(4)
+        ping(4)
+        # ping -> pong is primitive once per top-level call, deeper calls are recursive
+        ping_edge = pong.profile.callers[ping.profile]
+        self.assertEqual((ping_edge.count, ping_edge.primitive), (4, 2))
+        self.assertEqual(ping.profile.callers[pong.profile].primitive, 0)
+        # Call path nodes are shared by repeated calls along the same path
+        root = profiler._ROOT_PATH.children[ping.profile]
+        self.assertEqual(root.names(), (ping.profile.name,))
+        self.assertIs(root.children[pong.profile].children[ping.profile].parent.parent, root)
+
+    def test_exports(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            Profiler.write_collapsed(path)
+            with open(path) as f:
+                lines = f.read().splitlines()
+            root, recursive, leaf = self.root.name, self.recursive.name, self.leaf.name
+            self.assertIn('{};{};{};{} {}'.format(root, recursive, recursive, leaf, 10**9), lines)
+            self.assertIn('{} {}'.format(root, 2 * 10**9), lines)
+
+            Profiler.dump_stats(path)
+            stats = pstats.Stats(path).stats
+            entry = [v for k, v in stats.items() if k[2] == recursive][0]
+            self.assertEqual(entry[:4], (1, 2, 2., 4.))
+            recursive_key = [k for k in stats if k[2] == recursive][0]
+            root_key = [k for k in stats if k[2] == root][0]
+            self.assertEqual(entry[4][recursive_key][:2], (1, 0))
+            self.assertEqual(entry[4][root_key][:2], (1, 1))
+        finally:
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
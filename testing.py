@@ -1,13 +1,39 @@
 from functools import (update_wrapper, wraps)
-try:
-    from typesafe import Typesafe, Typesafe_mf
-except ImportError:
-    Typesafe = lambda f: f
 
 import functools
+import itertools
+import os
+import sys
+import time
 import typing
 from copy import deepcopy
 
+if typing.TYPE_CHECKING:
+    from typesafe import Typesafe, Typesafe_mf
+
+def __getattr__(name):
+    """Typesafe and Typesafe_mf from typesafe.py, imported on first use rather than with testing."""
+    if name not in ('Typesafe', 'Typesafe_mf'):
+        raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+    try:
+        import typesafe
+        value = getattr(typesafe, name)
+    except ImportError:
+        value = lambda f: f
+    globals()[name] = value
+    return value
+
+def _typesafe(fn):
+    """Typesafe applied on the first call rather than with testing."""
+    wrapped = []
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not wrapped:
+            wrapped.append(__getattr__('Typesafe')(fn))
+        return wrapped[0](*args, **kwargs)
+    return wrapper
+
 def _namedtuple(name, *fields):
     class Object(object):
         _fields = []
@@ -41,68 +67,417 @@ def _namedtuple(name, *fields):
 
     return Object
 
-_suite_result = _namedtuple('suite_result', 'passed', 'total', 'fails')
-_test_case_data = _namedtuple('test_case_data', 'case_name', 'case_details', 'case_fn')
+_suite_result = _namedtuple('suite_result', 'passed', 'total', 'fails', 'skipped')
+_test_case_data = _namedtuple('test_case_data', 'case_name', 'case_details', 'case_fn', 'is_async', 'timeout')
 _test_case_fail_result = _namedtuple('test_case_fail_result', 'case_name', 'fail_reason')
 
 TestResult = _namedtuple('TestResult', 'passed', 'fail_reason')
 Fail = lambda reason: TestResult(passed=False, fail_reason=reason)
 Success = lambda: TestResult(passed=True, fail_reason=None)
 
-@Typesafe
-def _print_suite_result(result: _suite_result):
+@_typesafe
+def _print_suite_result(result: _suite_result, slowest: list = ()):
+    """Prints fails, slowest (case name, wall seconds, CPU seconds or None) cases and the pass count."""
     print('')
     for fail_msg in result.fails:
         print(fail_msg)
+    if slowest:
+        print('\nslowest {} cases:'.format(len(slowest)))
+        for case_name, wall, cpu in slowest:
+            print('  {:.3f}s {} {}'.format(wall, 'cpu {:.3f}s'.format(cpu) if cpu is not None else 'async', case_name))
+    if result.skipped:
+        print('\nskipped {} unchanged cases that passed before: {}'.format(len(result.skipped), ', '.join(result.skipped)))
     print('\n{}/{} tests passed'.format(result.passed, result.total))
 
 
+def _check_result(result):
+    """(passed, fail reason) of TestResult returned by a case."""
+    if result is None or result.passed:
+        return True, None
+    return False, result.fail_reason
+
+def _run_case(tc, trace=False):
+    """(passed, fail reason, wall seconds, CPU seconds, source files) of a single case.
+
+    With trace, source files are those of the Python functions called (and modules imported) by the
+    case from its thread, otherwise None.
+    """
+    files = set() if trace else None
+
+    def on_call(frame, event, arg):
+        if event == 'call':
+            files.add(frame.f_code.co_filename)
+
+    ts = time.perf_counter()
+    cpu_ts = time.thread_time()
+    previous = sys.getprofile()
+    try:
+        if trace:
+            sys.setprofile(on_call)
+        try:
+            result = tc.case_fn()
+        finally:
+            if trace:
+                sys.setprofile(previous)
+        passed, fail_reason = _check_result(result)
+    except Exception as e:
+        passed, fail_reason = False, 'exception thrown: {}'.format(e)
+    return passed, fail_reason, time.perf_counter() - ts, time.thread_time() - cpu_ts, files
+
+class _CaseTimeout(Exception):
+    """An async def case ran past its timeout."""
+
+async def _run_async_case(tc, semaphore):
+    """_run_case for async def cases, wall time starts once the case gets past semaphore.
+
+    Cases share the loop thread, CPU time of one is not told apart from the others and is None.
+    """
+    import asyncio
+
+    async with semaphore:
+        ts = time.perf_counter()
+        try:
+            if tc.timeout is None:
+                result = await tc.case_fn()
+            else:
+                # Not wait_for: a TimeoutError raised by the case itself must not read as the case timing out
+                task = asyncio.ensure_future(tc.case_fn())
+                done, _ = await asyncio.wait({task}, timeout=tc.timeout)
+                if not done:
+                    task.cancel()
+                    await asyncio.wait({task})
+                    raise _CaseTimeout()
+                result = task.result()
+            passed, fail_reason = _check_result(result)
+        except _CaseTimeout:
+            passed, fail_reason = False, 'timed out after {}s'.format(tc.timeout)
+        except asyncio.CancelledError:
+            # Not an Exception: cancelling the run goes through (told apart on 3.11+),
+            # a case cancelled from within fails
+            cancelling = getattr(asyncio.current_task(), 'cancelling', None)
+            if cancelling is not None and cancelling():
+                raise
+            passed, fail_reason = False, 'cancelled'
+        except Exception as e:
+            passed, fail_reason = False, 'exception thrown: {}'.format(e)
+        return passed, fail_reason, time.perf_counter() - ts, None, None
+
+# Suite run by forked workers, they look cases up by index instead of unpickling them
+_forked_suite = None
+
+def _run_forked_case(index, trace):
+    return _run_case(_forked_suite.test_cases[index], trace)
+
+
+def _load_section(path, section):
+    """section of JSON file at path, empty when there is no file yet."""
+    import json
+    try:
+        with open(path) as f:
+            return json.load(f).get(section, {})
+    except FileNotFoundError:
+        return {}
+
+def _save_section(path, section, value):
+    """Replaces section of JSON file at path, other sections are kept."""
+    import json
+    try:
+        with open(path) as f:
+            sections = json.load(f)
+    except FileNotFoundError:
+        sections = {}
+    sections[section] = value
+    # Replaced whole, an interrupted run does not leave a truncated file behind
+    with open(path + '.tmp', 'w') as f:
+        json.dump(sections, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+def _referenced_files(fn):
+    """Source files of the modules fn refers to by global name, read from or called.
+
+    Covers modules (helper_mod.LIMIT) and functions and classes defined in other modules,
+    also from nested functions. Values bound by `from module import CONSTANT` cannot be traced
+    back to their module.
+    """
+    files = set()
+    code = getattr(fn, '__code__', None)
+    fn_globals = getattr(fn, '__globals__', {})
+    codes = [code] if code is not None else []
+    while codes:
+        code = codes.pop()
+        codes.extend(const for const in code.co_consts if hasattr(const, 'co_names'))
+        for name in code.co_names:
+            if name not in fn_globals:
+                continue
+            value = fn_globals[name]
+            module = value if isinstance(value, type(sys)) else sys.modules.get(getattr(value, '__module__', None) or '')
+            path = getattr(module, '__file__', None)
+            if path is not None:
+                files.add(path)
+    return files
+
+def _source_files(files):
+    """Absolute paths of files outside the standard library and installed packages, which are not fingerprinted."""
+    import sysconfig
+    paths = sysconfig.get_paths()
+    library = tuple(os.path.join(os.path.abspath(paths[name]), '') for name in ('stdlib', 'platstdlib', 'purelib', 'platlib'))
+    sources = (os.path.abspath(path) for path in files if not path.startswith('<'))
+    return {path for path in sources if not path.startswith(library)}
+
+def _file_hash(path, hashes):
+    """Hex digest of the file at path, None if it is gone, memoized in hashes."""
+    if path not in hashes:
+        import hashlib
+        try:
+            with open(path, 'rb') as f:
+                hashes[path] = hashlib.sha256(f.read()).hexdigest()
+        except OSError:
+            hashes[path] = None
+    return hashes[path]
+
+def _fingerprint(tc, files, hashes):
+    """Hex digest of the code and details of case and of the sources in files, None if it cannot be taken."""
+    import hashlib
+    import marshal
+    code = getattr(tc.case_fn, '__code__', None)
+    if code is None:
+        return None
+    digest = hashlib.sha256(marshal.dumps(code))
+    digest.update(tc.case_details.encode())
+    for path in sorted(files):
+        file_hash = _file_hash(path, hashes)
+        if file_hash is None:
+            return None
+        digest.update('\0{}\0{}'.format(path, file_hash).encode())
+    return digest.hexdigest()
+
+def _cache_enabled():
+    return os.environ.get('FUNKPY_TEST_CACHE', '1').lower() not in ('0', 'false', 'no', 'off')
+
+
+_ORDERS = (None, 'longest', 'failed-first')
+
+
 class TestSuite(object):
-    def __init__(self, suite_name):
+    """Collection of test cases registered with TestCase.
+
+    Usage:
+        ts = TestSuite('db', timings_path='.testing_timings.json', cache_path='.testing_cache.json')
+
+        @TestCase(ts, 'reads back a written key')
+        def test_get(): ...
+
+        ts.run_tests(jobs=8, order='failed-first', slowest=10)
+
+    Args:
+        suite_name: name prefixed to reported fails
+        timings_path: JSON file keeping the timings of each case across runs, shared by suites,
+                      timings are only kept for the lifetime of the suite without it
+        cache_path: JSON file of fingerprints of passed cases, shared by suites. Cases are traced
+                    for the source files they call into, and skipped while neither their code nor
+                    those files (outside the standard library and installed packages) changed.
+                    Set FUNKPY_TEST_CACHE=0 or pass use_cache=False to run_tests to run everything.
+    """
+    def __init__(self, suite_name, timings_path=None, cache_path=None):
         self.suite_name = suite_name
         self.test_cases = []
+        self.timings_path = timings_path
+        self.cache_path = cache_path
+        # {case name: {'wall': seconds, 'cpu': seconds or None, 'passed': bool}} of the last run of each case
+        self.timings = None
 
     def _register(self, fn):
         self.test_cases.append(fn)
 
-    def run_tests(self):
+    def _load_timings(self):
+        self.timings = {} if self.timings_path is None else _load_section(self.timings_path, self.suite_name)
+
+    def _save_timings(self):
+        if self.timings_path is not None:
+            _save_section(self.timings_path, self.suite_name, self.timings)
+
+    def _unchanged(self, cache, hashes):
+        """Indices of cases whose fingerprint matches the one they passed with."""
+        unchanged = set()
+        for index, tc in enumerate(self.test_cases):
+            entry = cache.get(tc.case_name)
+            if entry is not None and _fingerprint(tc, entry['files'], hashes) == entry['fingerprint']:
+                unchanged.add(index)
+        return unchanged
+
+    def _order(self, indices, order):
+        """indices sorted by order, see run_tests. Cases without timings count as the longest."""
+        if order is None:
+            return indices
+
+        def key(index):
+            timing = self.timings.get(self.test_cases[index].case_name)
+            failed = order == 'failed-first' and timing is not None and not timing['passed']
+            return (not failed, -(timing['wall'] if timing is not None else float('inf')))
+        return sorted(indices, key=key)
+
+    def run_tests(self, jobs=1, mode='process', concurrency=100, order=None, slowest=0, use_cache=True):
+        """Runs all cases, prints and returns _suite_result.
+
+        async def cases run after the others, all together on one event loop in this process.
+
+        Args:
+            jobs: number of cases run at once, cases run one after another with 1
+            mode: 'process' (forked worker processes) or 'thread' (worker threads in this process),
+                  ignored with jobs=1
+            concurrency: number of async def cases awaited at once
+            order: None for registration order with jobs=1 and 'longest' otherwise,
+                   'longest' starts the cases that took longest last time first,
+                   'failed-first' starts the cases that failed last time first, then as 'longest'
+            slowest: number of slowest cases to report
+            use_cache: skip cases cached as passed (see cache_path), False runs them and refreshes the cache
+        """
+        if mode not in ('process', 'thread'):
+            raise ValueError('unknown mode {}, expected process or thread'.format(mode))
+        if order not in _ORDERS:
+            raise ValueError('unknown order {}, expected one of {}'.format(order, _ORDERS))
+        if order is None and jobs != 1:
+            order = 'longest'
+        if self.timings is None:
+            self._load_timings()
+        trace = self.cache_path is not None
+        cache = _load_section(self.cache_path, self.suite_name) if trace else {}
+        hashes = {}
+        skipped = self._unchanged(cache, hashes) if use_cache and _cache_enabled() else set()
         tc_passed = 0
         tc_total = len(self.test_cases)
 
         fails = []
 
         print('\nRunning test suite {}'.format(self.suite_name))
-        for tc in self.test_cases:
-            print('  running {}...'.format(tc.case_name), end='')
-            try:
-                result = tc.case_fn()
-                if result is None or result.passed:
-                    tc_passed += 1
-                    print(' ok')
-                else:
-                    fails.append(_test_case_fail_result(case_name = tc.case_name, fail_reason = result.fail_reason))
-                    print(' fail')
-            except Exception as e:
-                fails.append(_test_case_fail_result(case_name = tc.case_name, fail_reason = 'exception thrown: {}'.format(e)))
-                print(' fail')
+        indices = self._order([index for index, tc in enumerate(self.test_cases)
+                               if not tc.is_async and index not in skipped], order)
+        async_indices = self._order([index for index, tc in enumerate(self.test_cases)
+                                     if tc.is_async and index not in skipped], order)
+        if jobs == 1:
+            outcomes = self._run_serial(indices, trace)
+        else:
+            outcomes = self._run_parallel(indices, jobs, mode, trace)
+        if async_indices:
+            outcomes = itertools.chain(outcomes, self._run_async(async_indices, concurrency))
+
+        tc_passed += len(skipped)
+        for index, (passed, fail_reason, wall, cpu, files) in outcomes:
+            tc = self.test_cases[index]
+            self.timings[tc.case_name] = {'wall': wall, 'cpu': cpu, 'passed': passed}
+            # Not traced (async def cases, the cache is off) or failed cases run again next time
+            fingerprint = None
+            if passed and files is not None:
+                files = _source_files(files | _referenced_files(tc.case_fn))
+                fingerprint = _fingerprint(tc, files, hashes)
+            if fingerprint is not None:
+                cache[tc.case_name] = {'fingerprint': fingerprint, 'files': sorted(files)}
+            else:
+                cache.pop(tc.case_name, None)
+            if passed:
+                tc_passed += 1
+            else:
+                fails.append((index, _test_case_fail_result(case_name = tc.case_name, fail_reason = fail_reason)))
+        # Reported in registration order whatever order the cases finished in
+        fails = [fail for _, fail in sorted(fails, key=lambda indexed: indexed[0])]
 
         result = _suite_result(
            passed = tc_passed,
            total = tc_total,
-           fails = ['{}.{} failed: {}'.format(self.suite_name, fail.case_name, fail.fail_reason) for fail in fails])
-        _print_suite_result(result)
+           fails = ['{}.{} failed: {}'.format(self.suite_name, fail.case_name, fail.fail_reason) for fail in fails],
+           skipped = [self.test_cases[index].case_name for index in sorted(skipped)])
+        self._save_timings()
+        if trace:
+            _save_section(self.cache_path, self.suite_name, cache)
+
+        ran = {self.test_cases[index].case_name for index in itertools.chain(indices, async_indices)}
+        timings = sorted(((name, timing['wall'], timing['cpu']) for name, timing in self.timings.items() if name in ran),
+                         key=lambda timing: -timing[1])
+        _print_suite_result(result, timings[:slowest])
         return result
 
+    def _run_serial(self, indices, trace):
+        for index in indices:
+            tc = self.test_cases[index]
+            print('  running {}...'.format(tc.case_name), end='')
+            outcome = _run_case(tc, trace)
+            print(' ok' if outcome[0] else ' fail')
+            yield index, outcome
+
+    def _run_parallel(self, indices, jobs, mode, trace):
+        """Yields (index, outcome) as cases finish, cases are started in the order of indices."""
+        from concurrent import futures
+
+        global _forked_suite
+        if mode == 'thread':
+            executor = futures.ThreadPoolExecutor(max_workers=jobs)
+            submit = lambda index: executor.submit(_run_case, self.test_cases[index], trace)
+        else:
+            import multiprocessing
+            # Workers fork lazily from submit, after _forked_suite is set
+            _forked_suite = self
+            executor = futures.ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('fork'))
+            submit = lambda index: executor.submit(_run_forked_case, index, trace)
+
+        try:
+            pending = {submit(index): index for index in indices}
+            for future in futures.as_completed(pending):
+                index = pending[future]
+                try:
+                    outcome = future.result()
+                except Exception as e:
+                    # Worker process died, the case is reported as failed
+                    outcome = (False, 'exception thrown: {}'.format(e), 0., 0., None)
+                print('  {}... {}'.format(self.test_cases[index].case_name, 'ok' if outcome[0] else 'fail'))
+                yield index, outcome
+        finally:
+            executor.shutdown(cancel_futures=True)
+            _forked_suite = None
+
+    def _run_async(self, indices, concurrency):
+        """Yields (index, outcome) of async def cases, printed as they finish on a fresh event loop."""
+        import asyncio
+
+        async def run_all():
+            semaphore = asyncio.Semaphore(concurrency)
+            outcomes = []
+
+            async def run(index):
+                outcome = await _run_async_case(self.test_cases[index], semaphore)
+                print('  {}... {}'.format(self.test_cases[index].case_name, 'ok' if outcome[0] else 'fail'))
+                outcomes.append((index, outcome))
+
+            await asyncio.gather(*(run(index) for index in indices))
+            return outcomes
+
+        yield from asyncio.run(run_all())
+
 
 class TestCase(object):
-    def __init__(self, suite: TestSuite, case_details: str):
+    """Registers a test case in suite.
+
+    Cases are plain functions or async def functions, returning TestResult or None for success.
+
+    Args:
+        suite: TestSuite to register in
+        case_details: description of the case
+        timeout: seconds an async def case may take before it fails, None waits forever
+    """
+    def __init__(self, suite: TestSuite, case_details: str, timeout: float = None):
         self.suite = suite
         self.case_details = case_details
         self.case_name = ''
+        self.timeout = timeout
 
     def __call__(self, fn: typing.Callable[[], TestResult]) -> typing.Callable[[], TestResult]:
+        import inspect
+
+        is_async = inspect.iscoroutinefunction(fn)
+        if self.timeout is not None and not is_async:
+            raise ValueError('timeout is only supported for async def cases, {} is not one'.format(fn.__name__))
         self.case_name = fn.__name__
-        self.suite._register(_test_case_data(case_name = self.case_name, case_details = self.case_details, case_fn = fn))
+        self.suite._register(_test_case_data(case_name = self.case_name, case_details = self.case_details, case_fn = fn,
+                                             is_async = is_async, timeout = self.timeout))
         return fn
 
 
@@ -121,3 +496,8 @@ def assert_throws(fn, expected_exception):
         if str(expected_exception) and not str(e) == str(expected_exception):
             raise AssertionError('exception message "{}" does not match expected "{}"'.format(str(e), str(expected_exception)))
     return True
+
+# Typesafe names are resolved through __getattr__ on star import.
+# functools, typing, deepcopy, update_wrapper and wraps were always exported, typesafe_tests.py uses typing
+__all__ = ['TestResult', 'Fail', 'Success', 'TestSuite', 'TestCase', 'assert_equal', 'assert_throws',
+           'Typesafe', 'Typesafe_mf', 'functools', 'typing', 'deepcopy', 'update_wrapper', 'wraps']
@@ -61,3 +61,214 @@ def test_assert_throws():
         pass
 
 assertion_ts.run_tests()
+
+import time
+
+parallel_ts = TestSuite('parallel_tests')
+started = []
+
+def _sleeping_case(name, seconds, passed=True):
+    def case():
+        started.append(name)
+        time.sleep(seconds)
+        if not passed:
+            return Fail('{} failed'.format(name))
+    case.__name__ = name
+    TestCase(parallel_ts, 'sleeps {}'.format(seconds))(case)
+
+_sleeping_case('short', 0.05)
+_sleeping_case('failing', 0.1, passed=False)
+_sleeping_case('long', 0.4)
+_sleeping_case('medium', 0.2)
+
+for mode in ('thread', 'process'):
+    ts = time.perf_counter()
+    suite_result = parallel_ts.run_tests(jobs=4, mode=mode)
+    assert(time.perf_counter() - ts < 0.75)
+    assert(suite_result.passed == 3)
+    assert(suite_result.total == 4)
+    assert(suite_result.fails == ['parallel_tests.failing failed: failing failed'])
+
+# Serial runs keep registration order, parallel ones start the longest cases of the previous run first
+del started[:]
+parallel_ts.run_tests()
+assert(started == ['short', 'failing', 'long', 'medium'])
+del started[:]
+parallel_ts.run_tests(jobs=2, mode='thread')
+assert(sorted(started[:2]) == ['long', 'medium'])
+
+import asyncio
+
+async_ts = TestSuite('async_tests')
+running = [0, 0] # now, most at once
+
+async def _waiting_case():
+    running[0] += 1
+    running[1] = max(running)
+    await asyncio.sleep(0.2)
+    running[0] -= 1
+
+for i in range(6):
+    TestCase(async_ts, 'waits on a socket')(_waiting_case)
+
+@TestCase(async_ts, 'sync case in an async suite')
+def sync_case():
+    return Success()
+
+@TestCase(async_ts, 'async failure')
+async def async_fail():
+    return Fail('async reason')
+
+@TestCase(async_ts, 'hangs', timeout=0.1)
+async def async_hang():
+    await asyncio.sleep(10)
+
+@TestCase(async_ts, 'socket timeout of its own', timeout=5)
+async def async_own_timeout():
+    raise TimeoutError('socket timed out')
+
+@TestCase(async_ts, 'awaits a cancelled task')
+async def async_cancelled():
+    task = asyncio.ensure_future(asyncio.sleep(10))
+    task.cancel()
+    await task
+
+@TestCase(async_ts, 'cancelled with a timeout', timeout=5)
+async def async_cancelled_timeout():
+    raise asyncio.CancelledError()
+
+ts = time.perf_counter()
+suite_result = async_ts.run_tests(concurrency=3)
+assert(time.perf_counter() - ts < 1)
+assert(running[1] == 3)
+assert(suite_result.passed == 7)
+assert(suite_result.total == 12)
+assert(suite_result.fails == ['async_tests.async_fail failed: async reason', 'async_tests.async_hang failed: timed out after 0.1s',
+                              'async_tests.async_own_timeout failed: exception thrown: socket timed out',
+                              'async_tests.async_cancelled failed: cancelled', 'async_tests.async_cancelled_timeout failed: cancelled'])
+assert_throws(lambda: TestCase(async_ts, 'not async', timeout=1)(sync_case), ValueError())
+
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+
+with tempfile.TemporaryDirectory() as timings_dir:
+    timings_path = os.path.join(timings_dir, 'timings.json')
+    timed_ts = TestSuite('timed_tests', timings_path=timings_path)
+    order = []
+
+    @TestCase(timed_ts, 'fast')
+    def fast():
+        order.append('fast')
+
+    @TestCase(timed_ts, 'burns cpu')
+    def busy():
+        order.append('busy')
+        sum(range(300000))
+
+    @TestCase(timed_ts, 'fails')
+    def flaky():
+        order.append('flaky')
+        return Fail('flaky')
+
+    timed_ts.run_tests()
+    assert(order == ['fast', 'busy', 'flaky'])
+    with open(timings_path) as f:
+        timings = json.load(f)['timed_tests']
+    assert(sorted(timings) == ['busy', 'fast', 'flaky'])
+    assert(timings['busy']['cpu'] > 0)
+    assert(timings['flaky']['passed'] is False)
+
+    # Another suite object, as in the next run of the test script, orders by the saved timings
+    rerun_ts = TestSuite('timed_tests', timings_path=timings_path)
+    for fn in (fast, busy, flaky):
+        TestCase(rerun_ts, 'rerun')(fn)
+    del order[:]
+    rerun_ts.run_tests(order='longest')
+    assert(order[0] == 'busy')
+    del order[:]
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        rerun_ts.run_tests(order='failed-first', slowest=2)
+    assert(order[:2] == ['flaky', 'busy'])
+    assert('slowest 2 cases:' in output.getvalue())
+    assert_throws(lambda: rerun_ts.run_tests(order='random'), ValueError())
+
+with tempfile.TemporaryDirectory() as cache_dir:
+    cache_path = os.path.join(cache_dir, 'cache.json')
+    helper_path = os.path.join(cache_dir, 'cached_helper.py')
+    with open(helper_path, 'w') as f:
+        f.write('def value():\n    return 1\n')
+    constants_path = os.path.join(cache_dir, 'cached_constants.py')
+    with open(constants_path, 'w') as f:
+        f.write('LIMIT = 1\n')
+    sys.path.insert(0, cache_dir)
+    import cached_helper
+    import cached_constants
+
+    runs = []
+
+    def make_cached_suite():
+        cached_ts = TestSuite('cached_tests', cache_path=cache_path)
+
+        @TestCase(cached_ts, 'calls the helper')
+        def uses_helper():
+            runs.append('uses_helper')
+            assert_equal(cached_helper.value(), 1)
+
+        @TestCase(cached_ts, 'calls nothing')
+        def standalone():
+            runs.append('standalone')
+
+        @TestCase(cached_ts, 'only reads a module')
+        def reads_constant():
+            runs.append('reads_constant')
+            assert(cached_constants.LIMIT == 1)
+
+        @TestCase(cached_ts, 'always fails')
+        def failing():
+            runs.append('failing')
+            return Fail('failing')
+
+        return cached_ts
+
+    make_cached_suite().run_tests()
+    assert(runs == ['uses_helper', 'standalone', 'reads_constant', 'failing'])
+
+    # Unchanged passes are skipped, failures run again; skipped cases are not among the slowest
+    del runs[:]
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        suite_result = make_cached_suite().run_tests(slowest=5)
+    assert(runs == ['failing'])
+    assert(suite_result.skipped == ['uses_helper', 'standalone', 'reads_constant'])
+    assert(suite_result.passed == 3)
+    assert('slowest 1 cases:' in output.getvalue())
+
+    # A change to a called module reruns only the cases calling into it
+    with open(helper_path, 'a') as f:
+        f.write('# changed\n')
+    del runs[:]
+    suite_result = make_cached_suite().run_tests(jobs=2, mode='thread')
+    assert(sorted(runs) == ['failing', 'uses_helper'])
+    assert(suite_result.skipped == ['standalone', 'reads_constant'])
+
+    # So does a change to a module the case only reads from
+    with open(constants_path, 'a') as f:
+        f.write('# changed\n')
+    del runs[:]
+    suite_result = make_cached_suite().run_tests()
+    assert(runs == ['reads_constant', 'failing'])
+
+    del runs[:]
+    make_cached_suite().run_tests(use_cache=False)
+    assert(runs == ['uses_helper', 'standalone', 'reads_constant', 'failing'])
+    os.environ['FUNKPY_TEST_CACHE'] = '0'
+    del runs[:]
+    make_cached_suite().run_tests()
+    assert(runs == ['uses_helper', 'standalone', 'reads_constant', 'failing'])
+    del os.environ['FUNKPY_TEST_CACHE']
+    sys.path.remove(cache_dir)
@@ -1,6 +1,5 @@
 from functools import (update_wrapper, wraps)
 import typing
-import logging
 
 """Supported types:
 (most) builtins
@@ -9,8 +8,21 @@ typing.Dict
 typing.Callable
 """
 
-logging.basicConfig(level=logging.INFO)
-log = logging.getLogger("@typesafe")
+_log = None
+
+def _logger():
+    """logging is imported on the first checked call, handlers and levels are left to the application."""
+    global _log
+    if _log is None:
+        import logging
+        _log = logging.getLogger("@typesafe")
+    return _log
+
+def __getattr__(name):
+    # log is created with logging on first use
+    if name == 'log':
+        return _logger()
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
 
 def is_list(c):
     return c == list or c == typing.List or (hasattr(c, '__origin__') and c.__origin__ == typing.List)
@@ -116,7 +128,7 @@ class Typesafe(object):
         update_wrapper(self, f)
 
     def __call__(self, *args, **kwargs):
-        log.debug('calling with {} {}'.format(args, kwargs))
+        _logger().debug('calling with %s %s', args, kwargs)
         for index, arg in enumerate(args):
             check = self.checks[index]
             if check and not check(arg):